@@ -0,0 +1,273 @@
+# -*- coding: utf-8 -*-
+
+######################################################################
+######################################################################
+######################################################################
+#                                                                    #
+# bench.py                                                           #
+#                                                                    #
+######################################################################
+######################################################################
+#                                                                    #
+# Benchmarks of the generation stages of maps_class                  #
+#                                                                    #
+######################################################################
+######################################################################
+#                                                                    #
+# This program is free software: you can redistribute it and/or      #
+# modify it under the terms of the GNU General Public License as     #
+# published by the Free Software Foundation, either version 3 of     #
+# the License, or (at your option) any later version.                #
+#                                                                    #
+# This program is distributed in the hope that it will be useful,    #
+# but WITHOUT ANY WARRANTY; without even the implied warranty of     #
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU  #
+# General Public License for more details.                           #
+#                                                                    #
+# You should have received a copy of the GNU General Public License  #
+# along with this program.  If not, see                              #
+# <https://www.gnu.org/licenses/>.                                   #
+#                                                                    #
+######################################################################
+######################################################################
+#                                                                    #
+# Usage:                                                             #
+#                                                                    #
+#   python bench.py [--sizes 90x90,360x360,1024x512]                 #
+#                   [--stages generate_map,...] [--repeat 3]         #
+#                   [--seed 26894] [--output results.json]           #
+#                   [--compare previous.json] [--tolerance 1.2]      #
+#                                                                    #
+# Every stage is timed on the map left by the previous ones, with    #
+# fixed seeds, and the results are written as json, to the standard  #
+# output if there is no --output, with the messages of maps_class on #
+# the standard error. With --compare, the best times are checked     #
+# against a previous run and the exit status is 1 if any stage got   #
+# slower than the tolerance factor.                                  #
+#                                                                    #
+######################################################################
+######################################################################
+
+import sys,os,json,time,platform,tempfile,argparse,contextlib
+import numpy as np
+from simplex import simplex_class
+from maps import maps_class
+
+# Stages, in the order they run
+STAGES = ['octave_noise_35d', 'generate_map', 'generate_wind', \
+          'generate_temperature', 'generate_moist', 'generate_biome', \
+          'generate_rivers', 'save_map', 'load_map', 'save_vtk', \
+          'refine', 'rotate']
+
+######################################################################
+######################################################################
+######################################################################
+######################################################################
+
+def timed(func, repeat, setup=None):
+    ''' Wall times of repeat calls of func, setup is called before
+        every call and not timed, its result is passed to func
+    '''
+
+    times = []
+    for ii in range(repeat):
+        arg = setup() if setup is not None else None
+        t0 = time.perf_counter()
+        if setup is not None:
+            func(arg)
+        else:
+            func()
+        times.append(time.perf_counter() - t0)
+
+    return times
+
+######################################################################
+######################################################################
+
+def bench_size(nth, nch, stages, repeat, seed, tmp):
+    ''' Times the requested stages for a nth x nch map
+    '''
+
+    results = []
+
+    def add(stage, times, items):
+        results.append({'size': '{0}x{1}'.format(nth, nch), \
+                        'nth': nth, \
+                        'nch': nch, \
+                        'stage': stage, \
+                        'items': items, \
+                        'times': times, \
+                        'min': min(times), \
+                        'median': float(np.median(times)), \
+                        'mean': float(np.mean(times))})
+
+    world = maps_class(nth=nth, nch=nch, seed=seed)
+    nodes = nth*nch
+
+    # Simplex noise on the nodes of the sphere, as generate_map
+    if 'octave_noise_35d' in stages:
+        simplex = simplex_class(octaves=20, persistence=1./1.65, \
+                                scale=0.8)
+        lat = np.linspace(0., np.pi, nth)
+        lon = np.linspace(0., 2.*np.pi, nch, endpoint=False)
+        x = (np.sin(lat)[:,None]*np.cos(lon)[None,:] + 1.).ravel()
+        y = (np.sin(lat)[:,None]*np.sin(lon)[None,:] + 1.).ravel()
+        z = (np.cos(lat)[:,None]*np.ones(nch)[None,:] + 1.).ravel()
+        def noise():
+            for ii in range(nodes):
+                simplex.octave_noise_35d(x[ii], y[ii], z[ii], seed)
+        add('octave_noise_35d', timed(noise, repeat), nodes)
+
+    # The generation stages build on each other, so the previous
+    # ones run even if they are not timed. The later stages only
+    # need the heights
+    generation = STAGES[1:7]
+    last = -1
+    for ii, stage in enumerate(generation):
+        if stage in stages:
+            last = ii
+    if any([stage in stages for stage in STAGES[7:]]):
+        last = max(last, 0)
+    for stage in generation[:last+1]:
+        func = getattr(world, stage)
+        times = timed(lambda: func(silent=True), \
+                      repeat if stage in stages else 1)
+        if stage in stages:
+            add(stage, times, nodes)
+
+    name = os.path.join(tmp, 'bench.map')
+    if 'save_map' in stages or 'load_map' in stages:
+        add('save_map', timed(lambda: world.save_map(name), repeat), \
+            nodes)
+        reader = maps_class(nth=nth, nch=nch, seed=seed)
+        add('load_map', timed(lambda: reader.load_map(name), repeat), \
+            nodes)
+
+    if 'save_vtk' in stages:
+        name = os.path.join(tmp, 'bench.vtk')
+        add('save_vtk', \
+            timed(lambda: world.save_vtk(name, binary=True), repeat), \
+            nodes)
+
+    # Refine a region of the map to the same number of nodes, on a
+    # fresh copy of the map every time
+    if 'refine' in stages:
+        name = os.path.join(tmp, 'refine.map')
+        world.save_map(name)
+        def setup():
+            tile = maps_class(nth=nth, nch=nch, seed=seed)
+            tile.load_map(name)
+            return tile
+        def refine(tile):
+            tile.refine(nth=nth, nch=nch, thrange=[-30.,30.], \
+                        chrange=[-60.,60.])
+        add('refine', timed(refine, repeat, setup=setup), nodes)
+
+    # The rotation is lazy, time it with its materialization
+    if 'rotate' in stages:
+        def rotate():
+            world.rotate(90.5)
+            world.materialize_rotation()
+        add('rotate', timed(rotate, repeat), nodes)
+
+    return [res for res in results if res['stage'] in stages]
+
+######################################################################
+######################################################################
+
+def compare(results, previous, tolerance):
+    ''' Lists the stages whose best time is slower than tolerance
+        times the best time of a previous run
+    '''
+
+    best = {}
+    for res in previous['results']:
+        best[(res['size'], res['stage'])] = res['min']
+
+    slower = []
+    for res in results:
+        key = (res['size'], res['stage'])
+        if key in best and res['min'] > tolerance*best[key]:
+            slower.append({'size': res['size'], \
+                           'stage': res['stage'], \
+                           'previous': best[key], \
+                           'current': res['min'], \
+                           'ratio': res['min']/best[key]})
+
+    return slower
+
+######################################################################
+######################################################################
+
+def main(argv=None):
+    ''' Runs the benchmarks and writes the json results
+    '''
+
+    parser = argparse.ArgumentParser( \
+                 description='Benchmarks of the maps_class stages')
+    parser.add_argument('--sizes', default='90x90,360x360,1024x512', \
+                        help='comma separated nthxnch grid sizes')
+    parser.add_argument('--stages', default=','.join(STAGES), \
+                        help='comma separated stages to time')
+    parser.add_argument('--repeat', type=int, default=3, \
+                        help='timed calls of every stage')
+    parser.add_argument('--seed', type=int, default=26894, \
+                        help='seed of the generated maps')
+    parser.add_argument('--output', default=None, \
+                        help='json file, standard output if missing')
+    parser.add_argument('--compare', default=None, \
+                        help='json file of a previous run')
+    parser.add_argument('--tolerance', type=float, default=1.2, \
+                        help='allowed slowdown factor with --compare')
+    args = parser.parse_args(argv)
+
+    stages = args.stages.split(',')
+    for stage in stages:
+        if stage not in STAGES:
+            parser.error('unknown stage ' + stage)
+    sizes = []
+    for size in args.sizes.split(','):
+        try:
+            nth, nch = [int(nn) for nn in size.lower().split('x')]
+        except ValueError:
+            parser.error('sizes must be like 90x90')
+        sizes.append((nth, nch))
+
+    # Messages of maps_class go to the standard error, so the
+    # standard output is only the json results
+    results = []
+    with tempfile.TemporaryDirectory() as tmp, \
+         contextlib.redirect_stdout(sys.stderr):
+        for nth, nch in sizes:
+            results += bench_size(nth, nch, stages, \
+                                  max(1, args.repeat), args.seed, tmp)
+
+    output = {'python': platform.python_version(), \
+              'numpy': np.__version__, \
+              'platform': platform.platform(), \
+              'seed': args.seed, \
+              'repeat': args.repeat, \
+              'results': results}
+
+    status = 0
+    if args.compare is not None:
+        with open(args.compare) as f:
+            previous = json.load(f)
+        output['slower'] = compare(results, previous, args.tolerance)
+        if len(output['slower']) > 0:
+            status = 1
+
+    text = json.dumps(output, indent=1)
+    if args.output is None:
+        print(text)
+    else:
+        with open(args.output, 'w') as f:
+            f.write(text + '\n')
+
+    return status
+
+######################################################################
+######################################################################
+
+if __name__ == '__main__':
+    sys.exit(main())
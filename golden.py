@@ -0,0 +1,484 @@
+# -*- coding: utf-8 -*-
+
+######################################################################
+######################################################################
+######################################################################
+#                                                                    #
+# golden.py                                                          #
+#                                                                    #
+######################################################################
+######################################################################
+#                                                                    #
+# Reference outputs of maps_class, to check that optimized code      #
+# paths keep generating the same worlds                              #
+#                                                                    #
+######################################################################
+######################################################################
+#                                                                    #
+# This program is free software: you can redistribute it and/or      #
+# modify it under the terms of the GNU General Public License as     #
+# published by the Free Software Foundation, either version 3 of     #
+# the License, or (at your option) any later version.                #
+#                                                                    #
+# This program is distributed in the hope that it will be useful,    #
+# but WITHOUT ANY WARRANTY; without even the implied warranty of     #
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU  #
+# General Public License for more details.                           #
+#                                                                    #
+# You should have received a copy of the GNU General Public License  #
+# along with this program.  If not, see                              #
+# <https://www.gnu.org/licenses/>.                                   #
+#                                                                    #
+######################################################################
+######################################################################
+#                                                                    #
+# Usage:                                                             #
+#                                                                    #
+#   python golden.py [--cases name,...] [--reference golden.json]    #
+#   python golden.py --update                                        #
+#                                                                    #
+# Every case generates a small world for a seed and a set of         #
+# parameters and stores it with save_map. The layers are read back   #
+# from the version 1 .map file, written again after load_map when    #
+# the case uses other arguments of save_map, and the sha256 of the   #
+# file is recorded together with, for every layer, the sha256 of its #
+# float64 (int16 for the biome) values, its sum, extremes and a      #
+# fixed sample of values, also for the refined region if any.        #
+# --update writes the reference, otherwise the worlds are compared   #
+# with it and the exit status is 1 on failure.                       #
+#                                                                    #
+# Besides the default path, cases store and read the chunked         #
+# container (version=2, mmap=True), use the single and quantized     #
+# dtype policies, stream the heights (generate_map(stream=...)) and  #
+# generate the world in generate_batch.                              #
+#                                                                    #
+# Tolerance:                                                         #
+#                                                                    #
+#   - A case is "identical" when the .map hash and the hash of every #
+#     layer, refined ones included, match.                           #
+#   - Otherwise it is "close" when, for every float layer, the sum,  #
+#     extremes and sampled values match within |a - b| <= ATOL +     #
+#     RTOL*|b| (RTOL = 1e-9, ATOL = 1e-9), which allows for          #
+#     reordered floating point operations, and the biome hash,       #
+#     shapes and number of rivers, lakes and polyline points are     #
+#     exact.                                                         #
+#   - The single and quantized dtype policies lose precision, so     #
+#     their cases also allow an error of 1e-6 and 1e-4 of the range  #
+#     of every layer, and 2% and 5% of the biome nodes changing      #
+#     class, counted from the number of nodes of each class.         #
+#   - Anything else is a failure.                                    #
+#                                                                    #
+# Reference:                                                         #
+#                                                                    #
+#   golden.json was written with --update from the maps.py of the    #
+#   first commit, with np.float replaced by float so it runs on      #
+#   numpy >= 1.24 and nothing else changed. --update generates every #
+#   case as that code could, with the default dtype, without         #
+#   streamed heights or generate_batch and stored as version 1, so   #
+#   the faster paths are checked against the original outputs. Some  #
+#   .map files are not identical, as generate_temperature no longer  #
+#   stores the observed extremes of the temperature as its limits,   #
+#   so those cases are "close".                                      #
+#                                                                    #
+######################################################################
+######################################################################
+
+import sys,os,json,struct,hashlib,tempfile,argparse
+import numpy as np
+from maps import maps_class
+
+# Tolerances of the comparison, see the header
+RTOL = 1e-9
+ATOL = 1e-9
+
+# Values sampled from every layer
+NSAMPLE = 64
+
+# Small worlds: parameters of maps_class, generation and, if any,
+# dtype policy, streamed heights, arguments of save_map and load_map,
+# batch generation and refined region
+CASES = [{'name': 'default-1', \
+          'params': {'nth': 16, 'nch': 32, 'seed': 1}, \
+          'generate': 'all', \
+          'refine': {'nth': 16, 'nch': 16, \
+                     'thrange': [-30., 30.], 'chrange': [-45., 45.]}}, \
+         {'name': 'default-2', \
+          'params': {'nth': 16, 'nch': 32, 'seed': 2}, \
+          'generate': 'weather'}, \
+         {'name': 'rough-3', \
+          'params': {'nth': 18, 'nch': 24, 'seed': 3, 'octaves': 8, \
+                     'persistence': 1.3, 'frequency': 0.5, \
+                     'water': 60.}, \
+          'generate': 'weather'}, \
+         {'name': 'warm-4', \
+          'params': {'nth': 12, 'nch': 30, 'seed': 4, \
+                     'maxwindspeed': 50., 'mintemperature': -5., \
+                     'maxtemperature': 35.}, \
+          'generate': 'all'}, \
+         {'name': 'region-5', \
+          'params': {'nth': 20, 'nch': 20, 'seed': 5, \
+                     'thrange': [-30., 60.], \
+                     'chrange': [-90., 45.], \
+                     'pthrange': [-30., 60.], \
+                     'pchrange': [-90., 45.]}, \
+          'generate': 'map'}, \
+         {'name': 'chunked-6', \
+          'params': {'nth': 16, 'nch': 32, 'seed': 6}, \
+          'generate': 'all', \
+          'save': {'version': 2, 'compress': 'none', 'tile': 64}, \
+          'load': {'mmap': True}, \
+          'refine': {'nth': 12, 'nch': 12, \
+                     'thrange': [-20., 40.], 'chrange': [0., 90.]}}, \
+         {'name': 'single-7', \
+          'params': {'nth': 16, 'nch': 32, 'seed': 7}, \
+          'policy': 'single', \
+          'tolerance': {'range': 1e-6, 'biome': 0.02}, \
+          'generate': 'all', \
+          'save': {'version': 2, 'compress': 'zlib', 'tile': 8}, \
+          'load': {}}, \
+         {'name': 'quantized-8', \
+          'params': {'nth': 16, 'nch': 32, 'seed': 8}, \
+          'policy': 'quantized', \
+          'tolerance': {'range': 1e-4, 'biome': 0.05}, \
+          'generate': 'weather', \
+          'save': {'version': 2, 'compress': 'none', 'tile': 64}, \
+          'load': {'mmap': True}}, \
+         {'name': 'stream-9', \
+          'params': {'nth': 20, 'nch': 30, 'seed': 9}, \
+          'stream': True, \
+          'generate': 'all'}, \
+         {'name': 'batch-10', \
+          'params': {'nth': 16, 'nch': 32, 'seed': 10}, \
+          'batch': True, \
+          'generate': 'all'}]
+
+######################################################################
+######################################################################
+######################################################################
+######################################################################
+
+def layers(name):
+    ''' Layers of a version 1 .map file by name, rivers and lakes as
+        the latitude and longitude of their points and the offsets
+        of each polyline
+    '''
+
+    with open(name, 'rb') as f:
+        data = f.read()
+
+    pos = [0]
+
+    def read(form):
+        values = struct.unpack_from(form, data, pos[0])
+        pos[0] += struct.calcsize(form)
+        return values
+
+    def array(shape):
+        size = int(np.prod(shape))
+        values = np.frombuffer(data, dtype='<f8', count=size, \
+                               offset=pos[0])
+        pos[0] += 8*size
+        return values.astype(np.float64).reshape(shape)
+
+    # Parameters
+    nth, nch = read('<ii')
+    read('<8d')
+    read('<ii')
+    read('<5d')
+    read('<i')
+    nodes, = read('<i')
+    read('<' + 'd'*4*max(0, nodes))
+    read('<3d')
+    pos[0] += 6 + 2048
+
+    out = {'lat': array((nth,)), 'lon': array((nch,)), \
+           'height': array((nth, nch))}
+    read('<3d')
+
+    for key, shape, extra in [('wind', (nth, nch, 3), 2), \
+                              ('temperature', (nth, nch), 2), \
+                              ('moist', (nth, nch), 2), \
+                              ('biome', (nth, nch), 0)]:
+        if read('<i')[0] > 0:
+            out[key] = array(shape)
+            read('<' + 'd'*extra)
+    if 'biome' in out:
+        out['biome'] = out['biome'].astype(np.int16)
+
+    for key in ['river', 'lake']:
+        nn, = read('<i')
+        if nn < 0:
+            continue
+        coord, off = [], [0]
+        for i in range(nn):
+            length, = read('<i')
+            coord.append(array((length, 2)))
+            off.append(off[-1] + length)
+        if len(coord) > 0:
+            out[key] = np.concatenate(coord)
+        else:
+            out[key] = np.zeros((0, 2))
+        out[key + '_off'] = np.array(off, dtype=np.int64)
+
+    return out
+
+######################################################################
+######################################################################
+
+def checksum(data, counts=False):
+    ''' Hash, shape, sum, extremes and sample of an array and, with
+        counts=True, the number of nodes with each of its values
+    '''
+
+    data = np.ascontiguousarray(data)
+    flat = data.ravel()
+    record = {'sha256': hashlib.sha256(data.tobytes()).hexdigest(), \
+              'dtype': str(data.dtype), \
+              'shape': list(data.shape)}
+    if flat.size > 0:
+        index = np.linspace(0, flat.size-1, min(NSAMPLE, flat.size))
+        record['sum'] = float(np.sum(flat, dtype=np.float64))
+        record['min'] = float(np.min(flat))
+        record['max'] = float(np.max(flat))
+        record['sample'] = [float(v) for v in \
+                            flat[index.astype(np.int64)]]
+    if counts:
+        value, count = np.unique(flat, return_counts=True)
+        record['counts'] = [[int(v), int(n)] for v, n in \
+                            zip(value, count)]
+
+    return record
+
+######################################################################
+######################################################################
+
+def generate(case, tmp, plain=False):
+    ''' Generates the world of a case and its record. With plain=True
+        the world is generated as the first versions of maps.py
+        could, without dtype policy, streamed heights, chunked
+        container or batch, which is how the reference is written
+    '''
+
+    params = dict(case['params'])
+    if case.get('batch', False):
+        params['name'] = case['name']
+
+    if case.get('batch', False) and not plain:
+        world, name = batch(case, tmp)
+    else:
+        world = maps_class(**params)
+        if 'policy' in case and not plain:
+            world.set_dtype_policy(case['policy'])
+        if case.get('stream', False) and not plain:
+            world.generate_map(full=True, silent=True, \
+                               stream=os.path.join(tmp, case['name'] + \
+                                                   '.npy'))
+            if case['generate'] in ['weather', 'all']:
+                world.generate_weather()
+            if case['generate'] == 'all':
+                world.generate_rivers()
+        elif case['generate'] in ['all']:
+            world.generate_all()
+        else:
+            world.generate_map(silent=True)
+            if case['generate'] == 'weather':
+                world.generate_weather()
+        name = os.path.join(tmp, case['name'] + '.map')
+        if plain:
+            world.save_map(name)
+        else:
+            world.save_map(name, **case.get('save', {}))
+
+    # The layers as read back from the file, stored again as version
+    # 1 if the case uses other arguments
+    if 'load' in case and not plain:
+        world = maps_class(seed=case['params']['seed'])
+        world.load_map(name, **case['load'])
+        name = os.path.join(tmp, case['name'] + '-load.map')
+        world.save_map(name)
+
+    with open(name, 'rb') as f:
+        record = {'map': hashlib.sha256(f.read()).hexdigest()}
+    record['layers'] = dict([(key, checksum(val, key == 'biome')) \
+                             for key, val in layers(name).items()])
+
+    if 'refine' in case:
+        world.refine(**case['refine'])
+        name = os.path.join(tmp, case['name'] + '-refine.map')
+        world.save_map(name)
+        record['refine'] = dict([(key, checksum(val, key == 'biome')) \
+                                 for key, val in layers(name).items()])
+
+    return record
+
+######################################################################
+######################################################################
+
+def batch(case, tmp):
+    ''' Generates the world of a case in a worker process of
+        generate_batch, returns it as loaded from its .map file and
+        the name of the file
+    '''
+
+    from maps import generate_batch
+
+    params = dict(case['params'])
+    seed = params.pop('seed')
+    params['name'] = case['name']
+    for seed, files, error in generate_batch([seed], params, \
+                                             workers=2, outdir=tmp, \
+                                             stages=case['generate']):
+        if error is not None:
+            raise RuntimeError(error)
+
+    world = maps_class(seed=seed)
+    world.load_map(files[0])
+
+    return world, files[0]
+
+######################################################################
+######################################################################
+
+def close(new, ref, atol, nodes=0.):
+    ''' Whether two checksums are within the tolerance. nodes is the
+        fraction of the nodes of an integer array that may change
+    '''
+
+    if new['shape'] != ref['shape']:
+        return False
+    if new['sha256'] == ref['sha256']:
+        return True
+    if new['dtype'].startswith('int'):
+        if nodes <= 0. or 'counts' not in new or 'counts' not in ref:
+            return False
+        # Every node that changes moves one count out of a value and
+        # one into another
+        count = dict([(v, -n) for v, n in ref['counts']])
+        for v, n in new['counts']:
+            count[v] = count.get(v, 0) + n
+        moved = sum([abs(n) for n in count.values()])
+        return moved <= 2.*nodes*int(np.prod(ref['shape']))
+    if 'sum' not in ref:
+        return 'sum' not in new
+    a = np.array([new['sum'], new['min'], new['max']] + new['sample'])
+    b = np.array([ref['sum'], ref['min'], ref['max']] + ref['sample'])
+    if a.size != b.size:
+        return False
+    # The sum adds up the error of every node
+    atol = np.full(b.size, atol)
+    atol[0] *= max(1, int(np.prod(ref['shape'])))
+
+    return bool(np.all(np.abs(a - b) <= atol + RTOL*np.abs(b)))
+
+######################################################################
+######################################################################
+
+def verify(record, ref, tolerance=None):
+    ''' Compares the record of a case with its reference, returns
+        the status and the layers out of tolerance. tolerance has the
+        error allowed as a fraction of the range of every layer and
+        the fraction of the biome that may change, for the cases whose
+        dtype policy loses precision
+    '''
+
+    if tolerance is None:
+        tolerance = {}
+    span = tolerance.get('range', 0.)
+    nodes = tolerance.get('biome', 0.)
+
+    # The refined region is not in the .map file, so every group is
+    # compared even if the file is the same
+    identical = record['map'] == ref['map']
+    bad = []
+    for group in ['layers', 'refine']:
+        new = record.get(group, {})
+        old = ref.get(group, {})
+        for key in sorted(set(new) | set(old)):
+            if key not in new or key not in old:
+                bad.append(group + '/' + key)
+                continue
+            if new[key]['sha256'] != old[key]['sha256']:
+                identical = False
+            atol = ATOL
+            if 'max' in old[key]:
+                atol += span*(old[key]['max'] - old[key]['min'])
+            if not close(new[key], old[key], atol, \
+                         nodes if key == 'biome' else 0.):
+                bad.append(group + '/' + key)
+
+    if len(bad) > 0:
+        return 'failed', bad
+
+    if identical:
+        return 'identical', []
+
+    return 'close', []
+
+######################################################################
+######################################################################
+
+def main(argv=None):
+    ''' Writes or checks the reference outputs
+    '''
+
+    here = os.path.dirname(os.path.abspath(__file__))
+    parser = argparse.ArgumentParser( \
+                 description='Golden outputs of maps_class')
+    parser.add_argument('--reference', \
+                        default=os.path.join(here, 'golden.json'), \
+                        help='json file with the reference outputs')
+    parser.add_argument('--cases', default=None, \
+                        help='comma separated cases, all by default')
+    parser.add_argument('--update', action='store_true', \
+                        help='write the reference instead of checking')
+    args = parser.parse_args(argv)
+
+    names = [case['name'] for case in CASES]
+    if args.cases is None:
+        cases = CASES
+    else:
+        for name in args.cases.split(','):
+            if name not in names:
+                parser.error('unknown case ' + name)
+        cases = [case for case in CASES \
+                 if case['name'] in args.cases.split(',')]
+
+    records = {}
+    with tempfile.TemporaryDirectory() as tmp:
+        for case in cases:
+            records[case['name']] = generate(case, tmp, \
+                                             plain=args.update)
+
+    if args.update:
+        reference = {}
+        if os.path.isfile(args.reference):
+            with open(args.reference) as f:
+                reference = json.load(f)
+        reference.update(records)
+        with open(args.reference, 'w') as f:
+            f.write(json.dumps(reference, indent=1, sort_keys=True) + \
+                    '\n')
+        return 0
+
+    with open(args.reference) as f:
+        reference = json.load(f)
+
+    status = 0
+    for case in cases:
+        name = case['name']
+        if name not in reference:
+            result, bad = 'missing', []
+        else:
+            result, bad = verify(records[name], reference[name], \
+                                 case.get('tolerance', None))
+        if result in ['failed', 'missing']:
+            status = 1
+        print('{0:12s} {1} {2}'.format(name, result, ' '.join(bad)))
+
+    return status
+
+######################################################################
+######################################################################
+
+if __name__ == '__main__':
+    sys.exit(main())
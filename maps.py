@@ -99,7 +99,10 @@ _maps_class__terror = _maps_class__tnormalred + \
                       '##Error## ' + \
                       _maps_class__tnormal
 
-import sys,copy,struct
+import sys,os,io,copy,struct,json,zlib,threading,time,tracemalloc
+import contextlib,argparse
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor, as_completed
 try:
     from simplex import *
 except ImportError:
@@ -107,13 +110,13 @@ except ImportError:
     print(_maps_class__terror + msg)
     for err in sys.exc_info()[:2]:
         print(err)
-    sys.exit()
+    raise
 except:
     msg = 'Unexpected error importing simplex'
     print(_maps_class__terror + msg)
     for err in sys.exc_info()[:2]:
         print(err)
-    sys.exit()
+    raise
 try:
     import numpy as np
 except ImportError:
@@ -121,39 +124,98 @@ except ImportError:
     print(_maps_class__terror + msg)
     for err in sys.exc_info()[:2]:
         print(err)
-    sys.exit()
+    raise
 except:
     msg = 'Unexpected error importing numpy'
     print(_maps_class__terror + msg)
     for err in sys.exc_info()[:2]:
         print(err)
-    sys.exit()
+    raise
 try:
     import random
     _maps_class__random = True
 except:
     _maps_class__random = False
 try:
-    import matplotlib.pyplot as plt
-    from matplotlib import cm
-    from matplotlib.colors import LinearSegmentedColormap
-    from mpl_toolkits.axes_grid1 import make_axes_locatable
-    import matplotlib.gridspec as gridspec
-    import matplotlib.ticker as mticker
-    import cartopy.crs as ccrs
-    _maps_class__2Dsup = True
+    import lzma
+    _maps_class__lzma = True
 except:
-    _maps_class__2Dsup = False
-try:
-    from scipy import interpolate
-    _maps_class__interp = True
-except:
-    _maps_class__interp = False
-try:
-    from scipy.ndimage import filters
-    _maps_class__smooth = True
-except:
-    _maps_class__smooth = False
+    _maps_class__lzma = False
+
+# Plotting and scipy are only imported the first time they are needed,
+# the flags are None until then
+_maps_class__2Dsup = None
+_maps_class__interp = None
+_maps_class__smooth = None
+_maps_class__kdtree = None
+
+def _maps_class__load_2D():
+    ''' Imports pyplot and cartopy, returns if they are available
+    '''
+    global _maps_class__2Dsup, plt, cm, LinearSegmentedColormap, \
+           PolyCollection, LineCollection, make_axes_locatable, \
+           gridspec, mticker, ccrs
+    if _maps_class__2Dsup is None:
+        try:
+            import matplotlib.pyplot as plt
+            from matplotlib import cm
+            from matplotlib.colors import LinearSegmentedColormap
+            from matplotlib.collections import PolyCollection, \
+                                               LineCollection
+            from mpl_toolkits.axes_grid1 import make_axes_locatable
+            import matplotlib.gridspec as gridspec
+            import matplotlib.ticker as mticker
+            import cartopy.crs as ccrs
+            _maps_class__2Dsup = True
+        except:
+            _maps_class__2Dsup = False
+    return _maps_class__2Dsup
+
+def _maps_class__load_interp():
+    ''' Imports scipy/interpolate, returns if it is available
+    '''
+    global _maps_class__interp, interpolate
+    if _maps_class__interp is None:
+        try:
+            from scipy import interpolate
+            _maps_class__interp = True
+        except:
+            _maps_class__interp = False
+    return _maps_class__interp
+
+def _maps_class__load_smooth():
+    ''' Imports scipy/ndimage, returns if it is available
+    '''
+    global _maps_class__smooth, filters
+    if _maps_class__smooth is None:
+        try:
+            from scipy.ndimage import filters
+            _maps_class__smooth = True
+        except:
+            _maps_class__smooth = False
+    return _maps_class__smooth
+
+def _maps_class__load_kdtree():
+    ''' Imports scipy/spatial, returns if it is available
+    '''
+    global _maps_class__kdtree, cKDTree
+    if _maps_class__kdtree is None:
+        try:
+            from scipy.spatial import cKDTree
+            _maps_class__kdtree = True
+        except:
+            _maps_class__kdtree = False
+    return _maps_class__kdtree
+
+# Color maps and tables shared by every map
+_maps_class__colors = OrderedDict()
+_maps_class__colors_size = 64
+_maps_class__colors_lock = threading.Lock()
+
+# Noise generators shared by every map, so the worlds generated in a
+# process reuse them
+_maps_class__simplex = {}
+_maps_class__noise_lock = threading.Lock()
 
 ######################################################################
 ######################################################################
@@ -182,20 +244,7 @@ class maps_class():
             msg = 'Missing random. No automatic random seeds posible'
             self.__warning(msg)
 
-        self.__can_plot_2D = __2Dsup
-        if not self.__can_plot_2D:
-            msg = 'Missing pyplot/basemap'
-            self.__warning(msg)
-
-        self.__interp = __interp
-        if not self.__interp:
-            msg = 'Missing scypy/interpolate'
-            self.__warning(msg)
-
-        self.__smooth = __smooth
-        if not self.__smooth:
-            msg = 'Missing scypy/ndimage'
-            self.__warning(msg)
+        self.__lzma = __lzma
 
 
         #
@@ -228,6 +277,22 @@ class maps_class():
              'nps':'North Polar Stereo', \
              'sps':'North Polar Stereo'}
 
+        # Chunked .map container
+        self.__map_magic = b'MAP\x89'
+        self.__map_version = 2
+        self.__codecs = ['none', 'zlib', 'lzma']
+
+        # Storage policies: dtype of float layers and biome, and
+        # int16 quantization of heights in the chunked container
+        self.__dtype_policies = { \
+             'double': {'float': np.float64, 'biome': np.int16, \
+                        'quantize': False}, \
+             'single': {'float': np.float32, 'biome': np.int8, \
+                        'quantize': False}, \
+             'quantized': {'float': np.float32, 'biome': np.int8, \
+                           'quantize': True}}
+        self.__dtype_policy = 'double'
+
         self.__default = {'nth': 360, \
                           'nch': 360, \
                           'thrange': [-90.,90.], \
@@ -267,7 +332,7 @@ class maps_class():
                 msg = 'Unexpected error setting nth'
                 error = sys.exc_info()[:2]
                 self.__error(msg, error)
-                sys.exit()
+                raise
 
         # Azimuthal nodes
         if nch is None:
@@ -287,7 +352,7 @@ class maps_class():
                 msg = 'Unexpected error setting nch'
                 error = sys.exc_info()[:2]
                 self.__error(msg, error)
-                sys.exit()
+                raise
 
         # Polar range
         if thrange is None:
@@ -314,7 +379,7 @@ class maps_class():
                     msg = 'Unexpected error setting thrange'
                     error = sys.exc_info()[:2]
                     self.__error(msg, error)
-                    sys.exit()
+                    raise
             else:
                 msg = 'Wrong format thrange. Set default'
                 self.__warning(msg)
@@ -346,7 +411,7 @@ class maps_class():
                     msg = 'Unexpected error checking pthrange'
                     error = sys.exc_info()[:2]
                     self.__error(msg, error)
-                    sys.exit()
+                    raise
             else:
                 msg = 'Wrong format pthrange. Set default'
                 self.__warning(msg)
@@ -377,7 +442,7 @@ class maps_class():
                     msg = 'Unexpected error setting chrange'
                     error = sys.exc_info()[:2]
                     self.__error(msg, error)
-                    sys.exit()
+                    raise
             else:
                 msg = 'Wrong format chrange. Set default'
                 self.__warning(msg)
@@ -409,7 +474,7 @@ class maps_class():
                     msg = 'Unexpected error setting pchrange'
                     error = sys.exc_info()[:2]
                     self.__error(msg, error)
-                    sys.exit()
+                    raise
             else:
                 msg = 'Wrong format pchrange'
                 self.__warning(msg)
@@ -435,7 +500,7 @@ class maps_class():
                 msg = 'Unexpected error setting seed'
                 error = sys.exc_info()[:2]
                 self.__error(msg, error)
-                sys.exit()
+                raise
 
         # Octaves
         if octaves is None:
@@ -455,7 +520,7 @@ class maps_class():
                 msg = 'Unexpected error setting octaves'
                 error = sys.exc_info()[:2]
                 self.__error(msg, error)
-                sys.exit()
+                raise
 
         # Frequency
         if frequency is None:
@@ -476,7 +541,7 @@ class maps_class():
                 msg = 'Unexpected error setting frequency'
                 error = sys.exc_info()[:2]
                 self.__error(msg, error)
-                sys.exit()
+                raise
 
         # Persistence
         if persistence is None:
@@ -496,7 +561,7 @@ class maps_class():
                 msg = 'Unexpected error setting persistence'
                 error = sys.exc_info()[:2]
                 self.__error(msg, error)
-                sys.exit()
+                raise
 
         # Water
         if water is None:
@@ -517,7 +582,7 @@ class maps_class():
                 msg = 'Unexpected error setting water'
                 error = sys.exc_info()[:2]
                 self.__error(msg, error)
-                sys.exit()
+                raise
 
         # Maxdepth
         if maxdepth is None:
@@ -538,7 +603,7 @@ class maps_class():
                 msg = 'Unexpected error setting maxdepth'
                 error = sys.exc_info()[:2]
                 self.__error(msg, error)
-                sys.exit()
+                raise
 
         # Maxheight
         if maxheight is None:
@@ -557,7 +622,7 @@ class maps_class():
                 msg = 'Unexpected error setting maxheight'
                 error = sys.exc_info()[:2]
                 self.__error(msg, error)
-                sys.exit()
+                raise
 
         # Windnnodes
         if windnnodes is None:
@@ -572,7 +637,7 @@ class maps_class():
                 msg = 'Unexpected error setting windnnodes'
                 error = sys.exc_info()[:2]
                 self.__error(msg, error)
-                sys.exit()
+                raise
 
         # Windnodes
         if windnodes is None:
@@ -637,7 +702,7 @@ class maps_class():
                 msg = 'Unexpected error setting windnodes'
                 error = sys.exc_info()[:2]
                 self.__error(msg, error)
-                sys.exit()
+                raise
 
         # Maxwindspeed
         if maxwindspeed is None:
@@ -660,7 +725,7 @@ class maps_class():
                 msg = 'Unexpected error setting maxwindspeed'
                 error = sys.exc_info()[:2]
                 self.__error(msg, error)
-                sys.exit()
+                raise
 
         # Mintemperature
         if mintemperature is None:
@@ -684,7 +749,7 @@ class maps_class():
                 msg = 'Unexpected error setting mintemperature'
                 error = sys.exc_info()[:2]
                 self.__error(msg, error)
-                sys.exit()
+                raise
 
         # Maxtemperature
         if maxtemperature is None:
@@ -708,7 +773,7 @@ class maps_class():
                 msg = 'Unexpected error setting maxtemperature'
                 error = sys.exc_info()[:2]
                 self.__error(msg, error)
-                sys.exit()
+                raise
 
         # Projection
         if projection is None:
@@ -735,6 +800,52 @@ class maps_class():
         self.__biome_exist = False
         self.__river_exist = False
         self.__lake_exist = False
+        self.__fullmapx = False
+        self.__fullmapy = False
+
+        # Stages and the stages they are generated from, and the
+        # generated stages out of date after a parameter change. The
+        # transport of heat and moisture only uses the wind relative
+        # to maxwindspeed, so no stage depends on the wind scale
+        self.__stage_deps = OrderedDict([ \
+                             ('map', []), \
+                             ('wind', ['map']), \
+                             ('wind scale', ['wind']), \
+                             ('temperature', ['map', 'wind']), \
+                             ('temperature scale', ['temperature']), \
+                             ('moist', ['map', 'wind', \
+                                        'temperature scale']), \
+                             ('biome', ['map', 'temperature scale', \
+                                        'moist']), \
+                             ('rivers', ['map', 'biome'])])
+        self.__dirty = set()
+        self.__generation = {}
+        self.__moist_inputs = None
+        self.__river_inputs = None
+
+        # Wind and temperature as generated, before the scaling to
+        # maxwindspeed and the temperature limits
+        self.__wind_raw = None
+        self.__temperature_raw = None
+
+        # File backing memory mapped layers
+        self.__mmap = None
+
+        # Noise generators and least recently used refined tiles
+        self.__tile_cache = OrderedDict()
+        self.__tile_cache_size = 16
+        self.__profiling = False
+        self.__profile_memory = False
+        self.__profile_tracing = False
+        self.__profile_callback = None
+        self.__profile = OrderedDict()
+        self.__tile_lock = threading.Lock()
+
+        # Level of detail pyramid, coarser levels only
+        self.__pyramid = None
+
+        # Pending rotation of the longitude, in degrees
+        self.__lon_offset = 0.
 
 ######################################################################
 ######################################################################
@@ -794,6 +905,62 @@ class maps_class():
             for err in error:
                 print('  '+str(err))
 
+######################################################################
+######################################################################
+
+    def __can_plot_2D(self):
+        ''' Imports pyplot and cartopy the first time, returns
+            whether they are available
+        '''
+
+        if __2Dsup is None and not __load_2D():
+            msg = 'Missing pyplot/basemap'
+            self.__warning(msg)
+
+        return __2Dsup
+
+######################################################################
+######################################################################
+
+    def __has_interp(self):
+        ''' Imports scipy/interpolate the first time, returns
+            whether it is available
+        '''
+
+        if __interp is None and not __load_interp():
+            msg = 'Missing scypy/interpolate'
+            self.__warning(msg)
+
+        return __interp
+
+######################################################################
+######################################################################
+
+    def __has_smooth(self):
+        ''' Imports scipy/ndimage the first time, returns
+            whether it is available
+        '''
+
+        if __smooth is None and not __load_smooth():
+            msg = 'Missing scypy/ndimage'
+            self.__warning(msg)
+
+        return __smooth
+
+######################################################################
+######################################################################
+
+    def __has_kdtree(self):
+        ''' Imports scipy/spatial the first time, returns
+            whether it is available
+        '''
+
+        if __kdtree is None and not __load_kdtree():
+            msg = 'Missing scypy/spatial'
+            self.__warning(msg)
+
+        return __kdtree
+
 ######################################################################
 ######################################################################
 
@@ -857,6 +1024,14 @@ class maps_class():
                'The mode for\n the rivers is "defailed=False" ' + \
                'with this shortcut\n\n'
 
+        msg += ' After changing parameters, maps_class.update()' + \
+               '\n generates again only the stages out of date. New' + \
+               '\n temperature limits or maxwindspeed only rescale ' + \
+               'the\n existing maps, and the moisture, biomes and ' + \
+               'rivers\n are kept when their inputs did not change.' + \
+               '\n maps_class.get_dirty() lists the stages, and\n ' + \
+               'maps_class.get_generated() those up to date.\n\n'
+
         msg += ' Everything except the heights requires a full ' + \
                'globe map\n\n'
 
@@ -867,7 +1042,17 @@ class maps_class():
                ' if not, you will not be able to generate them\n' + \
                ' afterwards. Be careful, this process is not' + \
                ' reversible,\n it is recommended to save the' + \
-               ' global map before refining.\n\n'
+               ' global map before refining.\n To keep the ' + \
+               'global map, use maps_class.refine_tile(\n thrange' + \
+               ', chrange, nth, nch), which returns the refined\n' + \
+               ' window as a new map. The last tiles are cached.\n\n'
+
+        msg += ' maps_class.build_pyramid() builds lower resolutions' + \
+               '\n of the map, each one half of the previous. It ' + \
+               'is\n built by generate_all() and generate_weather' + \
+               '(),\n and stored in the chunked container. Use\n ' + \
+               'maps_class.get_level(level) to get a level as a ' + \
+               'new\n map, level 0 being the full resolution.\n\n'
 
         msg += ' To visualize a map in 2D, use the method\n maps' + \
                '_class.draw(). You can see a list with the\n' + \
@@ -877,17 +1062,84 @@ class maps_class():
                'short keyword using the set_projection(val)\n' + \
                ' method.\n For some projections you may want to ' + \
                'rotate the map\n in the longitude axis. Use self.' + \
-               'rotate(val) to\n rotate the longitude by val.\n\n'
+               'rotate(val) to\n rotate the longitude by val. ' + \
+               'The layers are only\n rotated when drawn or stored' + \
+               ', use\n maps_class.materialize_rotation() to rotate' + \
+               '\n them in place.\n\n'
+
+        msg += ' For a quick preview without pyplot or cartopy,' + \
+               ' use\n maps_class.render_png(layer, name). The ' + \
+               'layer is\n "height", "wind", "temperature", "moist"' + \
+               ' or\n "biome", stored with one pixel per node in ' + \
+               'the\n "pc" or "lcy" projection.\n\n'
 
         msg += ' To store a generated map, use maps_class.save_' + \
                'map().\n The default name is the parameter ' + \
-               '"name" plus ".map".\n To load a map, use maps_' + \
+               '"name" plus ".map".\n Use the argument "versio' + \
+               'n=2" to store it in the\n chunked container, with' + \
+               ' "compress" (none, zlib\n or lzma) and "tile" ' + \
+               '(tile size in nodes).\n To load a map, use maps_' + \
                'class.load_map(). The default\n name is the ' + \
-               'parameter "name" plus ".map".\n\n'
+               'parameter "name" plus ".map".\n Use the argument' + \
+               ' "mmap=True" to map the layers\n from the file ' + \
+               'instead of reading them.\n To load only a region' + \
+               ', use maps_class.load_region(\n name, thrange, ' + \
+               'chrange). Use chrange[0] > chrange[1]\n for ' + \
+               'regions across the 180 longitude.\n\n'
+
+        msg += ' To halve the memory and file size of the layers' + \
+               ',\n use maps_class.set_dtype_policy("single"). ' + \
+               'With\n "quantized" the heights are also stored as' + \
+               '\n int16 in the chunked container. The default is' + \
+               '\n "double".\n\n'
+
+        msg += ' For maps larger than the memory, use\n generate_' + \
+               'map(stream="heights.npy"). The heights are\n ' + \
+               'written to the .npy file in bands of rows and ' + \
+               'mapped\n from it, with the same result as in ' + \
+               'memory.\n\n'
+
+        msg += ' To see where the generation time goes, use\n' + \
+               ' maps_class.set_profiling(True). Every stage ' + \
+               'then\n records its wall and cpu times and number' + \
+               ' of items,\n retrieved with maps_class.get_pro' + \
+               'file() (as_json=True\n for a json string). Use ' + \
+               '"memory=True" to also\n measure the peak memory ' + \
+               'with tracemalloc, which is\n much slower, and "' + \
+               'callback" to receive every stage\n as it ' + \
+               'finishes.\n\n'
+
+        msg += ' To follow or stop a long generation, pass\n "pr' + \
+               'ogress" and "cancel" to generate_map(),\n genera' + \
+               'te_temperature(), generate_moist(),\n generate_' + \
+               'rivers(), generate_weather() or\n generate_all' + \
+               '(). progress(fraction, stage) is called\n betw' + \
+               'een rows, iterations or river sources, and the' + \
+               '\n generation stops, keeping the previous layers' + \
+               ',\n when cancel.is_set() (e.g. a threading.Even' + \
+               't).\n\n'
+
+        msg += ' To generate and store many worlds, use the module' + \
+               '\n function generate_batch(seeds, params, workers,' + \
+               '\n outdir), with the other parameters of maps_class' + \
+               '\n in the dictionary params. Every seed runs ' + \
+               'generate_all\n in a pool of worker processes and' + \
+               ' is stored as\n outdir/name_seed.map, and (seed, ' + \
+               'files, error) is\n yielded as every world finishes' + \
+               ', error being None\n unless that world failed. ' + \
+               'Invalid arguments or\n parameters raise a ValueE' + \
+               'rror before generating.\n Use "stages" (map, wea' + \
+               'ther or all), "outputs" (map,\n vtk or layers sto' + \
+               'red as png) and "cachedir" (to\n stream the heigh' + \
+               'ts) to change what is generated\n and stored.\n ' + \
+               'The same is available from the command line,\n s' + \
+               'ee python -m maps --help.\n\n'
 
         msg += ' To store the map in vtk format, use\n maps_class' + \
                '.save_vtk(). The default name is the\n parameter' + \
-               ' "name" plus ".vtk"\n\n'
+               ' "name" plus ".vtk"\n Use the argument "binary=' + \
+               'True" to store every\n layer in a single binary ' + \
+               'file.\n\n'
         
         msg += ' Enjoy the maps!'
 
@@ -1018,6 +1270,7 @@ class maps_class():
                 self.__warning(msg)
             else:
                 self.__nth = nth
+                self.__mark_dirty('map')
 
         except ValueError:
             msg = 'nth must be integer'
@@ -1052,6 +1305,7 @@ class maps_class():
                 self.__warning(msg)
             else:
                 self.__nch = nch
+                self.__mark_dirty('map')
 
         except ValueError:
             msg = 'nch must be integer'
@@ -1089,6 +1343,7 @@ class maps_class():
                 self.__warning(msg)
             else:
                 self.__thrange = [th0,th1]
+                self.__mark_dirty('map')
         except ValueError:
             msg = 'ValueError in thrange'
             self.__error(msg)
@@ -1163,6 +1418,7 @@ class maps_class():
                 self.__warning(msg)
             else:
                 self.__chrange = [ch0,ch1]
+                self.__mark_dirty('map')
         except ValueError:
             msg = 'ValueError in chrange'
             self.__error(msg)
@@ -1225,6 +1481,7 @@ class maps_class():
         '''
 
         self.__seed = seed
+        self.__mark_dirty('map')
 
 ######################################################################
 ######################################################################
@@ -1235,6 +1492,7 @@ class maps_class():
 
         if self.__random:
             self.__seed = random.randint(1,100000)
+            self.__mark_dirty('map')
         else:
             msg = 'No support of random generator'
             self.__error(msg)
@@ -1262,6 +1520,7 @@ class maps_class():
                 self.__warning(msg)
             else:
                 self.__octaves = octav
+                self.__mark_dirty('map')
         except ValueError:
             msg = 'ValueError in octaves'
             self.__error(msg)
@@ -1294,6 +1553,7 @@ class maps_class():
                 self.__warning(msg)
             else:
                 self.__frequency = freq
+                self.__mark_dirty('map')
         except ValueError:
             msg = '##Error## ValueError in octaves'
             self.__error(msg)
@@ -1326,6 +1586,7 @@ class maps_class():
                 self.__warning(msg)
             else:
                 self.__persistence = pers
+                self.__mark_dirty('map')
         except ValueError:
             msg = 'ValueError in persistence'
             self.__error(msg)
@@ -1358,8 +1619,10 @@ class maps_class():
                     self.__warning(msg)
                 else:
                     self.__water = wat
+                    self.__mark_dirty('map')
             else:
                 self.__water = -1
+                self.__mark_dirty('map')
         except ValueError:
             msg = 'ValueError in water'
             self.__error(msg)
@@ -1393,6 +1656,7 @@ class maps_class():
                 self.__warning(msg)
             else:
                 self.__maxdepth = depth
+                self.__mark_dirty('map')
         except ValueError:
             msg = 'ValueError in maxdepth'
             self.__error(msg)
@@ -1425,6 +1689,7 @@ class maps_class():
                 self.__warning(msg)
             else:
                 self.__maxheight = height
+                self.__mark_dirty('map')
         except ValueError:
             msg = 'ValueError in maxheight'
             self.__error(msg)
@@ -1450,7 +1715,9 @@ class maps_class():
         '''
 
         try:
-            self.__windnnodes = int(nodes)
+            self.__wind_nnodes = int(nodes)
+            self.__wind_nodes = None
+            self.__mark_dirty('wind')
         except:
             msg = 'Unexpected error'
             error = sys.exc_info()[:2]
@@ -1464,7 +1731,7 @@ class maps_class():
         ''' Get value of windnnodes
         '''
 
-        return self.__windnnodes
+        return self.__wind_nnodes
 
 ######################################################################
 ######################################################################
@@ -1511,6 +1778,8 @@ class maps_class():
                         self.__warning(msg)
                         return
                 self.__wind_nodes = copy.deepcopy(windnodes)
+                self.__wind_nnodes = len(windnodes)
+                self.__mark_dirty('wind')
             else:
                 msg = 'Windnodes must be a list of 4 element lists'
                 self.__warning(msg)
@@ -1540,6 +1809,8 @@ class maps_class():
             try:
                 if self.__wind_nnodes < 0:
                     __wind_nnodes = random.choice(range(4,10))
+                else:
+                    __wind_nnodes = self.__wind_nnodes
             except:
                 __wind_nnodes = self.__wind_nnodes
 
@@ -1589,6 +1860,7 @@ class maps_class():
         '''
 
         self.__wind_nodes = None
+        self.__mark_dirty('wind')
 
 
 ######################################################################
@@ -1606,6 +1878,7 @@ class maps_class():
                 self.__warning(msg)
             else:
                 self.__maxwindspeed = wind
+                self.__mark_dirty('wind scale')
         except ValueError:
             msg = 'ValueError in maxwindspeed'
             self.__error(msg)
@@ -1638,6 +1911,7 @@ class maps_class():
                 self.__warning(msg)
             else:
                 self.__mintemperature = temp
+                self.__mark_dirty('temperature scale')
         except ValueError:
             msg = 'ValueError in mintemperature'
             self.__error(msg)
@@ -1670,6 +1944,7 @@ class maps_class():
                 self.__warning(msg)
             else:
                 self.__maxtemperature = temp
+                self.__mark_dirty('temperature scale')
         except ValueError:
             msg = 'ValueError in maxtemperature'
             self.__error(msg)
@@ -1737,6 +2012,157 @@ class maps_class():
         for key in self.__modes.keys():
             msg = '{0}:{1}'.format(key,self.__modes[key])
 
+######################################################################
+######################################################################
+
+    def set_dtype_policy(self, policy):
+        ''' Set the storage policy of the layers: "double" (float64
+            layers, int16 biome), "single" (float32 layers, int8
+            biome) or "quantized" (as single, with heights stored as
+            int16 plus scale and offset in the chunked container)
+        '''
+
+        if policy in self.__dtype_policies.keys():
+            self.__dtype_policy = policy
+            self.__changed()
+        else:
+            msg = 'Unknown dtype policy'
+            self.__warning(msg)
+
+######################################################################
+######################################################################
+
+    def get_dtype_policy(self):
+        ''' Get the storage policy of the layers
+        '''
+
+        return self.__dtype_policy
+
+######################################################################
+######################################################################
+
+    def __changed(self):
+        ''' Bookkeeping after the layers change: casts them to the
+            storage policy and drops the pyramid and refined tiles
+        '''
+
+        self.__apply_dtype()
+        self.__pyramid = None
+        with self.__tile_lock:
+            self.__tile_cache.clear()
+
+######################################################################
+######################################################################
+
+    def __stage_exist(self, stage):
+        ''' Checks if the layers of a stage were generated
+        '''
+
+        if stage == 'map':
+            return self.__exist
+        elif stage in ['wind', 'wind scale']:
+            return self.__wind_exist
+        elif stage in ['temperature', 'temperature scale']:
+            return self.__temperature_exist
+        elif stage == 'moist':
+            return self.__moist_exist
+        elif stage == 'biome':
+            return self.__biome_exist
+        elif stage == 'rivers':
+            return self.__river_exist or self.__lake_exist
+
+        return False
+
+######################################################################
+######################################################################
+
+    def __mark_dirty(self, stage):
+        ''' Marks a stage, and every stage generated from it, as out
+            of date if it was generated. Refined tiles were computed
+            with the previous parameters, so they are dropped
+        '''
+
+        with self.__tile_lock:
+            self.__tile_cache.clear()
+
+        stale = set([stage])
+        for name, deps in self.__stage_deps.items():
+            if any([dep in stale for dep in deps]):
+                stale.add(name)
+
+        for name in stale:
+            if self.__stage_exist(name):
+                self.__dirty.add(name)
+
+######################################################################
+######################################################################
+
+    def __generations(self, stages):
+        ''' Number of times each of the stages was generated
+        '''
+
+        return tuple([self.__generation.get(stage, 0) \
+                      for stage in stages])
+
+######################################################################
+######################################################################
+
+    def __stage_done(self, stage):
+        ''' Bookkeeping after a stage is generated: it is up to date
+            and the stages generated from it are not
+        '''
+
+        self.__generation[stage] = self.__generation.get(stage, 0) + 1
+        self.__dirty.discard(stage)
+        for name, deps in self.__stage_deps.items():
+            if stage in deps:
+                self.__mark_dirty(name)
+
+######################################################################
+######################################################################
+
+    def __apply_dtype(self):
+        ''' Casts the existing layers to the storage policy
+        '''
+
+        pol = self.__dtype_policies[self.__dtype_policy]
+
+        if self.__exist:
+            self.__height = self.__cast(self.__height, pol['float'])
+        if self.__wind_exist:
+            self.__wind = self.__cast(self.__wind, pol['float'])
+        if self.__temperature_exist:
+            self.__temperature = self.__cast(self.__temperature, \
+                                             pol['float'])
+        if self.__moist_exist:
+            self.__moist = self.__cast(self.__moist, pol['float'])
+        if self.__biome_exist:
+            self.__biome = self.__cast(self.__biome, pol['biome'])
+
+######################################################################
+######################################################################
+
+    def __cast(self, data, dtype):
+        ''' Casts a layer to dtype in bands of rows, so memory
+            mapped layers are not read whole, rounding floats cast
+            to integers. Returns the layer itself if it already has
+            the dtype
+        '''
+
+        dtype = np.dtype(dtype)
+        if data.dtype == dtype:
+            return data
+
+        out = np.empty(data.shape, dtype=dtype)
+        band = max(1, (1 << 20)//max(1, int(np.prod(data.shape[1:]))))
+        for i0 in range(0, data.shape[0], band):
+            if dtype.kind in 'iu' and data.dtype.kind == 'f':
+                out[i0:i0+band] = np.rint(data[i0:i0+band])
+            else:
+                out[i0:i0+band] = data[i0:i0+band]
+
+        return out
+
 ######################################################################
 ######################################################################
 
@@ -1744,18 +2170,97 @@ class maps_class():
         ''' Checks if there is a map
         '''
 
-        return 'Yes' if self.__exists else 'No'
+        return 'Yes' if self.__exist else 'No'
+
+######################################################################
+######################################################################
+
+    def get_nrivers(self):
+        ''' Get number of rivers
+        '''
+
+        if not self.__river_exist:
+            return 0
+
+        return self.__river_off.size - 1
+
+######################################################################
+######################################################################
+
+    def get_river(self, ii):
+        ''' Get the ii-th river as an array (npoints,2) with
+            latitude and longitude in degrees
+        '''
+
+        if ii < 0 or ii >= self.get_nrivers():
+            msg = 'River index out of range'
+            self.__error(msg)
+            return
+
+        return self.__rotate_line(self.__line(self.__river, \
+                                              self.__river_off, ii))
+
+######################################################################
+######################################################################
+
+    def get_nlakes(self):
+        ''' Get number of lakes
+        '''
+
+        if not self.__lake_exist:
+            return 0
+
+        return self.__lake_off.size - 1
+
+######################################################################
+######################################################################
+
+    def get_lake(self, ii):
+        ''' Get the ii-th lake as an array (npoints,2) with
+            latitude and longitude in degrees
+        '''
+
+        if ii < 0 or ii >= self.get_nlakes():
+            msg = 'Lake index out of range'
+            self.__error(msg)
+            return
+
+        return self.__rotate_line(self.__line(self.__lake, \
+                                              self.__lake_off, ii))
+
+######################################################################
+######################################################################
+
+    def __get_simplex(self, octaves, persistence, frequency):
+        ''' Noise generator for the given parameters, kept so it is
+            shared by refinements, tiles and every other map
+        '''
+
+        key = (octaves, persistence, frequency)
+        with __noise_lock:
+            if key not in __simplex:
+                __simplex[key] = simplex_class(octaves=octaves, \
+                                               persistence=persistence, \
+                                               scale=frequency)
+
+            return __simplex[key]
 
 ######################################################################
 ######################################################################
 ######################################################################
 ######################################################################
 
-    def generate_all(self):
-        ''' Generates the full weather maps
+    def generate_all(self, progress=None, cancel=None):
+        ''' Generates the full weather maps. The progress callback
+            and cancel token work as in generate_map
         '''
 
-        self.generate_map(full=True)
+        if not self.__check_progress(progress, cancel):
+            return
+
+        self.generate_map(full=True, progress=progress, cancel=cancel)
+        if cancel is not None and cancel.is_set():
+            return
 
         if not self.__exist:
             msg = 'Heights could not be generated, abort order'
@@ -1776,7 +2281,9 @@ class maps_class():
             self.__exist = False
             return
 
-        self.generate_temperature()
+        self.generate_temperature(progress=progress, cancel=cancel)
+        if cancel is not None and cancel.is_set():
+            return
 
         if not self.__temperature_exist:
             msg = 'Temperature could not be generated, abort ' + \
@@ -1786,7 +2293,9 @@ class maps_class():
             self.__wind_exist = False
             return
 
-        self.generate_moist()
+        self.generate_moist(progress=progress, cancel=cancel)
+        if cancel is not None and cancel.is_set():
+            return
 
         if not self.__moist_exist:
             msg = 'Moisture could not be generated, abort ' + \
@@ -1809,7 +2318,9 @@ class maps_class():
             self.__moist_exist = False
             return
 
-        self.generate_rivers()
+        self.generate_rivers(progress=progress, cancel=cancel)
+        if cancel is not None and cancel.is_set():
+            return
 
         if not self.__river_exist:
             msg = 'Rivers could not be generated, abort ' + \
@@ -1824,13 +2335,19 @@ class maps_class():
             self.__lake_exist = False
             return
 
+        self.build_pyramid()
+
 ######################################################################
 ######################################################################
 
-    def generate_weather(self):
-        ''' Generates the full weather maps
+    def generate_weather(self, progress=None, cancel=None):
+        ''' Generates the full weather maps. The progress callback
+            and cancel token work as in generate_map
         '''
 
+        if not self.__check_progress(progress, cancel):
+            return
+
         if not self.__exist:
             msg = 'Must generate a map first'
             self.__error(msg)
@@ -1848,7 +2365,9 @@ class maps_class():
             self.__error(msg)
             return
 
-        self.generate_temperature()
+        self.generate_temperature(progress=progress, cancel=cancel)
+        if cancel is not None and cancel.is_set():
+            return
 
         if not self.__temperature_exist:
             msg = 'Temperature could not be generated, abort ' + \
@@ -1857,7 +2376,9 @@ class maps_class():
             self.__wind_exist = False
             return
 
-        self.generate_moist()
+        self.generate_moist(progress=progress, cancel=cancel)
+        if cancel is not None and cancel.is_set():
+            return
 
         if not self.__moist_exist:
             msg = 'Moisture could not be generated, abort ' + \
@@ -1878,6 +2399,86 @@ class maps_class():
             self.__moist_exist = False
             return
 
+        self.build_pyramid()
+
+######################################################################
+######################################################################
+
+    def update(self, progress=None, cancel=None):
+        ''' Generates again the stages out of date after a parameter
+            change, and only those, in the order of generate_all.
+            The progress callback and cancel token work as in
+            generate_map
+        '''
+
+        if not self.__check_progress(progress, cancel):
+            return
+
+        done = False
+        for stage in self.__stage_deps.keys():
+
+            if stage not in self.__dirty:
+                continue
+
+            if stage == 'map':
+                self.generate_map(progress=progress, cancel=cancel)
+            elif stage == 'wind':
+                self.generate_wind()
+            elif stage == 'wind scale':
+                self.__rescale_wind()
+            elif stage == 'temperature':
+                self.generate_temperature(progress=progress, \
+                                          cancel=cancel)
+            elif stage == 'temperature scale':
+                self.__rescale_temperature()
+            elif stage == 'moist':
+                self.generate_moist(progress=progress, cancel=cancel)
+            elif stage == 'biome':
+                self.generate_biome()
+                # Keep the rivers if they were traced on the same
+                # heights and biomes
+                inputs = self.__river_inputs
+                if inputs is not None and \
+                   inputs[0] == self.__generations(['map']) and \
+                   np.array_equal(inputs[1], self.__biome):
+                    self.__dirty.discard('rivers')
+            elif stage == 'rivers':
+                self.generate_rivers(progress=progress, cancel=cancel)
+            if cancel is not None and cancel.is_set():
+                return
+
+            if stage in self.__dirty:
+                msg = 'Stage ' + stage + ' could not be generated, ' + \
+                      'abort update'
+                self.__error(msg)
+                return
+            done = True
+
+        if done and self.__biome_exist:
+            self.build_pyramid()
+
+######################################################################
+######################################################################
+
+    def get_dirty(self):
+        ''' Get the stages out of date, in the order of generate_all
+        '''
+
+        return [stage for stage in self.__stage_deps.keys() \
+                if stage in self.__dirty]
+
+######################################################################
+######################################################################
+
+    def get_generated(self):
+        ''' Get the stages generated by this map and up to date, in
+            the order of generate_all
+        '''
+
+        return [stage for stage in self.__stage_deps.keys() \
+                if self.__generation.get(stage, 0) > 0 and \
+                stage not in self.__dirty]
+
 ######################################################################
 ######################################################################
 
@@ -1899,9 +2500,7 @@ class maps_class():
         pnum = nch*nth
 
         # Compute noise
-        simplex = simplex_class(octaves=octaves, \
-                                persistence=ipersistence, \
-                                scale=frequency)
+        simplex = self.__get_simplex(octaves, ipersistence, frequency)
         noise = []
         for lat in iLat:
             for lon in iLon:
@@ -1926,8 +2525,15 @@ class maps_class():
 ######################################################################
 ######################################################################
 
-    def generate_map(self, full=None, silent=False, refine=False):
-        ''' Generates a map for the current parameters
+    def generate_map(self, full=None, silent=False, refine=False, \
+                     progress=None, cancel=None, stream=None):
+        ''' Generates a map for the current parameters. The
+            progress callback is called with the fraction done and
+            the stage name, the generation stops when the cancel
+            token (like a threading.Event) is set. With stream, a
+            .npy file name, the heights are written to that file in
+            bands of rows and mapped from it, so the memory needed
+            does not grow with the map
         '''
 
         # Check silent
@@ -1938,6 +2544,16 @@ class maps_class():
         if not isinstance(refine, bool):
             refine = False
 
+        # Check stream
+        if stream is not None and not isinstance(stream, str):
+            msg = 'stream must be a file name'
+            self.__error(msg)
+            return
+
+        # Check the progress callback and the cancel token
+        if not self.__check_progress(progress, cancel):
+            return
+
         # Check if there is a previous map
         if refine and not self.__exist:
             msg = 'cannot use refine flag if there is no ' + \
@@ -1970,17 +2586,17 @@ class maps_class():
         # If full map
         if np.absolute(np.absolute(thrange[1] - thrange[0]) - \
                        np.pi) < 1e-3:
-            self.__fullmapy = True
+            fullmapy = True
         else:
-            self.__fullmapy = False
+            fullmapy = False
         if np.absolute(chrange[1] - chrange[0] - np.pi*2.) < 1e-3:
             step = 2.*np.pi/self.__nch
             Tch = chrange[1] - step
             Lon = np.linspace(chrange[0],Tch,self.__nch,endpoint=True)
-            self.__fullmapx = True
+            fullmapx = True
         else:
             Lon = np.linspace(chrange[0],chrange[1],self.__nch)
-            self.__fullmapx = False
+            fullmapx = False
 
         # Check if a full map was required here
         if full is not None:
@@ -1988,7 +2604,7 @@ class maps_class():
             if isinstance(full, bool):
                 # If requiring full map
                 if full:
-                    if not self.__fullmapx or not self.__fullmapy:
+                    if not fullmapx or not fullmapy:
                         msg = 'a full map is required, adjust ' + \
                               'thrange and chrange'
                         self.__error(msg)
@@ -2013,39 +2629,60 @@ class maps_class():
             else:
                 Lat[-1] = 0.5*(Lat[-1] + Lat[-2])
 
+        # Stream into a .npy file band by band, or keep in memory
+        if stream is None:
+            height = np.empty((self.__nth,self.__nch))
+            band = self.__nth
+        else:
+            height = np.lib.format.open_memmap(stream, mode='w+', \
+                                               dtype='<f8', \
+                                               shape=(self.__nth, \
+                                                      self.__nch))
+            band = max(1, (1 << 20)//self.__nch)
+
         # Compute noise
         msg = 'Creating height map'
         if not silent:
             self.__print(msg)
-        simplex = simplex_class(octaves=self.__octaves, \
-                                persistence=persistence, \
-                                scale=self.__frequency)
-        noise = []
-        for lat in Lat:
-            for lon in Lon:
-                x = np.sin(lat)*np.cos(lon) + 1.
-                y = np.sin(lat)*np.sin(lon) + 1.
-                z = np.cos(lat) + 1.
+        stage = self.__stage_start('noise')
+        simplex = self.__get_simplex(self.__octaves, persistence, \
+                                     self.__frequency)
+        # Cartesian coordinates of the nodes, shifted by one, a row
+        # at a time
+        sinlat = np.sin(Lat)
+        coslat = np.cos(Lat) + 1.
+        coslon = np.cos(Lon)
+        sinlon = np.sin(Lon)
+        for ii in range(self.__nth):
+            xr = sinlat[ii]*coslon + 1.
+            yr = sinlat[ii]*sinlon + 1.
+            zr = np.full(self.__nch, coslat[ii])
+            noise = []
+            for xx, yy, zz in zip(xr.tolist(), yr.tolist(), \
+                                  zr.tolist()):
                 noise.append( \
-                      simplex.scaled_octave_noise_35d(x,y,z, \
+                      simplex.scaled_octave_noise_35d(xx,yy,zz, \
                                                       self.__seed))
+            height[ii] = noise
+            if self.__progress(progress, cancel, 'noise', \
+                               (ii+1.)/self.__nth):
+                msg = 'Height generation cancelled'
+                self.__warning(msg)
+                return
+        self.__stage_stop(stage, pnum)
 
         # Water control
 
         msg = 'Filling the world with salty water'
         if not silent:
             self.__print(msg)
+        stage = self.__stage_start('water shift')
 
         # If refining
         if refine:
 
             # Adjust water
-            for kk in range(pnum):
-                noise[kk] += self.__shift
-                if noise[kk] < 0.:
-                    noise[kk] *= self.__maxdepth
-                else:
-                    noise[kk] *= self.__maxheight
+            self.__water_level(height, self.__shift, band)
 
         else:
 
@@ -2061,61 +2698,14 @@ class maps_class():
 
                 # If no extremes, compute shift
                 else:
-
-                    ints = 11
-                    actual = 0.
-                    pack = 0.
-                    minv = 0.
-                    maxv = 1.
-                    histo = [0]*(ints - 1)
-                    kk = 0
-
-                    while abs(self.__water-actual) > 1e-2:
-
-                        inter = np.linspace(minv,maxv,ints)
-
-                        for nois in noise:
-                            for jj in range(1,ints):
-
-                                if nois > inter[jj-1] and \
-                                   nois < inter[jj]:
-                                    histo[jj-1] += 1
-                                    break
-
-                        cumold = 0.
-
-                        for jj in range(0,ints-1):
-
-                            cum = cumold + histo[jj]
-                            actual = pack + cum*100./pnum
-
-                            if (actual > self.__water):
-                                minv = inter[jj]
-                                maxv = inter[jj+1]
-                                shift = -inter[jj]
-                                pack = pack + cumold*100./pnum
-                                actual = pack
-                                break
-                            else:
-                                cumold = cum
-
-                        kk += 1
-
-                        if kk > 100: break
+                    shift = self.__water_shift(height, band)
 
             else:
 
                 shift = -0.5
 
             # Measure the water level 
-            actual = 0.
-            for kk in range(pnum):
-                noise[kk] += shift
-                if noise[kk] < 0.:
-                    noise[kk] *= self.__maxdepth
-                    actual += 1.
-                else:
-                    noise[kk] *= self.__maxheight
+            actual = self.__water_level(height, shift, band)
 
             actual = actual*100./(pnum*1.)
 
@@ -2126,6 +2716,15 @@ class maps_class():
             if self.__water >= 0:
                 self.__water = actual
 
+        self.__stage_stop(stage, pnum)
+        self.__progress(progress, None, 'water shift', 1.)
+
+        # Map the stored heights, the file is left untouched
+        if stream is not None:
+            height.flush()
+            del height
+            height = np.load(stream, mmap_mode='c')
+
         # Transform into real latutude and longitude
         for ii in range(self.__nth):
             Lat[ii] = Lat[ii]*self.__rade*(-1.) + 90.
@@ -2133,26 +2732,108 @@ class maps_class():
             Lon[ii] = Lon[ii]*self.__rade - 180.
 
         # Store
+        self.__fullmapx = fullmapx
+        self.__fullmapy = fullmapy
         self.__lon = Lon
         self.__lat = Lat
-        self.__height = np.array(noise).reshape(self.__nth,self.__nch)
+        self.__lon_offset = 0.
+        self.__height = height
         self.__exist = True
+        self.__changed()
+        self.__stage_done('map')
 
         # Update extremes
         if not refine:
             self.__minz = np.min(self.__height)
             self.__maxz = np.max(self.__height)
 
-
-######################################################################
-######################################################################
 ######################################################################
 ######################################################################
 
-    def generate_wind(self, silent=False):
-        ''' Generates a wind map for the current parameters.
+    def __water_shift(self, noise, band):
+        ''' Shift of the noise that leaves the water fraction under
+            the sea level, narrowing a histogram of the noise read in
+            bands of rows
         '''
 
+        ints = 11
+        actual = 0.
+        pack = 0.
+        minv = 0.
+        maxv = 1.
+        histo = np.zeros(ints - 1, dtype=np.int64)
+        kk = 0
+        pnum = noise.size
+
+        while abs(self.__water-actual) > 1e-2:
+
+            inter = np.linspace(minv,maxv,ints)
+
+            # Count the noise strictly inside each interval
+            for i0 in range(0, noise.shape[0], band):
+                nois = np.asarray(noise[i0:i0+band]).ravel()
+                jj = np.searchsorted(inter, nois)
+                inside = (jj > 0) & (jj < ints)
+                jj = jj[inside]
+                inside = nois[inside] < inter[jj]
+                histo += np.bincount(jj[inside]-1, minlength=ints-1)
+
+            cumold = 0.
+
+            for jj, count in enumerate(histo.tolist()):
+
+                cum = cumold + count
+                actual = pack + cum*100./pnum
+
+                if (actual > self.__water):
+                    minv = inter[jj]
+                    maxv = inter[jj+1]
+                    shift = -inter[jj]
+                    pack = pack + cumold*100./pnum
+                    actual = pack
+                    break
+                else:
+                    cumold = cum
+
+            kk += 1
+
+            if kk > 100: break
+
+        return shift
+
+######################################################################
+######################################################################
+
+    def __water_level(self, noise, shift, band):
+        ''' Shifts the noise in place, in bands of rows, and scales
+            it to maxdepth below the sea level and to maxheight above
+            it. Returns the number of nodes under water
+        '''
+
+        water = 0
+        for i0 in range(0, noise.shape[0], band):
+            nois = noise[i0:i0+band]
+            nois += shift
+            under = nois < 0.
+            nois[under] *= self.__maxdepth
+            nois[~under] *= self.__maxheight
+            water += int(np.count_nonzero(under))
+
+        return float(water)
+
+
+######################################################################
+######################################################################
+######################################################################
+######################################################################
+
+    def generate_wind(self, silent=False):
+        ''' Generates a wind map for the current parameters.
+        '''
+
+        # Wind nodes are placed on the rotated longitudes
+        self.materialize_rotation()
+
         # Check silent
         if not isinstance(silent, bool):
             silent = False
@@ -2172,6 +2853,7 @@ class maps_class():
             msg = 'Blowing some wind'
             if not silent:
                 self.__print(msg)
+            stage = self.__stage_start('wind')
 
             # Allocate vector map
             __wind = np.zeros((self.__nth,self.__nch,3))
@@ -2265,9 +2947,13 @@ class maps_class():
                         # Module
                         __wind[ii,jj,2] = rf
 
-            self.__wind = __wind*self.__maxwindspeed/ \
-                          np.amax(__wind[:,:,2])
+            self.__wind_raw = __wind
+            self.__wind = self.__scale_wind(__wind)
             self.__wind_exist = True
+            self.__changed()
+            self.__stage_done('wind')
+            self.__stage_done('wind scale')
+            self.__stage_stop(stage, self.__nth*self.__nch)
 
             # Update extremes
             self.__minwind = np.min(self.__wind[:,:,2])
@@ -2280,6 +2966,39 @@ class maps_class():
             error = sys.exc_info()[:2]
             self.__error(msg, error)
 
+######################################################################
+######################################################################
+
+    def __scale_wind(self, wind):
+        ''' Wind scaled so that the maximum speed is maxwindspeed.
+            A wind without speed is kept
+        '''
+
+        maxv = np.amax(wind[:,:,2])
+        if maxv <= 0.:
+            return np.array(wind)
+
+        return wind*self.__maxwindspeed/maxv
+
+######################################################################
+######################################################################
+
+    def __rescale_wind(self):
+        ''' Scales the wind again for a new maxwindspeed, without
+            generating it again. Loaded or refined maps have no
+            unscaled wind, the scaled one works the same
+        '''
+
+        if self.__wind_raw is None:
+            self.__wind_raw = np.array(self.__wind)
+        self.__wind = self.__scale_wind(self.__wind_raw)
+        self.__changed()
+        self.__stage_done('wind scale')
+
+        # Update extremes
+        self.__minwind = np.min(self.__wind[:,:,2])
+        self.__maxwind = np.max(self.__wind[:,:,2])
+
 ######################################################################
 ######################################################################
 ######################################################################
@@ -2388,8 +3107,9 @@ class maps_class():
                         # Module
                         __wind[ii,jj,2] = rf
 
-            self.__wind = __wind*self.__maxwindspeed/ \
-                          np.amax(__wind[:,:,2])
+            self.__wind_raw = __wind
+            self.__wind = self.__scale_wind(__wind)
+            self.__changed()
             return True
 
         except:
@@ -2401,14 +3121,21 @@ class maps_class():
 ######################################################################
 ######################################################################
 
-    def generate_temperature(self, silent=False):
-        ''' Generates a temperature map for the current parameters
+    def generate_temperature(self, silent=False, progress=None, \
+                             cancel=None):
+        ''' Generates a temperature map for the current parameters.
+            The progress callback and cancel token work as in
+            generate_map
         '''
 
         # Check silent
         if not isinstance(silent, bool):
             silent = False
 
+        # Check the progress callback and the cancel token
+        if not self.__check_progress(progress, cancel):
+            return
+
         if not self.__exist:
             msg = 'Must generate a map first'
             self.__error(msg)
@@ -2475,9 +3202,16 @@ class maps_class():
                             absorb[ii,jj] *= 2.
 
             # Move the air and absorb heat
+            stage = self.__stage_start('temperature iterations')
             kk = 0
             while np.amax(__air_temperature) > 0.:
 
+                if self.__progress(progress, cancel, \
+                                   'temperature iterations', kk/51.):
+                    msg = 'Temperature generation cancelled'
+                    self.__warning(msg)
+                    return
+
                 kk += 1
 
                 # Absorb
@@ -2713,6 +3447,8 @@ class maps_class():
                                 __air_temperature[iia,jja] += \
                                          dr1*__air_temperature0[ii,jj]
 
+            self.__stage_stop(stage, kk)
+            self.__progress(progress, None, 'temperature iterations', 1.)
 
             # For each latitude
             for ii,lat in zip(range(self.__nth),self.__lat):
@@ -2741,46 +3477,101 @@ class maps_class():
 
                #__temperature[ii,:] -= 1.*np.sin(la)*np.sin(la)
 
-            self.__temperature = __temperature
-
-            pointsp = np.where(self.__temperature >= 0.)
-            if np.amax(self.__temperature) > 0.:
-                self.__temperature[pointsp] *= \
-                                              self.__maxtemperature/ \
-                                np.amax(self.__temperature[pointsp])
-
-            pointsm = np.where(self.__temperature < 0.)
-            if np.amin(self.__temperature) < 0.:
-                self.__temperature[pointsm] *= \
-                                             -self.__mintemperature/ \
-                     np.amax(np.absolute(self.__temperature[pointsm]))
+            self.__temperature_raw = __temperature
+            self.__temperature = self.__scale_temperature(__temperature)
 
             self.__temperature_exist = True
+            self.__changed()
+            self.__stage_done('temperature')
+            self.__stage_done('temperature scale')
 
-            # Update extremes
-            self.__mintemperature = np.min(self.__temperature)
-            self.__maxtemperature = np.max(self.__temperature)
- 
         except:
             self.__temperature_exist = False
             msg = 'Could not generate temperature'
             error = sys.exc_info()[:2]
             self.__error(msg, error)
 
+######################################################################
+######################################################################
+
+    def __scale_temperature(self, temperature):
+        ''' Temperature scaled so that the positive side peaks at
+            maxtemperature and the negative side at mintemperature
+        '''
+
+        temperature = np.array(temperature)
+
+        pointsp = np.where(temperature >= 0.)
+        if np.amax(temperature) > 0.:
+            temperature[pointsp] *= self.__maxtemperature/ \
+                                    np.amax(temperature[pointsp])
+
+        pointsm = np.where(temperature < 0.)
+        if np.amin(temperature) < 0.:
+            temperature[pointsm] *= -self.__mintemperature/ \
+                           np.amax(np.absolute(temperature[pointsm]))
+
+        return temperature
+
+######################################################################
+######################################################################
+
+    def __rescale_temperature(self):
+        ''' Scales the temperature again for new limits, without
+            the heat transport. Each side is scaled by its own
+            extreme, so loaded or refined maps, without the unscaled
+            temperature, use the scaled one. The moisture is kept if
+            the sea classes it starts from did not change
+        '''
+
+        if self.__temperature_raw is None:
+            self.__temperature_raw = np.array(self.__temperature)
+        self.__temperature = \
+                    self.__scale_temperature(self.__temperature_raw)
+        self.__changed()
+        self.__stage_done('temperature scale')
+
+        inputs = self.__moist_inputs
+        if inputs is not None and \
+           inputs[0] == self.__generations(['map', 'wind', \
+                                            'temperature']) and \
+           np.array_equal(inputs[1], \
+                          self.__sea_moist(self.__temperature)):
+            self.__dirty.discard('moist')
+
+######################################################################
+######################################################################
+
+    def __sea_moist(self, temperature):
+        ''' Class of the initial air moisture of every sea node in
+            generate_moist, -1 on land
+        '''
+
+        bins = [-.5, 0., 5., 10., 15., 20., 30.]
+
+        return np.where(self.__height > 0, -1, \
+                        np.digitize(temperature, bins))
+
 ######################################################################
 ######################################################################
 ######################################################################
 ######################################################################
 
-    def generate_moist(self, silent=False):
+    def generate_moist(self, silent=False, progress=None, \
+                       cancel=None):
         ''' Generates a moisture map for the current parameters
-            Experimental.
+            Experimental. The progress callback and cancel token
+            work as in generate_map
         '''
 
         # Check silent
         if not isinstance(silent, bool):
             silent = False
 
+        # Check the progress callback and the cancel token
+        if not self.__check_progress(progress, cancel):
+            return
+
         if not self.__exist:
             msg = 'Must generate a map first'
             self.__error(msg)
@@ -2868,9 +3659,16 @@ class maps_class():
             # Apply resolution factor to absorption
             absorb *= rfac
 
+            stage = self.__stage_start('moisture iterations')
             kk = 0
             while np.amax(__air_moist) > 0.:
 
+                if self.__progress(progress, cancel, \
+                                   'moisture iterations', kk/51.):
+                    msg = 'Moisture generation cancelled'
+                    self.__warning(msg)
+                    return
+
                 kk += 1
 
                 # Absorb
@@ -3108,9 +3906,17 @@ class maps_class():
                                 __air_moist[iia,jja] += dr1* \
                                                    __air_moist0[ii,jj]
 
+            self.__stage_stop(stage, kk)
+            self.__progress(progress, None, 'moisture iterations', 1.)
+
             self.__moist = __moist*1e2
 
             self.__moist_exist = True
+            self.__changed()
+            self.__stage_done('moist')
+            self.__moist_inputs = \
+                   (self.__generations(['map', 'wind', 'temperature']), \
+                    self.__sea_moist(self.__temperature))
 
             # Update extremes
             self.__minmoist = np.min(self.__moist)
@@ -3161,6 +3967,7 @@ class maps_class():
             msg = 'Clasifying land'
             if not silent:
                 self.__print(msg)
+            stage = self.__stage_start('biome')
 
             # Allocate vector map
             __biome = np.zeros((self.__nth,self.__nch),dtype=np.int16)
@@ -3233,6 +4040,9 @@ class maps_class():
 
             self.__biome = __biome
             self.__biome_exist = True
+            self.__changed()
+            self.__stage_done('biome')
+            self.__stage_stop(stage, self.__nth*self.__nch)
  
         except:
             self.__biome_exist = False
@@ -3246,15 +4056,21 @@ class maps_class():
 ######################################################################
 ######################################################################
 
-    def generate_rivers(self, detailed=None, silent=False, seed=None):
+    def generate_rivers(self, detailed=None, silent=False, seed=None, \
+                        progress=None, cancel=None):
         ''' Generates rivers/lakes
-            Extremely experimental.
+            Extremely experimental. The progress callback and cancel
+            token work as in generate_map
         '''
 
         # Check silent
         if not isinstance(silent, bool):
             silent = False
 
+        # Check the progress callback and the cancel token
+        if not self.__check_progress(progress, cancel):
+            return
+
         if not self.__exist:
             msg = 'Must generate a map first'
             self.__error(msg)
@@ -3285,7 +4101,7 @@ class maps_class():
             self.__error(msg)
             return
 
-        if not self.__interp:
+        if not self.__has_interp():
             msg = 'An interpolator is required'
             self.__error(msg)
             return
@@ -3310,6 +4126,7 @@ class maps_class():
             msg = 'Making that water flow'
             if not silent:
                 self.__print(msg)
+            stage = self.__stage_start('river tracing')
 
             # Initialize river list
             __river = []
@@ -3346,6 +4163,12 @@ class maps_class():
             # For each source, get a random point in the map
             for isource in range(Nsource):
 
+                if self.__progress(progress, cancel, 'river tracing', \
+                                   isource/float(Nsource)):
+                    msg = 'River generation cancelled'
+                    self.__warning(msg)
+                    return
+
                 # Choose random point
                 ipoint = random.choice(range(Npoints))
 
@@ -3378,15 +4201,22 @@ class maps_class():
                         __lake.append([lakx,laky])
 
             # Save rivers
-            self.__river = __river
-            if len(self.__river) > 0:
+            self.__river, self.__river_off = self.__pack_lines(__river)
+            if len(__river) > 0:
                 self.__river_exist = True
+            self.__stage_stop(stage, len(__river))
+            self.__progress(progress, None, 'river tracing', 1.)
 
             # Correct and save lakes, if any
-            self.__lake = __lake
-            if len(self.__lake) > 0:
-                self.__lake_noise()
+            if len(__lake) > 0:
+                stage = self.__stage_start('lake noise')
+                __lake = self.__lake_noise(__lake)
                 self.__lake_exist = True
+                self.__stage_stop(stage, len(__lake))
+            self.__lake, self.__lake_off = self.__pack_lines(__lake)
+            self.__river_inputs = (self.__generations(['map']), \
+                                   self.__biome)
+            self.__stage_done('rivers')
 
         except:
             self.__river_exist = False
@@ -3485,12 +4315,12 @@ class maps_class():
         if lamax > self.__lat[-1]:
             lamax = self.__lat[-1]
         x = np.linspace(lamin, lamax, num=nlat, endpoint=True, \
-                        dtype=np.float)
+                        dtype=float)
 
         lomin = lon0 - dlon
         lomax = lon0 + dlon
         y = np.linspace(lomin, lomax, num=nlon, endpoint=True, \
-                        dtype=np.float)
+                        dtype=float)
 
         # Generate submap
         if detailed:
@@ -3521,7 +4351,7 @@ class maps_class():
             zz = self.__fint((xx,yy))
 
         # Smooth the map section
-        if self.__smooth:
+        if self.__has_smooth():
 
             if np.min(zz) <= 0.:
                 sea = True
@@ -3579,12 +4409,12 @@ class maps_class():
                 if lamax > self.__lat[-1]:
                     lamax = self.__lat[-1]
                 x = np.linspace(lamin, lamax, num=nlat, \
-                                endpoint=True, dtype=np.float)
+                                endpoint=True, dtype=float)
 
                 lomin = lon1 - dlon
                 lomax = lon1 + dlon
                 y = np.linspace(lomin, lomax, num=nlon, \
-                                endpoint=True, dtype=np.float)
+                                endpoint=True, dtype=float)
 
                 # Generate submap
                 if detailed:
@@ -3866,7 +4696,7 @@ class maps_class():
 
                 # To introduce randomness
                 if lh1 < lh:
-                    WW.append(lh-lh1)
+                    WW.append(float(lh-lh1))
                     pool.append([ilat1,ilon1])
 
                 # Deterministic
@@ -4543,7 +5373,7 @@ class maps_class():
             # Get normalized height vector
             WW = []
             for key in list(pool.keys()):
-                WW.append(key)
+                WW.append(float(key))
             total = sum(WW)
             for ii in range(len(WW)):
                 WW[ii] /= total
@@ -4560,7 +5390,7 @@ class maps_class():
 ######################################################################
 ######################################################################
 
-    def __lake_noise(self):
+    def __lake_noise(self, lakes):
         ''' Adds a bit of noise to the lakes to avoid ugly squares
         '''
 
@@ -4569,11 +5399,14 @@ class maps_class():
         Mdrf = .5
         Nr = 32
 
+        # Initialize output
+        out = []
+
         # For each lake
-        for ilake in range(len(self.__lake)):
+        for ilake in range(len(lakes)):
 
             # Copy the lake
-            clake = copy.deepcopy(self.__lake[ilake])
+            clake = copy.deepcopy(lakes[ilake])
 
             # Split in axes
             clakex = clake[0]
@@ -4611,7 +5444,7 @@ class maps_class():
             if len(r) < Nr:
                  xp = copy.deepcopy(theta)
                  theta = np.linspace(-np.pi, np.pi, num=Nr, \
-                                     endpoint=False, dtype=np.float)
+                                     endpoint=False, dtype=float)
                  r = np.interp(theta,xp,r,period=2.*np.pi)
 
             # Perturbate the radius
@@ -4645,320 +5478,271 @@ class maps_class():
                         clakey[iy] -= 359.
 
             # Reconstruct lake
-            self.__lake[ilake] = [clakex, clakey]
-        
+            out.append([clakex, clakey])
+
+        return out
 
-######################################################################
 ######################################################################
 ######################################################################
 ######################################################################
 
-    def save_vtk(self, name=None, R=None, only_h=None):
-        ''' Stores a generated map in a vtk file
+    def __pack_lines(self, lines):
+        ''' Packs a list of [lat, lon] polylines in a single
+            coordinate array (npoints,2) and an offsets array
+            (nlines+1), so that line ii is coord[off[ii]:off[ii+1]]
         '''
 
-        if not self.__exist:
-            msg = 'Must generate a map first'
-            self.__error(msg)
-            return
-
-        if name is None:
-            name = self.__name + '.vtk'
+        # Offsets from the lengths of each line
+        off = np.zeros(len(lines)+1, dtype=np.int64)
+        if len(lines) > 0:
+            off[1:] = np.cumsum([len(line[0]) for line in lines])
 
-        if R is None:
-            R = 6000.0
+        # Fill the coordinates
+        coord = np.empty((off[-1],2), dtype=np.float64)
+        for line, i0, i1 in zip(lines, off[:-1], off[1:]):
+            coord[i0:i1,0] = line[0]
+            coord[i0:i1,1] = line[1]
 
-        if only_h is None:
-            only_h = False
+        return coord, off
 
-        # Wrap the map on longitudes
-        if self.__fullmapx:
-            pheight, elon = addcyclic(self.__height, self.__lon)
-            elon[-1] = 179.99
-            nch = len(elon)
-        else:
-            pheight = self.__height
-            elon = self.__lon
-            nch = self.__nch
-
-        # Manual vtk generation
-        f = open(name,'w')
-        f.write("# vtk DataFile Version 2.0\n")
-        f.write("# Map "+name+" \n")
-        f.write("ASCII\n")
-        f.write("DATASET STRUCTURED_GRID\n");
-        f.write("DIMENSIONS {0} {1} {2} \n".format( \
-                 self.__nth,nch,1))
-        f.write("POINTS  {0} float\n".format(self.__nth* \
-                                             nch))
-
-        for ii,lat in zip(range(self.__nth),self.__lat):
-            la = (90. + lat)*self.__dera
-            for jj,lon in zip(range(nch),elon):
-                lo = (lon + 180.)*self.__dera
-                x = (R + pheight[ii,jj])* \
-                    np.sin(la)*np.cos(lo)
-                y = (R + pheight[ii,jj])* \
-                    np.sin(la)*np.sin(lo)
-                z = (R + pheight[ii,jj])*np.cos(la)
-                f.write("{0} {1} {2} \n".format(x,y,z))
-
-        f.write("\n")
-        f.write("POINT_DATA {0}\n".format(nch*self.__nth))
-        f.write("SCALARS Height float\n");
-        f.write("LOOKUP_TABLE default\n");
-        for ii in range(self.__nth):
-            for jj in range(nch):
-                 f.write("{0} ".format(pheight[ii,jj]))
-        f.write("\n")
-        f.close()
+######################################################################
+######################################################################
+######################################################################
 
-        if only_h:
-            return
+    def __line(self, coord, off, ii):
+        ''' Returns a view (npoints,2) of the ii-th polyline of a
+            packed coordinate array
+        '''
 
-        # Wind
-        if self.__wind_exist:
+        return coord[off[ii]:off[ii+1]]
 
-            if self.__fullmapx:
-                plonv, elon = addcyclic(self.__wind[:,:,1], \
-                                        self.__lon)
-                platv, elon = addcyclic(self.__wind[:,:,0], \
-                                        self.__lon)
-                pmodv, elon = addcyclic(self.__wind[:,:,2], \
-                                        self.__lon)
-                elon[-1] = 179.99
-                nch = len(elon)
-            else:
-                plonv = self.__wind[:,:,1]
-                platv = self.__wind[:,:,0]
-                pmodv = self.__wind[:,:,2]
-                elon = self.__lon
-                nch = len(elon)
+######################################################################
+######################################################################
 
-            # Manual vtk generation
-            try:
+    def __line_pieces(self, coord, off, pthrange, pchrange, closed):
+        ''' Polylines of a packed coordinate array as a list of
+            (npoints,2) longitude and latitude arrays, split at the
+            180 longitude and without those outside of the ranges.
+            Closed polylines are split in their east and west halves
+        '''
 
-                if '.vtk' in name[-4:]:
-                    namev = name[0:-4] + '-v.vtk'
-                else:
-                    namev = name+'-v'
+        lat = coord[:,0]
+        lon = coord[:,1]
+        nline = off.size - 1
+        if nline < 1 or lon.size == 0:
+            return []
+
+        ids = np.repeat(np.arange(nline), np.diff(off))
+        if closed:
+            # Halves of the polygons crossing the 180 longitude
+            xl = np.full(nline, np.inf)
+            xr = np.full(nline, -np.inf)
+            np.minimum.at(xl, ids, lon)
+            np.maximum.at(xr, ids, lon)
+            cross = (xl < -170.) & (xr > 170.)
+            key = 2*ids + (cross[ids] & (lon > 0.))
+            order = np.argsort(key, kind='stable')
+            lat = lat[order]
+            lon = lon[order]
+            counts = np.bincount(key, minlength=2*nline)
+            off = np.concatenate(([0], np.cumsum(counts)))
+        else:
+            # Cut where consecutive points jump across the globe
+            jump = np.nonzero(np.abs(np.diff(lon)) > 180.)[0] + 1
+            jump = jump[ids[jump] == ids[jump-1]]
+            off = np.union1d(off, jump)
 
-            except:
-                namev = name+'-v'
+        # Bounding box of every non empty piece
+        start = off[:-1][np.diff(off) > 0]
+        end = np.append(start[1:], lon.size)
+        xl = np.minimum.reduceat(lon, start)
+        xr = np.maximum.reduceat(lon, start)
+        yl = np.minimum.reduceat(lat, start)
+        yr = np.maximum.reduceat(lat, start)
+        inside = (xr >= pchrange[0]) & (xl <= pchrange[1]) & \
+                 (yr >= pthrange[0]) & (yl <= pthrange[1])
 
-            f = open(namev,'w')
-            f.write("# vtk DataFile Version 2.0\n")
-            f.write("# Map "+name+" \n")
-            f.write("ASCII\n")
-            f.write("DATASET STRUCTURED_GRID\n");
-            f.write("DIMENSIONS {0} {1} {2} \n".format( \
-                     self.__nth,nch,1))
-            f.write("POINTS  {0} float\n".format(self.__nth* \
-                                                 nch))
+        xy = np.column_stack((lon, lat))
 
-            for ii,lat in zip(range(self.__nth),self.__lat):
-                la = (90. + lat)*self.__dera
-                for jj,lon in zip(range(nch),elon):
-                    lo = (lon + 180.)*self.__dera
-                    x = (R + pheight[ii,jj])* \
-                        np.sin(la)*np.cos(lo)
-                    y = (R + pheight[ii,jj])* \
-                        np.sin(la)*np.sin(lo)
-                    z = (R + pheight[ii,jj])*np.cos(la)
-                    f.write("{0} {1} {2} \n".format(x,y,z))
-
-            f.write("POINT_DATA {0}\n".format(nch*self.__nth))
-            f.write("VECTORS v float\n");
+        return [xy[i0:i1] for i0, i1 in zip(start[inside], end[inside])]
 
-            for ii,lat in zip(range(self.__nth),self.__lat):
-                la = (90. + lat)*self.__dera
-                ct = np.cos(la)
-                st = np.sin(la)
-                for jj,lon in zip(range(nch),elon):
-                    lo = (lon + 180.)*self.__dera
-                    cc = np.cos(lo)
-                    sc = np.sin(lo)
+######################################################################
+######################################################################
+######################################################################
+######################################################################
 
-                    lav = platv[ii,jj]
-                    lov = plonv[ii,jj]
+    def save_vtk(self, name=None, R=None, only_h=None, binary=None):
+        ''' Stores a generated map in vtk files. With binary=True,
+            every layer is stored as point data of a single legacy
+            binary vtk file
+        '''
 
-                    x = st*lav
-                    y = lov
-                    z = ct*lav
+        if not self.__exist:
+            msg = 'Must generate a map first'
+            self.__error(msg)
+            return
 
-                    vx = cc*x - sc*y
-                    vy = sc*x + cc*y
-                    vz = z
+        if name is None:
+            name = self.__name + '.vtk'
 
-                    f.write("{0} {1} {2}\n".format(vx,vy,vz))
+        if R is None:
+            R = 6000.0
 
-            f.close()
+        if only_h is None:
+            only_h = False
 
-        # Temperature
-        if self.__temperature_exist:
+        if binary is None:
+            binary = False
+
+        # Wrap the map on longitudes, with the pending rotation
+        lon, gather = self.__columns(self.__lon)
+        pheight, elon = self.__addcyclic(gather(self.__height), lon)
+        nch = len(elon)
+        npoints = self.__nth*nch
+
+        # Coordinates of the points, computed once for every layer
+        points, la, lo = self.__vtk_points(pheight, elon, R)
+
+        # Layers to store
+        fields = [['Height', 'SCALARS', pheight, '-']]
+        if not only_h:
+            if self.__wind_exist:
+                plonv, elon = self.__addcyclic( \
+                                   gather(self.__wind[:,:,1]), lon)
+                platv, elon = self.__addcyclic( \
+                                   gather(self.__wind[:,:,0]), lon)
+                fields.append(['v', 'VECTORS', \
+                               self.__vtk_wind(platv, plonv, la, lo), \
+                               '-v'])
+            if self.__temperature_exist:
+                ptemp, elon = self.__addcyclic( \
+                                   gather(self.__temperature), lon)
+                fields.append(['Temperature', 'SCALARS', ptemp, '-T'])
+            if self.__moist_exist:
+                pmoist, elon = self.__addcyclic(gather(self.__moist), \
+                                                lon)
+                fields.append(['Moisture', 'SCALARS', pmoist, '-h'])
+            if self.__biome_exist:
+                pbiome, elon = self.__addcyclic(gather(self.__biome), \
+                                                lon)
+                fields.append(['Biome', 'SCALARS', pbiome, '-b'])
+
+        # Header and structured grid
+        head = "# vtk DataFile Version 2.0\n" + \
+               "# Map "+name+" \n"
+        grid = "DATASET STRUCTURED_GRID\n" + \
+               "DIMENSIONS {0} {1} {2} \n".format(nch,self.__nth,1) + \
+               "POINTS  {0} float\n".format(npoints)
+
+        # Single binary file with every layer
+        if binary:
+
+            f = open(name,'wb')
+            f.write(str.encode(head + 'BINARY\n' + grid))
+            f.write(points.astype('>f4').tobytes())
+            f.write(str.encode("\nPOINT_DATA {0}\n".format(npoints)))
+
+            for field in fields:
+                if field[1] == 'VECTORS':
+                    f.write(str.encode("VECTORS {0} float\n". \
+                                       format(field[0])))
+                    f.write(field[2].astype('>f4').tobytes())
+                elif field[0] == 'Biome':
+                    f.write(str.encode("SCALARS {0} short 1\n". \
+                                       format(field[0]) + \
+                                       "LOOKUP_TABLE default\n"))
+                    f.write(field[2].astype('>i2').tobytes())
+                else:
+                    f.write(str.encode("SCALARS {0} float 1\n". \
+                                       format(field[0]) + \
+                                       "LOOKUP_TABLE default\n"))
+                    f.write(field[2].astype('>f4').tobytes())
+                f.write(str.encode("\n"))
 
-            if self.__fullmapx:
-                ptemp, elon = addcyclic(self.__temperature, \
-                                        self.__lon)
-                elon[-1] = 179.99
-                nch = len(elon)
-            else:
-                ptemp = self.__temperature
-                elon = self.__lon
-                nch = len(elon)
+            f.close()
 
-            # Manual vtk generation
-            try:
+            return
 
-                if '.vtk' in name[-4:]:
-                    namev = name[0:-4] + '-T.vtk'
-                else:
-                    namev = name+'-T'
+        # Manual ascii vtk generation, a file per layer
+        for field in fields:
 
-            except:
-                namev = name+'-T'
+            if field[3] == '-':
+                namev = name
+            elif '.vtk' in name[-4:]:
+                namev = name[0:-4] + field[3] + '.vtk'
+            else:
+                namev = name + field[3]
 
             f = open(namev,'w')
-            f.write("# vtk DataFile Version 2.0\n")
-            f.write("# Map "+name+" \n")
-            f.write("ASCII\n")
-            f.write("DATASET STRUCTURED_GRID\n");
-            f.write("DIMENSIONS {0} {1} {2} \n".format( \
-                     self.__nth,nch,1))
-            f.write("POINTS  {0} float\n".format(self.__nth* \
-                                                 nch))
-
-            for ii,lat in zip(range(self.__nth),self.__lat):
-                la = (90. + lat)*self.__dera
-                for jj,lon in zip(range(nch),elon):
-                    lo = (lon + 180.)*self.__dera
-                    x = (R + pheight[ii,jj])* \
-                        np.sin(la)*np.cos(lo)
-                    y = (R + pheight[ii,jj])* \
-                        np.sin(la)*np.sin(lo)
-                    z = (R + pheight[ii,jj])*np.cos(la)
-                    f.write("{0} {1} {2} \n".format(x,y,z))
-
-            f.write("POINT_DATA {0}\n".format(nch*self.__nth))
-            f.write("SCALARS Temperature float\n");
-            f.write("LOOKUP_TABLE default\n");
-
-            for ii in range(self.__nth):
-                for jj in range(nch):
-                     f.write("{0} ".format(ptemp[ii,jj]))
+            f.write(head + 'ASCII\n' + grid)
+            np.savetxt(f, points, fmt='%.9g')
             f.write("\n")
+            f.write("POINT_DATA {0}\n".format(npoints))
+            if field[1] == 'VECTORS':
+                f.write("VECTORS {0} float\n".format(field[0]))
+                np.savetxt(f, field[2], fmt='%.9g')
+            else:
+                f.write("SCALARS {0} float\n".format(field[0]))
+                f.write("LOOKUP_TABLE default\n")
+                np.savetxt(f, field[2].reshape(1,npoints), fmt='%.9g')
             f.close()
 
-        # Moisture
-        if self.__moist_exist:
-
-            if self.__fullmapx:
-                pmoist, elon = addcyclic(self.__moist, \
-                                        self.__lon)
-                elon[-1] = 179.99
-                nch = len(elon)
-            else:
-                pmoist = self.__moist
-                elon = self.__lon
-                nch = len(elon)
+######################################################################
+######################################################################
 
-            # Manual vtk generation
-            try:
+    def __addcyclic(self, data, lon):
+        ''' Wraps a map on longitudes if it is a full globe, adding
+            the first longitude at the end
+        '''
 
-                if '.vtk' in name[-4:]:
-                    namev = name[0:-4] + '-h.vtk'
-                else:
-                    namev = name+'-h'
+        if not self.__fullmapx:
+            return data, lon
 
-            except:
-                namev = name+'-h'
+        data = np.concatenate((data, data[:,:1]), axis=1)
+        elon = np.append(lon, 179.99)
 
-            f = open(namev,'w')
-            f.write("# vtk DataFile Version 2.0\n")
-            f.write("# Map "+name+" \n")
-            f.write("ASCII\n")
-            f.write("DATASET STRUCTURED_GRID\n");
-            f.write("DIMENSIONS {0} {1} {2} \n".format( \
-                     self.__nth,nch,1))
-            f.write("POINTS  {0} float\n".format(self.__nth* \
-                                                 nch))
+        return data, elon
 
-            for ii,lat in zip(range(self.__nth),self.__lat):
-                la = (90. + lat)*self.__dera
-                for jj,lon in zip(range(nch),elon):
-                    lo = (lon + 180.)*self.__dera
-                    x = (R + pheight[ii,jj])* \
-                        np.sin(la)*np.cos(lo)
-                    y = (R + pheight[ii,jj])* \
-                        np.sin(la)*np.sin(lo)
-                    z = (R + pheight[ii,jj])*np.cos(la)
-                    f.write("{0} {1} {2} \n".format(x,y,z))
-
-            f.write("POINT_DATA {0}\n".format(nch*self.__nth))
-            f.write("SCALARS Moisture float\n");
-            f.write("LOOKUP_TABLE default\n");
+######################################################################
+######################################################################
 
-            for ii in range(self.__nth):
-                for jj in range(nch):
-                     f.write("{0} ".format(pmoist[ii,jj]))
-            f.write("\n")
-            f.close()
+    def __vtk_points(self, pheight, elon, R):
+        ''' Cartesian coordinates (npoints,3) of the surface of the
+            globe for the vtk files. Also returns the polar and
+            azimuthal angles
+        '''
 
-        # Biome
-        if self.__biome_exist:
+        la = (90. + self.__lat)*self.__dera
+        lo = (elon + 180.)*self.__dera
 
-            if self.__fullmapx:
-                pbiome, elon = addcyclic(self.__biome, \
-                                         self.__lon)
-                elon[-1] = 179.99
-                nch = len(elon)
-            else:
-                pbiome = self.__biome
-                elon = self.__lon
-                nch = len(elon)
+        rr = R + pheight
+        points = np.empty((pheight.size,3), dtype=np.float32)
+        points[:,0] = (rr*np.outer(np.sin(la),np.cos(lo))).ravel()
+        points[:,1] = (rr*np.outer(np.sin(la),np.sin(lo))).ravel()
+        points[:,2] = (rr*np.cos(la)[:,None]).ravel()
 
-            # Manual vtk generation
-            try:
+        return points, la, lo
 
-                if '.vtk' in name[-4:]:
-                    namev = name[0:-4] + '-b.vtk'
-                else:
-                    namev = name+'-b'
+######################################################################
+######################################################################
 
-            except:
-                namev = name+'-b'
+    def __vtk_wind(self, platv, plonv, la, lo):
+        ''' Cartesian wind vectors (npoints,3) for the vtk files
+        '''
 
-            f = open(namev,'w')
-            f.write("# vtk DataFile Version 2.0\n")
-            f.write("# Map "+name+" \n")
-            f.write("ASCII\n")
-            f.write("DATASET STRUCTURED_GRID\n");
-            f.write("DIMENSIONS {0} {1} {2} \n".format( \
-                     self.__nth,nch,1))
-            f.write("POINTS  {0} float\n".format(self.__nth* \
-                                                 nch))
+        x = np.sin(la)[:,None]*platv
+        y = plonv
+        z = np.cos(la)[:,None]*platv
 
-            for ii,lat in zip(range(self.__nth),self.__lat):
-                la = (90. + lat)*self.__dera
-                for jj,lon in zip(range(nch),elon):
-                    lo = (lon + 180.)*self.__dera
-                    x = (R + pheight[ii,jj])* \
-                        np.sin(la)*np.cos(lo)
-                    y = (R + pheight[ii,jj])* \
-                        np.sin(la)*np.sin(lo)
-                    z = (R + pheight[ii,jj])*np.cos(la)
-                    f.write("{0} {1} {2} \n".format(x,y,z))
-
-            f.write("POINT_DATA {0}\n".format(nch*self.__nth))
-            f.write("SCALARS Biome float\n");
-            f.write("LOOKUP_TABLE default\n");
+        cc = np.cos(lo)[None,:]
+        sc = np.sin(lo)[None,:]
 
-            for ii in range(self.__nth):
-                for jj in range(nch):
-                     f.write("{0} ".format(pbiome[ii,jj]))
-            f.write("\n")
-            f.close()
+        vectors = np.empty((platv.size,3), dtype=np.float32)
+        vectors[:,0] = (cc*x - sc*y).ravel()
+        vectors[:,1] = (sc*x + cc*y).ravel()
+        vectors[:,2] = z.ravel()
 
+        return vectors
 
 ######################################################################
 ######################################################################
@@ -4981,8 +5765,12 @@ class maps_class():
 ######################################################################
 ######################################################################
 
-    def save_map(self, name=None):
-        ''' Stores the parameters in a .map file
+    def save_map(self, name=None, version=None, compress=None, \
+                 tile=None):
+        ''' Stores the map in a .map file. version=2 writes the
+            chunked container, with every layer split in tiles of
+            tile x tile nodes compressed with compress ('none',
+            'zlib' or 'lzma')
         '''
 
         if not self.__exist:
@@ -4990,6 +5778,42 @@ class maps_class():
             self.__error(msg)
             return
 
+        if version is None:
+            iversion = 1
+        else:
+            if version in [1, self.__map_version]:
+                iversion = version
+            else:
+                msg = 'Unknown .map version. Set 1'
+                self.__warning(msg)
+                iversion = 1
+
+        if compress is None:
+            icompress = 'zlib'
+        else:
+            if compress in self.__codecs:
+                icompress = compress
+            else:
+                msg = 'Unknown compression. Set zlib'
+                self.__warning(msg)
+                icompress = 'zlib'
+        if icompress == 'lzma' and not self.__lzma:
+            msg = 'Missing lzma. Set zlib'
+            self.__warning(msg)
+            icompress = 'zlib'
+
+        if tile is None:
+            itile = 256
+        else:
+            try:
+                itile = int(tile)
+                if itile < 1:
+                    raise ValueError()
+            except:
+                msg = 'Tile must be a positive integer. Set 256'
+                self.__warning(msg)
+                itile = 256
+
         if name is None:
             iname = self.__name + '.map'
         else:
@@ -4998,9 +5822,17 @@ class maps_class():
             else:
                 iname = self.__name + '.map'
 
+        # Do not truncate the file under memory mapped layers
+        if self.__mmap is not None and os.path.exists(iname):
+            if os.path.samefile(iname, self.__mmap):
+                self.__unmap()
+
         f = open(iname,'wb')
-        self.__save_parameters(f)
-        self.__save_map(f)
+        if iversion > 1:
+            self.__save_map_v2(f, icompress, itile)
+        else:
+            self.__save_parameters(f)
+            self.__save_map(f)
         f.close()
 
 ######################################################################
@@ -5065,12 +5897,12 @@ class maps_class():
             else:
                 ionly_h = False
 
-        form = '<'+'d'*self.__nth
-        f.write(struct.pack(form, *self.__lat))
-        form = '<'+'d'*self.__nch
-        f.write(struct.pack(form, *self.__lon))
-        form = '<'+'d'*self.__nth*self.__nch
-        f.write(struct.pack(form, *(self.__height.flatten())))
+        # Store the map as seen, with the pending rotation
+        lon, gather = self.__columns(self.__lon)
+
+        self.__write_array(f, self.__lat)
+        self.__write_array(f, lon)
+        self.__write_array(f, self.__height, gather)
         form = '<d'
         f.write(struct.pack(form, self.__shift))
         f.write(struct.pack(form, self.__minz))
@@ -5081,8 +5913,7 @@ class maps_class():
 
         if self.__wind_exist:
             f.write(struct.pack('<i', 1))
-            form = '<'+'d'*self.__nth*self.__nch*3
-            f.write(struct.pack(form, *(self.__wind.flatten())))
+            self.__write_array(f, self.__wind, gather)
             form = '<d'
             f.write(struct.pack(form, self.__minwind))
             f.write(struct.pack(form, self.__maxwind))
@@ -5091,9 +5922,7 @@ class maps_class():
 
         if self.__temperature_exist:
             f.write(struct.pack('<i', 1))
-            form = '<'+'d'*self.__nth*self.__nch
-            f.write(struct.pack(form, \
-                                *(self.__temperature.flatten())))
+            self.__write_array(f, self.__temperature, gather)
             form = '<d'
             f.write(struct.pack(form, self.__mintemperature))
             f.write(struct.pack(form, self.__maxtemperature))
@@ -5102,8 +5931,7 @@ class maps_class():
 
         if self.__moist_exist:
             f.write(struct.pack('<i', 1))
-            form = '<'+'d'*self.__nth*self.__nch
-            f.write(struct.pack(form, *(self.__moist.flatten())))
+            self.__write_array(f, self.__moist, gather)
             form = '<d'
             f.write(struct.pack(form, self.__minmoist))
             f.write(struct.pack(form, self.__maxmoist))
@@ -5112,37 +5940,216 @@ class maps_class():
 
         if self.__biome_exist:
             f.write(struct.pack('<i', 1))
-            form = '<'+'d'*self.__nth*self.__nch
-            f.write(struct.pack(form, *(self.__biome.flatten())))
+            self.__write_array(f, self.__biome, gather)
         else:
             f.write(struct.pack('<i', -1))
 
         if self.__river_exist:
-            nn = len(self.__river)
-            f.write(struct.pack('<i', nn))
-            if nn > 0:
-                for river in self.__river:
-                    length = len(river[0])
-                    f.write(struct.pack('<i', length))
-                    for il in range(length):
-                        f.write(struct.pack('<d', river[0][il]))
-                        f.write(struct.pack('<d', river[1][il]))
+            self.__save_lines(f, self.__rotate_line(self.__river), \
+                              self.__river_off)
         else:
             f.write(struct.pack('<i', -1))
 
         if self.__lake_exist:
-            nn = len(self.__lake)
-            f.write(struct.pack('<i', nn))
-            if nn > 0:
-                for lake in self.__lake:
-                    length = len(lake[0])
-                    f.write(struct.pack('<i', length))
-                    for il in range(length):
-                        f.write(struct.pack('<d', lake[0][il]))
-                        f.write(struct.pack('<d', lake[1][il]))
+            self.__save_lines(f, self.__rotate_line(self.__lake), \
+                              self.__lake_off)
         else:
             f.write(struct.pack('<i', -1))
 
+######################################################################
+######################################################################
+
+    def __save_lines(self, f, coord, off):
+        ''' Stores packed polylines, each one as its length followed
+            by the latitude and longitude of each point
+        '''
+
+        f.write(struct.pack('<i', off.size - 1))
+        for i0, i1 in zip(off[:-1], off[1:]):
+            f.write(struct.pack('<i', i1 - i0))
+            f.write(coord[i0:i1].astype('<f8').tobytes())
+
+######################################################################
+######################################################################
+
+    def __write_array(self, f, data, gather=None):
+        ''' Stores an array as little endian doubles in C order, in
+            bands of rows so memory mapped layers are not read whole.
+            gather moves the columns of each band
+        '''
+
+        if np.ndim(data) < 2:
+            f.write(np.ascontiguousarray(data, dtype='<f8').tobytes())
+            return
+
+        band = max(1, (1 << 20)//max(1, int(np.prod(np.shape(data)[1:]))))
+        for i0 in range(0, np.shape(data)[0], band):
+            block = data[i0:i0+band]
+            if gather is not None:
+                block = gather(block)
+            f.write(np.ascontiguousarray(block, dtype='<f8').tobytes())
+
+######################################################################
+######################################################################
+
+    def __save_map_v2(self, f, compress, tile):
+        ''' Really stores map in the chunked container: magic,
+            version, position of the table of contents and
+            parameters, followed by the layer chunks and the json
+            table of contents
+        '''
+
+        f.write(self.__map_magic)
+        f.write(struct.pack('<i', self.__map_version))
+        f.write(struct.pack('<q', 0))
+        self.__save_parameters(f)
+
+        # Disk types of the storage policy
+        pol = self.__dtype_policies[self.__dtype_policy]
+        fdtype = np.dtype(pol['float']).newbyteorder('<').str
+        bdtype = np.dtype(pol['biome']).newbyteorder('<').str
+
+        # Store the map as seen, with the pending rotation
+        lon, gather = self.__columns(self.__lon)
+
+        toc = {}
+        self.__write_layer(f, toc, 'lat', self.__lat, '<f8', \
+                           'none', None)
+        self.__write_layer(f, toc, 'lon', lon, '<f8', \
+                           'none', None)
+        if pol['quantize']:
+            # Heights as int16 over the range of the map
+            minz = float(np.amin(self.__height))
+            maxz = float(np.amax(self.__height))
+            offset = 0.5*(maxz + minz)
+            scale = max(0.5*(maxz - minz)/32767., 1e-12)
+            self.__write_layer(f, toc, 'height', self.__height, \
+                               '<i2', compress, tile, gather, \
+                               shift=self.__shift, minz=self.__minz, \
+                               maxz=self.__maxz, scale=scale, \
+                               offset=offset)
+        else:
+            self.__write_layer(f, toc, 'height', self.__height, \
+                               fdtype, compress, tile, gather, \
+                               shift=self.__shift, minz=self.__minz, \
+                               maxz=self.__maxz)
+        if self.__wind_exist:
+            self.__write_layer(f, toc, 'wind', self.__wind, fdtype, \
+                               compress, tile, gather, \
+                               minwind=self.__minwind, \
+                               maxwind=self.__maxwind)
+        if self.__temperature_exist:
+            self.__write_layer(f, toc, 'temperature', \
+                               self.__temperature, fdtype, \
+                               compress, tile, gather, \
+                               mintemperature=self.__mintemperature, \
+                               maxtemperature=self.__maxtemperature)
+        if self.__moist_exist:
+            self.__write_layer(f, toc, 'moist', self.__moist, fdtype, \
+                               compress, tile, gather, \
+                               minmoist=self.__minmoist, \
+                               maxmoist=self.__maxmoist)
+        if self.__biome_exist:
+            self.__write_layer(f, toc, 'biome', self.__biome, bdtype, \
+                               compress, tile, gather)
+        if self.__river_exist:
+            self.__write_layer(f, toc, 'river', \
+                               self.__rotate_line(self.__river), '<f8', \
+                               compress, None)
+            self.__write_layer(f, toc, 'river_off', \
+                               self.__river_off, '<i8', \
+                               compress, None)
+        if self.__lake_exist:
+            self.__write_layer(f, toc, 'lake', \
+                               self.__rotate_line(self.__lake), '<f8', \
+                               compress, None)
+            self.__write_layer(f, toc, 'lake_off', \
+                               self.__lake_off, '<i8', \
+                               compress, None)
+
+        # Pyramid levels, as "layer.level", each rotated on its own
+        # longitudes
+        if self.__pyramid is not None:
+            for ilevel, coarse in enumerate(self.__pyramid):
+                lon, gather = self.__columns(coarse['lon'])
+                for key in coarse.keys():
+                    data = coarse[key]
+                    igather = gather
+                    if key == 'lon':
+                        data = lon
+                    if key in ['lat', 'lon']:
+                        dtype = '<f8'
+                        itile = None
+                        igather = None
+                    elif key == 'biome':
+                        dtype = bdtype
+                        itile = tile
+                    else:
+                        dtype = fdtype
+                        itile = tile
+                    self.__write_layer(f, toc, \
+                                       key + '.' + str(ilevel+1), \
+                                       data, dtype, compress, itile, \
+                                       igather)
+
+        tocpos = f.tell()
+        f.write(json.dumps(toc).encode('utf8'))
+        f.seek(len(self.__map_magic) + 4)
+        f.write(struct.pack('<q', tocpos))
+
+######################################################################
+######################################################################
+
+    def __write_layer(self, f, toc, name, data, dtype, compress, \
+                      tile, gather=None, **attrs):
+        ''' Stores a layer as chunks of tile x tile nodes, in row
+            major order, and adds its entry to the table of contents.
+            With tile=None the layer is a single chunk. Tiles are
+            read a band of rows at a time, so memory mapped layers
+            are not read whole, and gather moves the columns of
+            each band. With the scale and offset attributes the
+            layer is quantized
+        '''
+
+        if gather is None:
+            gather = lambda data: data
+        if 'scale' in attrs:
+            convert = lambda data: np.rint((gather(data) - \
+                                            attrs['offset'])/ \
+                                           attrs['scale'])
+        else:
+            convert = gather
+
+        shape = np.shape(data)
+        if tile is None or len(shape) < 2:
+            tiles = None
+            blocks = [np.ascontiguousarray(convert(data), dtype=dtype)]
+        else:
+            tiles = [tile, tile]
+            bands = (np.ascontiguousarray(convert(data[i0:i0+tile]), \
+                                          dtype=dtype) \
+                     for i0 in range(0, shape[0], tile))
+            blocks = (band[:,j0:j0+tile] for band in bands \
+                      for j0 in range(0, shape[1], tile))
+
+        chunks = []
+        for block in blocks:
+            bit = np.ascontiguousarray(block).tobytes()
+            if compress == 'zlib':
+                bit = zlib.compress(bit)
+            elif compress == 'lzma':
+                bit = lzma.compress(bit)
+            chunks.append([f.tell(), len(bit)])
+            f.write(bit)
+
+        toc[name] = {'dtype': dtype, \
+                     'shape': list(shape), \
+                     'tile': tiles, \
+                     'codec': compress, \
+                     'chunks': chunks, \
+                     'attrs': dict([[key, float(attrs[key])] \
+                                    for key in attrs])}
+
 ######################################################################
 ######################################################################
 ######################################################################
@@ -5175,20 +6182,42 @@ class maps_class():
 ######################################################################
 ######################################################################
 
-    def load_map(self, name=None):
-        ''' Load a .map file
+    def load_map(self, name=None, mmap=None):
+        ''' Load a .map file, in any version. With mmap=True the
+            layers are memory mapped copy-on-write views of the file,
+            only read from disk when used. In the chunked container
+            only uncompressed layers stored as a single tile can be
+            mapped, the rest are read
         '''
 
         if name is None:
             name = self.__name + '.map'
 
+        if mmap is None:
+            immap = False
+        else:
+            if isinstance(mmap, bool):
+                immap = mmap
+            else:
+                immap = False
+
         try:
+            if immap:
+                self.__unmap()
+                self.__mmap = name
+            else:
+                self.__mmap = None
             f = open(name,'rb')
+            version, tocpos = self.__load_version(f)
             check = self.__load_parameters(f)
 
             if check:
 
-                checkb = self.__load_map(f)
+                if version > 1:
+                    toc = self.__load_toc(f, tocpos)
+                    checkb = self.__load_map_v2(f, toc)
+                else:
+                    checkb = self.__load_map(f)
 
                 if checkb:
                     self.__exist = True
@@ -5220,7 +6249,10 @@ class maps_class():
                     self.__fullmapx = False
 
 
-                cw, ct, cm, cb = self.__load_map_weather(f)
+                if version > 1:
+                    cw, ct, cm, cb = self.__load_map_weather_v2(f, toc)
+                else:
+                    cw, ct, cm, cb = self.__load_map_weather(f)
 
                 if cw > 0:
                     self.__wind_exist = True
@@ -5259,7 +6291,10 @@ class maps_class():
                         self.__biome_exist = False
 
 
-                cr, cl = self.__load_map_water(f)
+                if version > 1:
+                    cr, cl = self.__load_map_water_v2(f, toc)
+                else:
+                    cr, cl = self.__load_map_water(f)
 
                 if cr == 0:
                     self.__river_exist = True
@@ -5278,6 +6313,16 @@ class maps_class():
                               'lakes anymore'
                         self.__warning(msg)
                         self.__lake_exist = False
+
+                self.__lon_offset = 0.
+                self.__changed()
+                self.__dirty.clear()
+                self.__moist_inputs = None
+                self.__river_inputs = None
+                self.__wind_raw = None
+                self.__temperature_raw = None
+                if version > 1:
+                    self.__load_pyramid_v2(f, toc)
             f.close()
             return True
         except ValueError:
@@ -5295,13 +6340,209 @@ class maps_class():
 ######################################################################
 ######################################################################
 
-    def __load_parameters(self, f):
-        ''' Really loads the parameters
+    def load_region(self, name=None, thrange=None, chrange=None):
+        ''' Load the part of a .map file inside thrange and chrange,
+            reading from disk only the needed rows and columns of
+            each layer. If chrange[0] > chrange[1] the region crosses
+            the 180 longitude seam, and the longitude is continued
+            beyond 180. Only rivers and lakes touching the region
+            are kept
         '''
 
-        try:
+        if name is None:
+            name = self.__name + '.map'
 
-            bit = f.read(4)
+        # Polar range
+        if thrange is None:
+            msg = 'thrange is a required parameter'
+            self.__error(msg)
+            return False
+        try:
+            __thrange = [float(th) for th in thrange]
+            if len(__thrange) != 2 or \
+               __thrange[0] >= __thrange[1] or \
+               __thrange[0] < -90. or \
+               __thrange[1] > 90.:
+                raise ValueError()
+        except:
+            msg = 'Bad range in thrange.'
+            self.__error(msg)
+            return False
+
+        # Azimuthal range
+        if chrange is None:
+            msg = 'chrange is a required parameter'
+            self.__error(msg)
+            return False
+        try:
+            __chrange = [float(ch) for ch in chrange]
+            if len(__chrange) != 2 or \
+               __chrange[0] == __chrange[1] or \
+               __chrange[0] < -180. or \
+               __chrange[0] > 180. or \
+               __chrange[1] < -180. or \
+               __chrange[1] > 180.:
+                raise ValueError()
+            if __chrange[1] < __chrange[0]:
+                __chrange[1] += 360.
+        except:
+            msg = 'Bad range in chrange.'
+            self.__error(msg)
+            return False
+
+        try:
+            f = open(name,'rb')
+            version, tocpos = self.__load_version(f)
+            check = self.__load_parameters(f)
+            if not check:
+                f.close()
+                return False
+            self.__mmap = None
+
+            if version > 1:
+                toc = self.__load_toc(f, tocpos)
+                linepos = None
+            else:
+                toc, linepos = self.__scan_map(f)
+
+            lat = self.__read_layer(f, toc['lat'])
+            lon = self.__read_layer(f, toc['lon'])
+            fullmapy = np.absolute(self.__thrange[1] - \
+                                   self.__thrange[0] - 180.) < 1e-3
+            fullmapx = np.absolute(self.__chrange[1] - \
+                                   self.__chrange[0] - 360.) < 1e-3
+
+            # Rows, contiguous as the latitude grows
+            rows = np.nonzero((lat >= __thrange[0]) & \
+                              (lat <= __thrange[1]))[0]
+
+            # Columns, sorted from chrange[0] and split at the seam
+            width = __chrange[1] - __chrange[0]
+            dlon = np.mod(lon - __chrange[0], 360.)
+            cols = np.nonzero(dlon <= width + 1e-9)[0]
+            cols = cols[np.argsort(dlon[cols], kind='stable')]
+
+            if rows.size < 3 or cols.size < 3:
+                f.close()
+                msg = 'The region must contain at least 3x3 nodes'
+                self.__error(msg)
+                return False
+
+            cut = np.nonzero(np.diff(cols) != 1)[0] + 1
+            spans = [(int(c[0]), int(c[-1]) + 1) \
+                     for c in np.split(cols, cut)]
+            i0 = int(rows[0])
+            i1 = int(rows[-1]) + 1
+
+            # Grid layers
+            height = self.__read_region(f, toc['height'], i0, i1, spans)
+            layers = {}
+            for key in ['wind', 'temperature', 'moist', 'biome']:
+                if key in toc:
+                    layers[key] = self.__read_region(f, toc[key], \
+                                                     i0, i1, spans)
+
+            # Rivers and lakes
+            if linepos is None:
+                river = self.__read_lines_v2(f, toc, 'river')
+                lake = self.__read_lines_v2(f, toc, 'lake')
+            else:
+                f.seek(linepos)
+                river = self.__load_lines(f)
+                lake = self.__load_lines(f)
+            f.close()
+
+        except ValueError:
+            msg = 'Invalid inputs in load_region'
+            self.__error(msg)
+            return False
+        except:
+            msg = 'Unexpected error in load_region'
+            error = sys.exc_info()[:2]
+            self.__error(msg, error)
+            return False
+
+        # Continue the longitude beyond the seam
+        elon = lon[cols] + 360.*np.concatenate([[0], \
+                              np.cumsum(np.diff(lon[cols]) < 0.)])
+
+        # Store the region
+        self.__nth = i1 - i0
+        self.__nch = cols.size
+        self.__lat = np.array(lat[i0:i1])
+        self.__lon = elon
+        self.__fullmapy = bool(fullmapy and self.__nth == lat.size)
+        self.__fullmapx = bool(fullmapx and self.__nch == lon.size)
+        if not self.__fullmapy:
+            self.__thrange = [float(self.__lat[0]), \
+                              float(self.__lat[-1])]
+            self.__pthrange = list(self.__thrange)
+        if not self.__fullmapx:
+            self.__chrange = [float(elon[0]), float(elon[-1])]
+            self.__pchrange = list(self.__chrange)
+        self.__height = height
+        self.__shift = float(toc['height']['attrs']['shift'])
+        self.__minz = float(toc['height']['attrs']['minz'])
+        self.__maxz = float(toc['height']['attrs']['maxz'])
+        self.__exist = True
+
+        self.__wind_exist = 'wind' in layers
+        if self.__wind_exist:
+            self.__wind = layers['wind']
+            self.__minwind = float(toc['wind']['attrs']['minwind'])
+            self.__maxwind = float(toc['wind']['attrs']['maxwind'])
+        self.__temperature_exist = 'temperature' in layers
+        if self.__temperature_exist:
+            self.__temperature = layers['temperature']
+            attrs = toc['temperature']['attrs']
+            self.__mintemperature = float(attrs['mintemperature'])
+            self.__maxtemperature = float(attrs['maxtemperature'])
+        self.__moist_exist = 'moist' in layers
+        if self.__moist_exist:
+            self.__moist = layers['moist']
+            self.__minmoist = float(toc['moist']['attrs']['minmoist'])
+            self.__maxmoist = float(toc['moist']['attrs']['maxmoist'])
+        self.__biome_exist = 'biome' in layers
+        if self.__biome_exist:
+            self.__biome = layers['biome']
+
+        center = __chrange[0] + 0.5*width
+        self.__river_exist = False
+        if river is not None:
+            self.__river, self.__river_off = \
+                           self.__clip_lines(river[0], river[1], \
+                                             __thrange, __chrange, \
+                                             center)
+            self.__river_exist = self.__river_off.size > 1
+        self.__lake_exist = False
+        if lake is not None:
+            self.__lake, self.__lake_off = \
+                           self.__clip_lines(lake[0], lake[1], \
+                                             __thrange, __chrange, \
+                                             center)
+            self.__lake_exist = self.__lake_off.size > 1
+
+        self.__lon_offset = 0.
+        self.__changed()
+        self.__dirty.clear()
+        self.__moist_inputs = None
+        self.__river_inputs = None
+        self.__wind_raw = None
+        self.__temperature_raw = None
+        return True
+
+######################################################################
+######################################################################
+######################################################################
+######################################################################
+
+    def __load_parameters(self, f):
+        ''' Really loads the parameters
+        '''
+
+        try:
+
+            bit = f.read(4)
             self.__nth = struct.unpack('<i', bit)[0]
             if self.__nth < 3:
                 raise ValueError()
@@ -5328,7 +6569,7 @@ class maps_class():
                l0 < -180. or \
                l0 > 180. or \
                l1 < -180. or \
-               l1 > 180.:
+               l1 > l0 + 360.:
                 raise ValueError()
 
             bit = f.read(16)
@@ -5348,7 +6589,7 @@ class maps_class():
                l0 < -180. or \
                l0 > 180. or \
                l1 < -180. or \
-               l1 > 180.:
+               l1 > l0 + 360.:
                 raise ValueError()
 
             bit = f.read(4)
@@ -5458,16 +6699,10 @@ class maps_class():
         '''
 
         try:
-            bit = f.read(8*self.__nth)
-            form = '<'+'d'*self.__nth
-            self.__lat = np.array(struct.unpack(form, bit))
-            bit = f.read(8*self.__nch)
-            form = '<'+'d'*self.__nch
-            self.__lon = np.array(struct.unpack(form, bit))
-            bit = f.read(8*self.__nth*self.__nch)
-            form = '<'+'d'*self.__nth*self.__nch
-            self.__height = np.array(struct.unpack(form, bit)). \
-                               reshape(self.__nth,self.__nch)
+            self.__lat = self.__read_array(f, (self.__nth,))
+            self.__lon = self.__read_array(f, (self.__nch,))
+            self.__height = self.__read_array(f, \
+                                       (self.__nth,self.__nch))
             bit = f.read(8)
             form = '<d'
             self.__shift = float(struct.unpack(form, bit)[0])
@@ -5497,10 +6732,8 @@ class maps_class():
             bit = f.read(4)
             cw = int(struct.unpack('<i', bit)[0])
             if cw > 0:
-                bit = f.read(8*self.__nth*self.__nch*3)
-                form = '<'+'d'*self.__nth*self.__nch*3
-                self.__wind = np.array(struct.unpack(form, bit)). \
-                                     reshape(self.__nth,self.__nch,3)
+                self.__wind = self.__read_array(f, \
+                                       (self.__nth,self.__nch,3))
                 bit = f.read(8)
                 form = '<d'
                 self.__minwind = float(struct.unpack(form, bit)[0])
@@ -5514,11 +6747,8 @@ class maps_class():
             bit = f.read(4)
             ct = int(struct.unpack('<i', bit)[0])
             if ct > 0:
-                bit = f.read(8*self.__nth*self.__nch)
-                form = '<'+'d'*self.__nth*self.__nch
-                self.__temperature = \
-                               np.array(struct.unpack(form, bit)). \
-                                        reshape(self.__nth,self.__nch)
+                self.__temperature = self.__read_array(f, \
+                                       (self.__nth,self.__nch))
                 bit = f.read(8)
                 form = '<d'
                 self.__mintemperature = \
@@ -5534,10 +6764,8 @@ class maps_class():
             bit = f.read(4)
             cm = int(struct.unpack('<i', bit)[0])
             if cm > 0:
-                bit = f.read(8*self.__nth*self.__nch)
-                form = '<'+'d'*self.__nth*self.__nch
-                self.__moist = np.array(struct.unpack(form, bit)). \
-                                  reshape(self.__nth,self.__nch)
+                self.__moist = self.__read_array(f, \
+                                       (self.__nth,self.__nch))
                 bit = f.read(8)
                 form = '<d'
                 self.__minmoist = float(struct.unpack(form, bit)[0])
@@ -5551,10 +6779,8 @@ class maps_class():
             bit = f.read(4)
             cb = int(struct.unpack('<i', bit)[0])
             if cb > 0:
-                bit = f.read(8*self.__nth*self.__nch)
-                form = '<'+'d'*self.__nth*self.__nch
-                self.__biome = np.array(struct.unpack(form, bit)). \
-                                  reshape(self.__nth,self.__nch)
+                self.__biome = self.__read_array(f, \
+                                       (self.__nth,self.__nch))
         except:
             cb = -1
 
@@ -5571,58 +6797,474 @@ class maps_class():
 
         # Rivers
         try:
-            bit = f.read(4)
-            form = '<i'
-            nrivers = struct.unpack(form,bit)[0]
-            if nrivers < 1:
+            lines = self.__load_lines(f)
+            if lines is None:
                 riv = -1
             else:
-                self.__river = []
+                self.__river, self.__river_off = lines
                 riv = 0
-                for ir in range(nrivers):
-                    bit = f.read(4)
-                    form = '<i'
-                    length = struct.unpack(form,bit)[0]
-                    riverx = []
-                    rivery = []
-                    for il in range(length):
-                        form = '<d'
-                        bit = f.read(8)
-                        riverx.append(struct.unpack(form,bit)[0])
-                        bit = f.read(8)
-                        rivery.append(struct.unpack(form,bit)[0])
-                    self.__river.append([riverx,rivery])
         except:
             riv = -1
 
         # Lakes
         try:
-            bit = f.read(4)
-            form = '<i'
-            nlakes = struct.unpack(form,bit)[0]
-            if nlakes < 1:
+            lines = self.__load_lines(f)
+            if lines is None:
                 lak = -1
             else:
-                self.__lake = []
+                self.__lake, self.__lake_off = lines
                 lak = 0
-                for ir in range(nlakes):
-                    bit = f.read(4)
-                    form = '<i'
-                    length = struct.unpack(form,bit)[0]
-                    lakex = []
-                    lakey = []
-                    for il in range(length):
-                        form = '<d'
-                        bit = f.read(8)
-                        lakex.append(struct.unpack(form,bit)[0])
-                        bit = f.read(8)
-                        lakey.append(struct.unpack(form,bit)[0])
-                    self.__lake.append([lakex,lakey])
         except:
             lak = -1
 
         return riv, lak
 
+######################################################################
+######################################################################
+
+    def __load_lines(self, f):
+        ''' Really loads polylines into a packed coordinate array
+            and its offsets. Returns None if there are no lines
+        '''
+
+        bit = f.read(4)
+        nlines = struct.unpack('<i', bit)[0]
+        if nlines < 1:
+            return None
+
+        off = np.zeros(nlines+1, dtype=np.int64)
+        coord = []
+        for il in range(nlines):
+            bit = f.read(4)
+            length = struct.unpack('<i', bit)[0]
+            bit = f.read(16*length)
+            coord.append(np.frombuffer(bit, dtype='<f8'). \
+                                               reshape(length,2))
+            off[il+1] = off[il] + length
+        coord = np.concatenate(coord)
+
+        return coord, off
+
+######################################################################
+######################################################################
+
+    def __read_array(self, f, shape):
+        ''' Really loads an array of little endian doubles, reading
+            straight from the file into the array buffer, or mapping
+            it if the map is loaded with mmap=True
+        '''
+
+        if self.__mmap is not None:
+            data = np.memmap(self.__mmap, dtype='<f8', mode='c', \
+                             offset=f.tell(), shape=shape)
+            f.seek(data.nbytes, 1)
+            return data
+
+        data = np.empty(shape, dtype='<f8')
+        nbytes = f.readinto(data)
+        if nbytes != data.nbytes:
+            raise ValueError()
+
+        return data.astype(float, copy=False)
+
+######################################################################
+######################################################################
+
+    def __unmap(self):
+        ''' Reads into memory every memory mapped layer
+        '''
+
+        if self.__mmap is None:
+            return
+
+        if self.__exist:
+            self.__lat = np.array(self.__lat)
+            self.__lon = np.array(self.__lon)
+            self.__height = np.array(self.__height)
+        if self.__wind_exist and isinstance(self.__wind, np.memmap):
+            self.__wind = np.array(self.__wind)
+        if self.__temperature_exist and \
+           isinstance(self.__temperature, np.memmap):
+            self.__temperature = np.array(self.__temperature)
+        if self.__moist_exist and isinstance(self.__moist, np.memmap):
+            self.__moist = np.array(self.__moist)
+        if self.__biome_exist and isinstance(self.__biome, np.memmap):
+            self.__biome = np.array(self.__biome)
+
+        self.__mmap = None
+
+######################################################################
+######################################################################
+######################################################################
+######################################################################
+
+    def __load_version(self, f):
+        ''' Identifies the .map version. Returns the version and the
+            position of the table of contents, None for version 1
+        '''
+
+        bit = f.read(len(self.__map_magic))
+        if bit != self.__map_magic:
+            f.seek(0)
+            return 1, None
+
+        bit = f.read(4)
+        version = struct.unpack('<i', bit)[0]
+        if version < 2 or version > self.__map_version:
+            msg = 'Unsupported .map version ' + str(version)
+            raise ValueError(msg)
+        bit = f.read(8)
+        tocpos = struct.unpack('<q', bit)[0]
+
+        return version, tocpos
+
+######################################################################
+######################################################################
+
+    def __load_toc(self, f, tocpos):
+        ''' Really loads the table of contents of the chunked container
+        '''
+
+        pos = f.tell()
+        f.seek(tocpos)
+        toc = json.loads(f.read().decode('utf8'))
+        f.seek(pos)
+
+        return toc
+
+######################################################################
+######################################################################
+
+    def __read_layer(self, f, entry):
+        ''' Really loads a layer of the chunked container, tile by
+            tile
+        '''
+
+        dtype = np.dtype(entry['dtype'])
+        shape = tuple(entry['shape'])
+        codec = entry['codec']
+        if codec not in self.__codecs or \
+           (codec == 'lzma' and not self.__lzma):
+            msg = 'Unsupported compression ' + str(codec)
+            raise ValueError(msg)
+
+        if self.__mmap is not None and codec == 'none' and \
+           len(entry['chunks']) == 1 and \
+           'scale' not in entry['attrs']:
+            pos, nbytes = entry['chunks'][0]
+            return np.memmap(self.__mmap, dtype=dtype, mode='c', \
+                             offset=pos, shape=shape)
+
+        if entry['tile'] is None:
+            blocks = [tuple(slice(0, n) for n in shape)]
+        else:
+            t0, t1 = entry['tile']
+            blocks = [(slice(i0, i0+t0), slice(j0, j0+t1)) \
+                      for i0 in range(0, shape[0], t0) \
+                      for j0 in range(0, shape[1], t1)]
+
+        data = np.empty(shape, dtype=dtype)
+        for block, (pos, nbytes) in zip(blocks, entry['chunks']):
+            f.seek(pos)
+            bit = f.read(nbytes)
+            if len(bit) != nbytes:
+                raise ValueError()
+            if codec == 'zlib':
+                bit = zlib.decompress(bit)
+            elif codec == 'lzma':
+                bit = lzma.decompress(bit)
+            view = data[block]
+            view[...] = np.frombuffer(bit, dtype=dtype). \
+                                               reshape(view.shape)
+
+        return self.__dequantize(entry, data)
+
+######################################################################
+######################################################################
+
+    def __dequantize(self, entry, data):
+        ''' Undoes the int16 quantization of a layer, if any
+        '''
+
+        attrs = entry['attrs']
+        if 'scale' not in attrs:
+            return data
+
+        pol = self.__dtype_policies[self.__dtype_policy]
+
+        return (data*attrs['scale'] + attrs['offset']). \
+                                     astype(pol['float'], copy=False)
+
+######################################################################
+######################################################################
+
+    def __load_map_v2(self, f, toc):
+        ''' Really loads the map from the chunked container
+        '''
+
+        try:
+            self.__lat = self.__read_layer(f, toc['lat'])
+            self.__lon = self.__read_layer(f, toc['lon'])
+            entry = toc['height']
+            self.__height = self.__read_layer(f, entry)
+            self.__shift = float(entry['attrs']['shift'])
+            self.__minz = float(entry['attrs']['minz'])
+            self.__maxz = float(entry['attrs']['maxz'])
+            if self.__height.shape != (self.__nth,self.__nch):
+                raise ValueError()
+            return True
+        except:
+            msg = 'Unexpected error loading map'
+            error = sys.exc_info()[:2]
+            self.__error(msg, error)
+            return False
+
+######################################################################
+######################################################################
+
+    def __load_map_weather_v2(self, f, toc):
+        ''' Really loads the map weather from the chunked container
+        '''
+
+        try:
+            entry = toc['wind']
+            self.__wind = self.__read_layer(f, entry)
+            self.__minwind = float(entry['attrs']['minwind'])
+            self.__maxwind = float(entry['attrs']['maxwind'])
+            cw = 1
+        except:
+            cw = -1
+
+        try:
+            entry = toc['temperature']
+            self.__temperature = self.__read_layer(f, entry)
+            self.__mintemperature = \
+                            float(entry['attrs']['mintemperature'])
+            self.__maxtemperature = \
+                            float(entry['attrs']['maxtemperature'])
+            ct = 1
+        except:
+            ct = -1
+
+        try:
+            entry = toc['moist']
+            self.__moist = self.__read_layer(f, entry)
+            self.__minmoist = float(entry['attrs']['minmoist'])
+            self.__maxmoist = float(entry['attrs']['maxmoist'])
+            cm = 1
+        except:
+            cm = -1
+
+        try:
+            self.__biome = self.__read_layer(f, toc['biome'])
+            cb = 1
+        except:
+            cb = -1
+
+        return cw, ct, cm, cb
+
+######################################################################
+######################################################################
+
+    def __load_map_water_v2(self, f, toc):
+        ''' Really loads the map rivers and lakes from the chunked
+            container
+        '''
+
+        try:
+            self.__river = np.array(self.__read_layer(f, toc['river']))
+            self.__river_off = \
+                         np.array(self.__read_layer(f, toc['river_off']))
+            riv = 0
+        except:
+            riv = -1
+
+        try:
+            self.__lake = np.array(self.__read_layer(f, toc['lake']))
+            self.__lake_off = \
+                          np.array(self.__read_layer(f, toc['lake_off']))
+            lak = 0
+        except:
+            lak = -1
+
+        return riv, lak
+
+######################################################################
+######################################################################
+
+    def __load_pyramid_v2(self, f, toc):
+        ''' Really loads the pyramid levels from the chunked container,
+            if they were stored
+        '''
+
+        pyramid = []
+        while 'height.' + str(len(pyramid)+1) in toc:
+            suffix = '.' + str(len(pyramid)+1)
+            coarse = {}
+            for key in ['lat', 'lon', 'height', 'wind', \
+                        'temperature', 'moist', 'biome']:
+                if key + suffix in toc:
+                    coarse[key] = self.__read_layer(f, toc[key + suffix])
+            pyramid.append(coarse)
+
+        if len(pyramid) > 0:
+            self.__pyramid = pyramid
+
+######################################################################
+######################################################################
+
+    def __scan_map(self, f):
+        ''' Locates the layers of a version 1 .map file without
+            reading them. Returns a table of contents like the one of
+            the chunked container, with a chunk per row, and the
+            position of the rivers
+        '''
+
+        nth = self.__nth
+        nch = self.__nch
+
+        def entry(pos, shape, **attrs):
+            if len(shape) < 2:
+                tile = None
+                chunks = [[pos, 8*shape[0]]]
+            else:
+                tile = [1, nch]
+                row = 8*int(np.prod(shape[1:]))
+                chunks = [[pos + ii*row, row] for ii in range(nth)]
+            return {'dtype': '<f8', 'shape': list(shape), \
+                    'tile': tile, 'codec': 'none', \
+                    'chunks': chunks, 'attrs': attrs}
+
+        toc = {}
+        pos = f.tell()
+        toc['lat'] = entry(pos, (nth,))
+        pos += 8*nth
+        toc['lon'] = entry(pos, (nch,))
+        pos += 8*nch
+        hpos = pos
+        pos += 8*nth*nch
+        f.seek(pos)
+        shift, minz, maxz = struct.unpack('<ddd', f.read(24))
+        toc['height'] = entry(hpos, (nth,nch), shift=shift, \
+                              minz=minz, maxz=maxz)
+
+        names = [['wind', (nth,nch,3), 'minwind', 'maxwind'], \
+                 ['temperature', (nth,nch), 'mintemperature', \
+                  'maxtemperature'], \
+                 ['moist', (nth,nch), 'minmoist', 'maxmoist'], \
+                 ['biome', (nth,nch)]]
+        for item in names:
+            flag = struct.unpack('<i', f.read(4))[0]
+            if flag < 1:
+                continue
+            pos = f.tell()
+            f.seek(8*int(np.prod(item[1])), 1)
+            attrs = {}
+            for key in item[2:]:
+                attrs[key] = struct.unpack('<d', f.read(8))[0]
+            toc[item[0]] = entry(pos, item[1], **attrs)
+
+        return toc, f.tell()
+
+######################################################################
+######################################################################
+
+    def __read_region(self, f, entry, i0, i1, spans):
+        ''' Really loads the rows i0 to i1 of the column spans of a
+            tiled layer. Only the overlapping tiles are read, and
+            from uncompressed tiles only the needed bytes
+        '''
+
+        dtype = np.dtype(entry['dtype'])
+        shape = tuple(entry['shape'])
+        codec = entry['codec']
+        if codec not in self.__codecs or \
+           (codec == 'lzma' and not self.__lzma):
+            msg = 'Unsupported compression ' + str(codec)
+            raise ValueError(msg)
+
+        depth = shape[2:]
+        node = dtype.itemsize*int(np.prod(depth))
+        t0, t1 = entry['tile']
+        ntc = (shape[1] + t1 - 1)//t1
+        ncol = sum([b - a for a, b in spans])
+        data = np.empty((i1-i0,ncol)+depth, dtype=dtype)
+
+        c0 = 0
+        for a, b in spans:
+            for ti in range(i0//t0, (i1-1)//t0 + 1):
+                for tj in range(a//t1, (b-1)//t1 + 1):
+                    pos, nbytes = entry['chunks'][ti*ntc + tj]
+                    r0 = ti*t0
+                    r1 = min(r0 + t0, shape[0])
+                    q0 = tj*t1
+                    q1 = min(q0 + t1, shape[1])
+                    ra = max(r0, i0)
+                    rb = min(r1, i1)
+                    qa = max(q0, a)
+                    qb = min(q1, b)
+                    out = data[ra-i0:rb-i0,c0+qa-a:c0+qb-a]
+                    if codec == 'none':
+                        for ii in range(ra, rb):
+                            f.seek(pos + ((ii - r0)*(q1 - q0) + \
+                                          qa - q0)*node)
+                            if f.readinto(out[ii-ra]) != \
+                               out[ii-ra].nbytes:
+                                raise ValueError()
+                        continue
+                    f.seek(pos)
+                    bit = f.read(nbytes)
+                    if codec == 'zlib':
+                        bit = zlib.decompress(bit)
+                    elif codec == 'lzma':
+                        bit = lzma.decompress(bit)
+                    block = np.frombuffer(bit, dtype=dtype). \
+                                      reshape((r1-r0,q1-q0)+depth)
+                    out[...] = block[ra-r0:rb-r0,qa-q0:qb-q0]
+            c0 += b - a
+
+        return self.__dequantize(entry, data)
+
+######################################################################
+######################################################################
+
+    def __read_lines_v2(self, f, toc, name):
+        ''' Really loads packed polylines from the chunked container.
+            Returns None if there are none
+        '''
+
+        if name not in toc:
+            return None
+
+        coord = np.array(self.__read_layer(f, toc[name]))
+        off = np.array(self.__read_layer(f, toc[name + '_off']))
+
+        return coord, off
+
+######################################################################
+######################################################################
+
+    def __clip_lines(self, coord, off, thrange, chrange, center):
+        ''' Keeps the polylines with any point inside the region,
+            with the longitude continued around the region center
+        '''
+
+        lengths = np.diff(off)
+        inside = (coord[:,0] >= thrange[0]) & \
+                 (coord[:,0] <= thrange[1]) & \
+                 (np.mod(coord[:,1] - chrange[0], 360.) <= \
+                  chrange[1] - chrange[0])
+        owner = np.repeat(np.arange(lengths.size), lengths)
+        keep = np.zeros(lengths.size, dtype=bool)
+        keep[owner[inside]] = True
+
+        coord = np.array(coord[np.repeat(keep, lengths)])
+        coord[:,1] = center + np.mod(coord[:,1] - center + 180., \
+                                     360.) - 180.
+        off = np.concatenate([[0], np.cumsum(lengths[keep])])
+
+        return coord, off.astype(np.int64)
+
 ######################################################################
 ######################################################################
 ######################################################################
@@ -5640,7 +7282,7 @@ class maps_class():
             return
 
         # Check there is interpolation
-        if not self.__interp:
+        if not self.__has_interp():
             if force is None:
                 iforce = False
             else:
@@ -5775,6 +7417,10 @@ class maps_class():
             self.__error(msg)
             return
 
+        # Ranges are given on the rotated longitudes, rotate the
+        # layers once the arguments are valid
+        self.materialize_rotation()
+
         # Store old quantities
         __lat_old = copy.deepcopy(self.__lat)
         __lon_old = copy.deepcopy(self.__lon)
@@ -5840,9 +7486,12 @@ class maps_class():
                 w1 = copy.deepcopy(self.__wind[:,:,1])
                 w2 = copy.deepcopy(self.__wind[:,:,2])
 
-                self.__interN(w0, __lat_old, __lon_old, __height_old)
-                self.__interN(w1, __lat_old, __lon_old, __height_old)
-                self.__interN(w2, __lat_old, __lon_old, __height_old)
+                w0 = self.__interN(w0, __lat_old, __lon_old, \
+                                   __height_old)
+                w1 = self.__interN(w1, __lat_old, __lon_old, \
+                                   __height_old)
+                w2 = self.__interN(w2, __lat_old, __lon_old, \
+                                   __height_old)
 
                 self.__wind = np.zeros((self.__nth,self.__nch,3))
                 self.__wind[:,:,0] = w0
@@ -5867,12 +7516,469 @@ class maps_class():
         # Biome
         self.generate_biome(silent=True)
 
+        self.__changed()
+        self.__dirty.clear()
+        self.__moist_inputs = None
+        self.__river_inputs = None
+        self.__wind_raw = None
+        self.__temperature_raw = None
+######################################################################
+######################################################################
+
+    def refine_tile(self, thrange=None, chrange=None, nth=None, \
+                    nch=None):
+        ''' Returns a new map with a refined window of this one, as
+            refine does, leaving this map untouched. The last tiles
+            are cached, so asking again for the same window returns
+            the same object, which should not be modified
+        '''
+
+        if not self.__exist:
+            msg = 'Must generate a map first'
+            self.__error(msg)
+            return None
+
+        try:
+            key = (tuple([float(th) for th in thrange]), \
+                   tuple([float(ch) for ch in chrange]), \
+                   int(nth), int(nch))
+        except:
+            msg = 'Invalid inputs in refine_tile'
+            self.__error(msg)
+            return None
+
+        # Windows are given on the rotated longitudes, which only
+        # the copy takes
+        key = key + (self.__lon_offset,)
+
+        with self.__tile_lock:
+            if key in self.__tile_cache:
+                self.__tile_cache.move_to_end(key)
+                return self.__tile_cache[key]
+
+        # Refine replaces the shared layers instead of modifying them
+        tile = self.__shallow_copy()
+        tile.refine(nth=nth, nch=nch, thrange=thrange, chrange=chrange)
+        if not tile.__exist or tile.__thrange != list(key[0]) or \
+           tile.__chrange != list(key[1]):
+            return None
+
+        with self.__tile_lock:
+            self.__tile_cache[key] = tile
+            self.__tile_cache.move_to_end(key)
+            while len(self.__tile_cache) > self.__tile_cache_size:
+                self.__tile_cache.popitem(last=False)
+
+        return tile
+
+######################################################################
+######################################################################
+
+    def set_tile_cache_size(self, size):
+        ''' Set how many refined tiles are kept
+        '''
+
+        try:
+            self.__tile_cache_size = max(0, int(size))
+        except:
+            msg = 'Invalid tile cache size'
+            self.__warning(msg)
+            return
+        with self.__tile_lock:
+            while len(self.__tile_cache) > self.__tile_cache_size:
+                self.__tile_cache.popitem(last=False)
+
+######################################################################
+######################################################################
+
+    def get_tile_cache_size(self):
+        ''' Get how many refined tiles are kept
+        '''
+
+        return self.__tile_cache_size
+
+######################################################################
+######################################################################
+######################################################################
+######################################################################
+
+    def set_profiling(self, enable=True, memory=False, callback=None):
+        ''' Turns on or off the record of the wall time, cpu time,
+            peak memory and number of items of every generation
+            stage. Turning it on clears the previous records. The
+            peak memory is only measured with memory=True, through
+            tracemalloc, which makes the generation many times
+            slower. The callback, if any, is called with the name and
+            the record of every finished stage
+        '''
+
+        if not isinstance(enable, bool) or not isinstance(memory, bool):
+            msg = 'enable and memory must be bool'
+            self.__warning(msg)
+            return
+
+        if callback is not None and not callable(callback):
+            msg = 'callback must be callable'
+            self.__warning(msg)
+            return
+
+        # Stop the memory tracing started here
+        if self.__profile_tracing:
+            tracemalloc.stop()
+            self.__profile_tracing = False
+
+        self.__profiling = enable
+        self.__profile_memory = enable and memory
+        self.__profile_callback = callback if enable else None
+        if enable:
+            self.__profile = OrderedDict()
+            if memory and not tracemalloc.is_tracing():
+                tracemalloc.start()
+                self.__profile_tracing = True
+
+######################################################################
+######################################################################
+
+    def get_profile(self, as_json=False):
+        ''' Records of the generation stages, by stage name, with
+            the number of calls, the total wall and cpu times in
+            seconds, the highest peak of memory in bytes and the
+            total number of items. As a json string with as_json
+        '''
+
+        profile = OrderedDict()
+        for name, record in self.__profile.items():
+            profile[name] = dict(record)
+
+        if as_json:
+            return json.dumps(profile, indent=1)
+
+        return profile
+
+######################################################################
+######################################################################
+
+    def __stage_start(self, name):
+        ''' Starts the record of a stage, if profiling
+        '''
+
+        if not self.__profiling:
+            return None
+
+        mem = 0
+        if self.__profile_memory and tracemalloc.is_tracing():
+            tracemalloc.reset_peak()
+            mem = tracemalloc.get_traced_memory()[0]
+
+        return (name, time.perf_counter(), time.process_time(), mem)
+
+######################################################################
+######################################################################
+
+    def __stage_stop(self, stage, count=0):
+        ''' Adds the record of a stage started by __stage_start
+        '''
+
+        if stage is None:
+            return
+
+        name, wall, cpu, mem = stage
+        record = {'wall': time.perf_counter() - wall, \
+                  'cpu': time.process_time() - cpu, \
+                  'peak': 0, \
+                  'count': int(count)}
+        if self.__profile_memory and tracemalloc.is_tracing():
+            record['peak'] = max(0, tracemalloc.get_traced_memory()[1] \
+                                    - mem)
+
+        if name in self.__profile:
+            total = self.__profile[name]
+            total['calls'] += 1
+            total['wall'] += record['wall']
+            total['cpu'] += record['cpu']
+            total['peak'] = max(total['peak'], record['peak'])
+            total['count'] += record['count']
+        else:
+            self.__profile[name] = {'calls': 1}
+            self.__profile[name].update(record)
+
+        if self.__profile_callback is not None:
+            try:
+                self.__profile_callback(name, record)
+            except:
+                msg = 'Profiling callback failed'
+                error = sys.exc_info()[:2]
+                self.__warning(msg, error)
+
+######################################################################
+######################################################################
+
+    def __check_progress(self, progress, cancel):
+        ''' Checks the progress callback and the cancel token
+        '''
+
+        if progress is not None and not callable(progress):
+            msg = 'progress must be callable'
+            self.__error(msg)
+            return False
+
+        if cancel is not None and not hasattr(cancel, 'is_set'):
+            msg = 'cancel must have an is_set method, like ' + \
+                  'threading.Event'
+            self.__error(msg)
+            return False
+
+        return True
+
+######################################################################
+######################################################################
+
+    def __progress(self, progress, cancel, stage, fraction):
+        ''' Reports the fraction done of a stage, returns whether
+            the generation has been cancelled
+        '''
+
+        if progress is not None:
+            try:
+                progress(fraction, stage)
+            except:
+                msg = 'Progress callback failed'
+                error = sys.exc_info()[:2]
+                self.__warning(msg, error)
+
+        return cancel is not None and cancel.is_set()
+
+######################################################################
+######################################################################
+
+    def __shallow_copy(self):
+        ''' Copy of the map sharing the layers, with its own ranges,
+            wind nodes, polylines and caches
+        '''
+
+        new = copy.copy(self)
+        new.__thrange = list(self.__thrange)
+        new.__chrange = list(self.__chrange)
+        new.__pthrange = list(self.__pthrange)
+        new.__pchrange = list(self.__pchrange)
+        new.__wind_nodes = copy.deepcopy(self.__wind_nodes)
+        new.__tile_cache = OrderedDict()
+        new.__tile_lock = threading.Lock()
+        new.__dirty = set(self.__dirty)
+        new.__generation = dict(self.__generation)
+        if self.__river_exist:
+            new.__river = np.array(self.__river)
+            new.__river_off = np.array(self.__river_off)
+        if self.__lake_exist:
+            new.__lake = np.array(self.__lake)
+            new.__lake_off = np.array(self.__lake_off)
+
+        return new
+
+######################################################################
+######################################################################
+######################################################################
+######################################################################
+
+    def build_pyramid(self, levels=None):
+        ''' Builds a level of detail pyramid, halving the resolution
+            at each level. Continuous layers are averaged over the
+            cells, which have equal area, the wind speed is the one
+            of the mean velocity and the biome is the most common
+            one. By default, levels are added while the map
+            has at least 3x3 nodes
+        '''
+
+        if not self.__exist:
+            msg = 'Must generate a map first'
+            self.__error(msg)
+            return
+
+        if levels is None:
+            ilevels = 64
+        else:
+            try:
+                ilevels = int(levels)
+            except:
+                msg = 'Invalid number of levels'
+                self.__error(msg)
+                return
+
+        pyramid = []
+        level = {'lat': self.__lat, 'lon': self.__lon, \
+                 'height': self.__height}
+        if self.__wind_exist:
+            level['wind'] = self.__wind
+        if self.__temperature_exist:
+            level['temperature'] = self.__temperature
+        if self.__moist_exist:
+            level['moist'] = self.__moist
+        if self.__biome_exist:
+            level['biome'] = self.__biome
+
+        while len(pyramid) < ilevels and \
+              (level['lat'].size + 1)//2 >= 3 and \
+              (level['lon'].size + 1)//2 >= 3:
+            coarse = {}
+            sinlat = self.__downsample(np.sin(level['lat']*self.__dera))
+            coarse['lat'] = np.arcsin(sinlat)*self.__rade
+            coarse['lon'] = self.__downsample(level['lon'])
+
+            # Bands of an even number of rows, so memory mapped layers
+            # are not read whole
+            band = 2*max(1, (1 << 19)//level['lon'].size)
+            for key in level.keys():
+                if key in coarse:
+                    continue
+                if key == 'biome':
+                    func = self.__downsample_biome
+                elif key == 'wind':
+                    func = self.__downsample_wind
+                else:
+                    func = self.__downsample
+                coarse[key] = np.concatenate( \
+                          [func(level[key][i0:i0+band]) \
+                           for i0 in range(0, level[key].shape[0], band)])
+            pyramid.append(coarse)
+            level = coarse
+
+        self.__pyramid = pyramid
+
+######################################################################
+######################################################################
+
+    def get_nlevels(self):
+        ''' Get number of levels of the pyramid, including the full
+            resolution map
+        '''
+
+        if self.__pyramid is None:
+            return 1
+
+        return len(self.__pyramid) + 1
+
+######################################################################
+######################################################################
+
+    def get_level(self, level):
+        ''' Returns the map at a level of the pyramid as a new map,
+            level 0 being a copy of this map. The pyramid is built
+            if needed
+        '''
+
+        if not self.__exist:
+            msg = 'Must generate a map first'
+            self.__error(msg)
+            return None
+
+        try:
+            ilevel = int(level)
+        except:
+            msg = 'Invalid level'
+            self.__error(msg)
+            return None
+
+        if ilevel == 0:
+            return self.__shallow_copy()
+
+        if self.__pyramid is None:
+            self.build_pyramid()
+
+        if ilevel < 0 or ilevel > len(self.__pyramid):
+            msg = 'Level must be between 0 and ' + \
+                  str(len(self.__pyramid))
+            self.__error(msg)
+            return None
+
+        coarse = self.__pyramid[ilevel-1]
+        lmap = self.__shallow_copy()
+        lmap.__pyramid = self.__pyramid[ilevel:]
+        lmap.__nth = coarse['lat'].size
+        lmap.__nch = coarse['lon'].size
+        lmap.__lat = coarse['lat']
+        lmap.__lon = coarse['lon']
+        lmap.__height = coarse['height']
+        lmap.__wind_raw = None
+        lmap.__temperature_raw = None
+        if 'wind' in coarse:
+            lmap.__wind = coarse['wind']
+        if 'temperature' in coarse:
+            lmap.__temperature = coarse['temperature']
+        if 'moist' in coarse:
+            lmap.__moist = coarse['moist']
+        if 'biome' in coarse:
+            lmap.__biome = coarse['biome']
+
+        return lmap
+
+######################################################################
+######################################################################
+
+    def __downsample(self, data):
+        ''' Mean over blocks of 2x2 nodes. An odd last row or column
+            is averaged alone
+        '''
+
+        ii = np.arange(0, data.shape[0], 2)
+        sums = np.add.reduceat(data, ii, axis=0)
+        counts = np.diff(np.append(ii, data.shape[0]))
+        if data.ndim > 1:
+            jj = np.arange(0, data.shape[1], 2)
+            sums = np.add.reduceat(sums, jj, axis=1)
+            counts = np.outer(counts, \
+                              np.diff(np.append(jj, data.shape[1])))
+        counts = counts.reshape(counts.shape + (1,)*(data.ndim - \
+                                                    counts.ndim))
+
+        return (sums/counts).astype(data.dtype, copy=False)
+
+######################################################################
+######################################################################
+
+    def __downsample_wind(self, wind):
+        ''' Mean wind over blocks of 2x2 nodes. The direction
+            components are averaged, and the speed is the modulus
+            of the mean velocity, so opposite winds cancel out
+        '''
+
+        coarse = self.__downsample(wind)
+
+        # Velocity of each node, the speed along the direction
+        norm = np.sqrt(wind[:,:,0]**2 + wind[:,:,1]**2)
+        speed = np.divide(wind[:,:,2], norm, \
+                          out=np.zeros(norm.shape), where=norm > 1e-7)
+        u0 = self.__downsample(wind[:,:,0]*speed)
+        u1 = self.__downsample(wind[:,:,1]*speed)
+        coarse[:,:,2] = np.sqrt(u0*u0 + u1*u1)
+
+        return coarse
+
+######################################################################
+######################################################################
+
+    def __downsample_biome(self, data):
+        ''' Most common biome over blocks of 2x2 nodes. Ties go to
+            the lowest biome
+        '''
+
+        vals, inv = np.unique(data, return_inverse=True)
+        inv = inv.reshape(data.shape)
+        onehot = (inv[:,:,None] == np.arange(vals.size)). \
+                                               astype(np.int8)
+        ii = np.arange(0, data.shape[0], 2)
+        jj = np.arange(0, data.shape[1], 2)
+        counts = np.add.reduceat(np.add.reduceat(onehot, ii, axis=0), \
+                                 jj, axis=1)
+
+        return vals[np.argmax(counts, axis=2)].astype(data.dtype)
+
 ######################################################################
 ######################################################################
 
     def __interN(self, data, xold, yold, zold, wold=None):
         ''' Pseudo-interpolation to a different grid. It looks for
-            the closest neighbour
+            the closest neighbour in latitude, longitude, height and
+            temperature, with a kd-tree if available
         '''
 
         # Weights for distances
@@ -5922,40 +8028,37 @@ class maps_class():
                    np.min(self.__temperature)
             ww /= maxw
 
-        # Allocate new data
-        datanew = np.zeros((self.__nth, self.__nch))
-
-        # For each new point
-        for ilat, xnew in zip(range(self.__nth), self.__lat):
-            for ilon, ynew in zip(range(self.__nch), self.__lon):
-
-                znew = self.__height[ilat, ilon]
-
-                dx = (__xold - xnew)*maxx
-                dx *= dx
-                dy = (__yold - ynew)*maxy
-                dy *= dy
-                ddx, ddy = np.meshgrid(dx, dy, indexing='ij')
-                dz = __zold - znew
-                dz *= dz
-
-                if wold is None:
-                    dw = np.zeros(dz.shape)
-                else:
-                    wnew = self.__temperature[ilat,ilon]
-                    dw = __wold - wnew
-                    dw *= dw
-
-                Delta = wh*(ddx + ddy) + wz*dz + ww*dw
-
-                inds = np.argmin(Delta)
-
-                ix, iy = np.unravel_index(inds, dz.shape)
-
-                datanew[ilat,ilon] = data[ix,iy]
+        # Features of the old and new points, the distance is
+        # wh*(dx^2 + dy^2) + wz*dz^2 + ww*dw^2
+        xo, yo = np.meshgrid(__xold*maxx, __yold*maxy, indexing='ij')
+        xn, yn = np.meshgrid(self.__lat*maxx, self.__lon*maxy, \
+                             indexing='ij')
+        fold = [xo, yo, __zold]
+        fnew = [xn, yn, self.__height]
+        weights = [wh, wh, wz]
+        if wold is not None:
+            fold.append(__wold)
+            fnew.append(self.__temperature)
+            weights.append(ww)
+        weights = np.array(weights, dtype=float)
+        fold = np.stack([fo.ravel() for fo in fold], axis=1)
+        fnew = np.stack([fn.ravel() for fn in fnew], axis=1)
+
+        # Closest old point of each new point
+        if self.__has_kdtree() and np.all(weights > 0.):
+            scale = np.sqrt(weights)
+            tree = cKDTree(fold*scale)
+            dist, inds = tree.query(fnew*scale, workers=-1)
+        else:
+            inds = np.empty(fnew.shape[0], dtype=np.int64)
+            block = max(1, 2**22//max(fold.shape[0], 1))
+            for i0 in range(0, fnew.shape[0], block):
+                delta = fnew[i0:i0+block,None,:] - fold[None,:,:]
+                delta = np.dot(delta*delta, weights)
+                inds[i0:i0+block] = np.argmin(delta, axis=1)
 
         # Return
-        return datanew
+        return data.reshape(-1)[inds].reshape(self.__nth, self.__nch)
 
 ######################################################################
 ######################################################################
@@ -6003,7 +8106,9 @@ class maps_class():
 ######################################################################
 
     def rotate(self, ang=None):
-        ''' Rotates the longitude axis the quantity specified
+        ''' Rotates the longitude axis the quantity specified. The
+            layers are not moved, the rotation is applied when the
+            map is drawn or stored, or by materialize_rotation()
         '''
 
         if not self.__exist:
@@ -6017,192 +8122,162 @@ class maps_class():
             self.__error(msg)
             return
 
-        for ii in range(len(self.__lon)):
+        # Only stored, applied when the map is read
+        self.__lon_offset = self.__wrap_lon(self.__lon_offset + ang)
 
-            self.__lon[ii] += ang
+######################################################################
+######################################################################
 
-            if self.__lon[ii] < -180.:
-                self.__lon[ii] += 359.
+    def get_rotation(self):
+        ''' Get the pending rotation of the longitude
+        '''
 
-            if self.__lon[ii] > 179.:
-                self.__lon[ii] -= 359.
+        return self.__lon_offset
 
-        ind = self.__lon.argsort()
-        self.__lon.sort()
+######################################################################
+######################################################################
 
-        # Rotate height
-        arraycopy = np.copy(self.__height)
+    def materialize_rotation(self):
+        ''' Applies the pending rotation to the stored layers
+        '''
 
-        for jj in range(len(self.__lat)):
-            for ii in range(len(self.__lon)):
-                self.__height[jj,ii] = arraycopy[jj,ind[ii]]
+        if not self.__exist or self.__lon_offset == 0.:
+            return
 
-        # Rotate wind
+        ang = self.__lon_offset
+
+        # Rotate the pyramid levels, each on its own longitudes
+        pyramid = None
+        if self.__pyramid is not None:
+            pyramid = []
+            for coarse in self.__pyramid:
+                lon, gather = self.__columns(coarse['lon'])
+                level = {'lat': coarse['lat'], 'lon': lon}
+                for key in coarse.keys():
+                    if key not in level:
+                        level[key] = gather(coarse[key])
+                pyramid.append(level)
+
+        # New longitudes, and the columns that go to each of them
+        self.__lon, gather = self.__columns(self.__lon)
+        self.__lon_offset = 0.
+
+        # Rotate every layer, including the wind modulus
+        self.__height = gather(self.__height)
         if self.__wind_exist:
-            arraycopy = np.copy(self.__wind)
+            self.__wind = gather(self.__wind)
+        if self.__wind_raw is not None:
+            self.__wind_raw = gather(self.__wind_raw)
+        if self.__temperature_exist:
+            self.__temperature = gather(self.__temperature)
+        if self.__temperature_raw is not None:
+            self.__temperature_raw = gather(self.__temperature_raw)
+        if self.__moist_exist:
+            self.__moist = gather(self.__moist)
+        if self.__biome_exist:
+            self.__biome = gather(self.__biome)
 
-            for kk in range(2):
-                for jj in range(len(self.__lat)):
-                    for ii in range(len(self.__lon)):
-                        self.__wind[jj,ii,kk] = \
-                                              arraycopy[jj,ind[ii],kk]
+        # Rotate lakes and rivers
+        if self.__lake_exist:
+            self.__lake[:,1] = self.__wrap_lon(self.__lake[:,1] + ang)
+        if self.__river_exist:
+            self.__river[:,1] = self.__wrap_lon(self.__river[:,1] + ang)
 
-        # Rotate temperature
-        if self.__temperature_exist:
-            arraycopy = np.copy(self.__temperature)
+        self.__changed()
+        self.__pyramid = pyramid
 
-            for jj in range(len(self.__lat)):
-                for ii in range(len(self.__lon)):
-                    self.__temperature[jj,ii] = arraycopy[jj,ind[ii]]
+######################################################################
+######################################################################
 
-        # Rotate moist
-        if self.__moist_exist:
-            arraycopy = np.copy(self.__moist)
+    def __columns(self, lon):
+        ''' Longitudes with the pending rotation applied, sorted, and
+            a function that moves the columns of a layer to them
+        '''
 
-            for jj in range(len(self.__lat)):
-                for ii in range(len(self.__lon)):
-                    self.__moist[jj,ii] = arraycopy[jj,ind[ii]]
+        if self.__lon_offset == 0.:
+            return lon, lambda data: data
 
-        # Rotate biome
-        if self.__biome_exist:
-            arraycopy = np.copy(self.__biome)
+        lon = self.__wrap_lon(lon + self.__lon_offset)
+        ind = np.argsort(lon, kind='stable')
 
-            for jj in range(len(self.__lat)):
-                for ii in range(len(self.__lon)):
-                    self.__biome[jj,ii] = arraycopy[jj,ind[ii]]
+        # A whole number of columns on a regular grid is a roll
+        shift = int(ind[0])
+        if np.array_equal(ind, np.roll(np.arange(ind.size), -shift)):
+            gather = lambda data: np.roll(data, -shift, axis=1)
+        else:
+            gather = lambda data: np.take(data, ind, axis=1)
 
-        # Rotate lakes
-        if self.__lake_exist:
-            for il in range(len(self.__lake)):
-                for ix in range(len(self.__lake[il][1])):
-                    newx = self.__lake[il][1][ix] + ang
-                    if newx < -180.:
-                        newx += 359.
-                    if newx > 179.:
-                        newx -= 359.
-                    self.__lake[il][1][ix] = newx
-
-        # Rotate rivers
-        if self.__river_exist:
-            for ir in range(len(self.__river)):
-                for ix in range(len(self.__river[ir][1])):
-                    newx = self.__river[ir][1][ix] + ang
-                    if newx < -180.:
-                        newx += 359.
-                    if newx > 179.:
-                        newx -= 359.
-                    self.__river[ir][1][ix] = newx
+        return lon[ind], gather
 
 ######################################################################
 ######################################################################
+
+    def __rotate_line(self, line):
+        ''' Polyline with the pending rotation applied
+        '''
+
+        if self.__lon_offset == 0.:
+            return line
+
+        line = np.array(line)
+        line[:,1] = self.__wrap_lon(line[:,1] + self.__lon_offset)
+
+        return line
+
 ######################################################################
 ######################################################################
 
-    def __color_def(self, minv=None, maxv=None):
-        ''' Defines the color bar given the limits of the map and the
-            predefined height color scale
+    def __wrap_lon(self, lon):
+        ''' Longitude in [-180,180)
         '''
 
-        if minv is None:
-            minv = -10.0
-        if maxv is None:
-            maxv = 20.0
+        return np.mod(lon + 180., 360.) - 180.
 
-        bit_rgb = np.linspace(0,1,256)
+######################################################################
+######################################################################
+######################################################################
+######################################################################
 
-        # Predefined color scale
-        precolo = [(  0, 51,102),(  0,102,204),( 51,153,255), \
-                   (102,178,255),(204,255,255),(220,255,255), \
-                   (220,255,255),(  0,153,  0),(  0,204,  0), \
-                   (  0,204,  0),(  0,204,102),(  0,255,128), \
-                   (225,225,123),(215,215,111),(255,178,102), \
-                   (204,102,  0),(153, 76,  0),(102, 51,  0), \
-                   (102,  0,204),(153, 51,255),(178,102,255), \
-                   (204,153,255),(229,204,255)]
-        preleve = [-10.0,-8.0,-6.0, \
-                   -4.0,-2.0,-0.2, \
-                   -0.001,0.0,0.001, \
-                   0.25,0.5,0.75, \
-                   1.0,1.5,1.75, \
-                   3.0,3.5,6.0, \
-                   6.001,9.0,10.0, \
-                   15.0,20.0]
+    def __color_def(self, minv=None, maxv=None):
+        ''' Defines the color bar given the limits of the map and the
+            predefined height color scale
+        '''
 
-        # Introduce the extremes of the data
-        level = [minv]
-        if minv >= preleve[0]:
-            if minv == preleve[0]:
-                color = [precolo[0]]
-                ini=1
-            else:
-                ini = -1
-                for i in range(len(preleve)-1):
-                    if minv >= preleve[i] and minv < preleve[i+1]:
-                        R = [precolo[i][0],precolo[i+1][0]]
-                        G = [precolo[i][1],precolo[i+1][1]]
-                        B = [precolo[i][2],precolo[i+1][2]]
-                        color = [(np.interp([minv],[preleve[i], \
-                                            preleve[i+1]],R)[0],
-                                  np.interp([minv],[preleve[i], \
-                                            preleve[i+1]],G)[0],
-                                  np.interp([minv],[preleve[i], \
-                                            preleve[i+1]],B)[0])]
-                        ini = i+1
-                        break
-        else:
-            color = [(  0,  0,  0)]
-            ini = 0
-        if maxv < preleve[len(preleve)-1]:
-            for j in range(len(preleve[ini:])-1):
-                if maxv > preleve[ini+j] and maxv <= preleve[ini+j+1]:
-                    for k in range(len(preleve[ini:ini+j+1])):
-                        level.append(preleve[k+ini])
-                        color.append(precolo[k+ini])
-                    level.append(maxv)
-                    fin = ini+j
-                    R = [precolo[fin][0],precolo[fin+1][0]]
-                    G = [precolo[fin][1],precolo[fin+1][1]]
-                    B = [precolo[fin][2],precolo[fin+1][2]]
-                    color.append((np.interp([maxv],[preleve[fin], \
-                                            preleve[fin+1]],R)[0], \
-                                  np.interp([maxv],[preleve[fin], \
-                                            preleve[fin+1]],G)[0],
-                                  np.interp([maxv],[preleve[fin], \
-                                            preleve[fin+1]],B)[0]))
-        else:
-            for j in range(len(preleve[ini:])):
-                level.append(preleve[ini+j])
-                color.append(precolo[ini+j])
-                fin = ini+j
-            if maxv != preleve[len(preleve)-1]:
-                level.append(maxv)
-                color.append((255,255,255))
+        return self.__color_cached(('height', minv, maxv), \
+                   lambda: self.__color_map('physicheigh', \
+                       *self.__height_scale(minv, maxv), 256))
 
-        # Normalize the height scale
-        a = 1./(maxv - minv)
-        b = minv/(minv - maxv)
-        for i in range(len(level)):
-            level[i] = a*level[i] + b
-        level[0] = 0
-        level[len(level)-1]=1
+######################################################################
+######################################################################
 
-        # Transform from bits to 0-1
-        for i in range(len(color)):
-            color[i] = (bit_rgb[int(round(color[i][0]))],
-                        bit_rgb[int(round(color[i][1]))],
-                        bit_rgb[int(round(color[i][2]))])
+    def __height_scale(self, minv=None, maxv=None):
+        ''' Levels and colors of the height color bar
+        '''
 
-        # Generate the dictionary
-        cdict = {'red':[], 'green':[], 'blue':[]}
-        for lv, col in zip(level, color):
-            cdict[ 'red' ].append((lv, col[0], col[0]))
-            cdict['green'].append((lv, col[1], col[1]))
-            cdict[ 'blue'].append((lv, col[2], col[2]))
+        if minv is None:
+            minv = -10.0
+        if maxv is None:
+            maxv = 20.0
 
-        # Define map and return
-        cmap = LinearSegmentedColormap('physicheigh',cdict,256)
+        # Predefined color scale
+        precolo = [(  0, 51,102),(  0,102,204),( 51,153,255), \
+                   (102,178,255),(204,255,255),(220,255,255), \
+                   (220,255,255),(  0,153,  0),(  0,204,  0), \
+                   (  0,204,  0),(  0,204,102),(  0,255,128), \
+                   (225,225,123),(215,215,111),(255,178,102), \
+                   (204,102,  0),(153, 76,  0),(102, 51,  0), \
+                   (102,  0,204),(153, 51,255),(178,102,255), \
+                   (204,153,255),(229,204,255)]
+        preleve = [-10.0,-8.0,-6.0, \
+                   -4.0,-2.0,-0.2, \
+                   -0.001,0.0,0.001, \
+                   0.25,0.5,0.75, \
+                   1.0,1.5,1.75, \
+                   3.0,3.5,6.0, \
+                   6.001,9.0,10.0, \
+                   15.0,20.0]
 
-        return cmap
+        return self.__color_segments(precolo, preleve, minv, maxv)
 
 ######################################################################
 ######################################################################
@@ -6214,13 +8289,22 @@ class maps_class():
             predefined temperature color scale
         '''
 
+        return self.__color_cached(('temperature', minv, maxv), \
+                   lambda: self.__color_map('physicheigh', \
+                       *self.__temperature_scale(minv, maxv), 256))
+
+######################################################################
+######################################################################
+
+    def __temperature_scale(self, minv=None, maxv=None):
+        ''' Levels and colors of the temperature color bar
+        '''
+
         if minv is None:
             minv = -10.0
         if maxv is None:
             maxv = 20.0
 
-        bit_rgb = np.linspace(0,1,256)
-
         # Predefined color scale
         precolo = [(  0,  0,255), \
                    (100,100,255), \
@@ -6237,179 +8321,147 @@ class maps_class():
                     30, \
                     100]
 
-        # Introduce the extremes of the data
-        level = [minv]
-        if minv >= preleve[0]:
-            if minv == preleve[0]:
-                color = [precolo[0]]
-                ini=1
-            else:
-                ini = -1
-                for i in range(len(preleve)-1):
-                    if minv >= preleve[i] and minv < preleve[i+1]:
-                        R = [precolo[i][0],precolo[i+1][0]]
-                        G = [precolo[i][1],precolo[i+1][1]]
-                        B = [precolo[i][2],precolo[i+1][2]]
-                        color = [(np.interp([minv],[preleve[i], \
-                                            preleve[i+1]],R)[0],
-                                  np.interp([minv],[preleve[i], \
-                                            preleve[i+1]],G)[0],
-                                  np.interp([minv],[preleve[i], \
-                                            preleve[i+1]],B)[0])]
-                        ini = i+1
-                        break
-        else:
-            color = [(  0,  0,  0)]
-            ini = 0
-        if maxv < preleve[len(preleve)-1]:
-            for j in range(len(preleve[ini:])-1):
-                if maxv > preleve[ini+j] and maxv <= preleve[ini+j+1]:
-                    for k in range(len(preleve[ini:ini+j+1])):
-                        level.append(preleve[k+ini])
-                        color.append(precolo[k+ini])
-                    level.append(maxv)
-                    fin = ini+j
-                    R = [precolo[fin][0],precolo[fin+1][0]]
-                    G = [precolo[fin][1],precolo[fin+1][1]]
-                    B = [precolo[fin][2],precolo[fin+1][2]]
-                    color.append((np.interp([maxv],[preleve[fin], \
-                                            preleve[fin+1]],R)[0], \
-                                  np.interp([maxv],[preleve[fin], \
-                                            preleve[fin+1]],G)[0],
-                                  np.interp([maxv],[preleve[fin], \
-                                            preleve[fin+1]],B)[0]))
-        else:
-            for j in range(len(preleve[ini:])):
-                level.append(preleve[ini+j])
-                color.append(precolo[ini+j])
-                fin = ini+j
-            if maxv != preleve[len(preleve)-1]:
-                level.append(maxv)
-                color.append((255,255,255))
+        return self.__color_segments(precolo, preleve, minv, maxv)
 
-        # Normalize the height scale
-        a = 1./(maxv - minv)
-        b = minv/(minv - maxv)
-        for i in range(len(level)):
-            level[i] = a*level[i] + b
-        level[0] = 0
-        level[len(level)-1]=1
+######################################################################
+######################################################################
+######################################################################
+######################################################################
 
-        # Transform from bits to 0-1
-        for i in range(len(color)):
-            color[i] = (bit_rgb[int(round(color[i][0]))],
-                        bit_rgb[int(round(color[i][1]))],
-                        bit_rgb[int(round(color[i][2]))])
+    def __color_adjust(self, cmap, minv, maxv, ominv, omaxv):
+        ''' Redefines a new color bar from a previous one respecting
+            the limits
+        '''
 
-        # Generate the dictionary    
-        cdict = {'red':[], 'green':[], 'blue':[]}
-        for lv, col in zip(level, color):
-            cdict[ 'red' ].append((lv, col[0], col[0]))
-            cdict['green'].append((lv, col[1], col[1]))
-            cdict[ 'blue'].append((lv, col[2], col[2]))
+        key = (cmap.name, minv, maxv, ominv, omaxv)
 
-        # Define map and return    
-        cmap = LinearSegmentedColormap('physicheigh',cdict,256)    
+        return self.__color_cached(key, \
+                   lambda: self.__color_map('physicheigh', \
+                               *self.__adjust_scale(cmap, minv, maxv, \
+                                                    ominv, omaxv), 256))
 
-        return cmap
+######################################################################
+######################################################################
+
+    def __adjust_scale(self, cmap, minv, maxv, ominv, omaxv):
+        ''' Levels and colors of a color bar taken from a previous
+            one, any function of an array of indexes from 0 to 255
+            returning the colors between 0 and 1
+        '''
+
+        # Color map
+        index = np.arange(256)
+        precolo = np.asarray(cmap(index))[:,:3]*255.
+        preleve = (omaxv-ominv)*index.astype(float)/255. + ominv
+
+        return self.__color_segments(precolo, preleve, minv, maxv)
 
 ######################################################################
 ######################################################################
 ######################################################################
 ######################################################################
 
-    def __color_adjust(self, cmap, minv, maxv, ominv, omaxv):
-        ''' Redefines a new color bar from a previous one respecting
-            the limits
+    def __color_segments(self, precolo, preleve, minv, maxv):
+        ''' Levels, normalized between 0 and 1, and colors of a
+            color bar given the limits of the map and a predefined
+            color scale
         '''
 
         bit_rgb = np.linspace(0,1,256)
+        preleve = np.asarray(preleve, dtype=float)
+        precolo = np.asarray(precolo, dtype=float)
 
-        # Color map
-        precolo = []
-        preleve = []
-        for i in range(256):
-            precolo.append((cmap(i)[0]*255., \
-                            cmap(i)[1]*255., \
-                            cmap(i)[2]*255.))
-            preleve.append((omaxv-ominv)*float(i)/255. + ominv)
+        def interp(v):
+            return np.array([np.interp(v, preleve, precolo[:,ic]) \
+                             for ic in range(3)])
 
         # Introduce the extremes of the data
-        level = [minv]
         if minv >= preleve[0]:
-            if minv == preleve[0]:
-                color = [precolo[0]]
-                ini=1
-            else:
-                ini = -1
-                for i in range(len(preleve)-1):
-                    if minv >= preleve[i] and minv < preleve[i+1]:
-                        R = [precolo[i][0],precolo[i+1][0]]
-                        G = [precolo[i][1],precolo[i+1][1]]
-                        B = [precolo[i][2],precolo[i+1][2]]
-                        color = [(np.interp([minv],[preleve[i], \
-                                            preleve[i+1]],R)[0],
-                                  np.interp([minv],[preleve[i], \
-                                            preleve[i+1]],G)[0],
-                                  np.interp([minv],[preleve[i], \
-                                            preleve[i+1]],B)[0])]
-                        ini = i+1
-                        break
+            first = interp(minv)
+            ini = np.searchsorted(preleve, minv, side='right')
         else:
-            color = [(  0,  0,  0)]
+            first = np.zeros(3)
             ini = 0
         if maxv < preleve[-1]:
-            for j in range(len(preleve[ini:])-1):
-                if maxv > preleve[ini+j] and maxv <= preleve[ini+j+1]:
-                    for k in range(len(preleve[ini:ini+j+1])):
-                        level.append(preleve[k+ini])
-                        color.append(precolo[k+ini])
-                    level.append(maxv)
-                    fin = ini+j
-                    R = [precolo[fin][0],precolo[fin+1][0]]
-                    G = [precolo[fin][1],precolo[fin+1][1]]
-                    B = [precolo[fin][2],precolo[fin+1][2]]
-                    color.append((np.interp([maxv],[preleve[fin], \
-                                            preleve[fin+1]],R)[0], \
-                                  np.interp([maxv],[preleve[fin], \
-                                            preleve[fin+1]],G)[0],
-                                  np.interp([maxv],[preleve[fin], \
-                                            preleve[fin+1]],B)[0]))
+            fin = np.searchsorted(preleve, maxv, side='left')
+            last = [interp(maxv)]
         else:
-            for j in range(len(preleve[ini:])):
-                level.append(preleve[ini+j])
-                color.append(precolo[ini+j])
-                fin = ini+j
-            if maxv != preleve[len(preleve)-1]:
-                level.append(maxv)
-                color.append((255,255,255))
+            fin = len(preleve)
+            last = [] if maxv == preleve[-1] else [np.full(3, 255.)]
+        level = np.concatenate(([minv], preleve[ini:fin], \
+                                [maxv]*len(last)))
+        color = np.vstack([first, precolo[ini:fin]] + last)
 
         # Normalize the height scale
         a = 1./(maxv - minv)
         b = minv/(minv - maxv)
-        for i in range(len(level)):
-            level[i] = a*level[i] + b
+        level = a*level + b
         level[0] = 0
-        level[len(level)-1]=1
+        level[-1] = 1
 
         # Transform from bits to 0-1
-        for i in range(len(color)):
-            color[i] = (bit_rgb[int(round(color[i][0]))],
-                        bit_rgb[int(round(color[i][1]))],
-                        bit_rgb[int(round(color[i][2]))])
+        color = bit_rgb[np.rint(color).astype(int)]
+
+        return level, color
+
+######################################################################
+######################################################################
+
+    def __color_cached(self, key, build):
+        ''' Color map or table from the cache shared by every map,
+            built and stored when missing
+        '''
+
+        with __colors_lock:
+            if key in __colors:
+                __colors.move_to_end(key)
+                return __colors[key]
+
+        value = build()
+
+        with __colors_lock:
+            __colors[key] = value
+            __colors.move_to_end(key)
+            while len(__colors) > __colors_size:
+                __colors.popitem(last=False)
+
+        return value
+
+######################################################################
+######################################################################
 
-        # Generate the dictionary    
+    def __color_map(self, name, level, color, N):
+        ''' Matplotlib color map from levels and colors
+        '''
+
+        # Generate the dictionary
         cdict = {'red':[], 'green':[], 'blue':[]}
         for lv, col in zip(level, color):
             cdict[ 'red' ].append((lv, col[0], col[0]))
             cdict['green'].append((lv, col[1], col[1]))
             cdict[ 'blue'].append((lv, col[2], col[2]))
 
-        # Define map and return    
-        cmap = LinearSegmentedColormap('physicheigh',cdict,256)    
+        # Define map and return
+        cmap = LinearSegmentedColormap(name,cdict,N)
 
         return cmap
 
+######################################################################
+######################################################################
+
+    def __color_lut(self, level, color, N):
+        ''' Table of N colors as uint8 from levels and colors,
+            sampled as a matplotlib color map would do
+        '''
+
+        x = np.linspace(0., 1., N)
+        color = np.array(color, dtype=float)
+        lut = np.empty((N,3))
+        for ic in range(3):
+            lut[:,ic] = np.interp(x, level, color[:,ic])
+
+        return np.rint(lut*255.).astype(np.uint8)
+
 ######################################################################
 ######################################################################
 ######################################################################
@@ -6419,6 +8471,17 @@ class maps_class():
         ''' Defines the color bar for biomes
         '''
 
+        return self.__color_cached(('biome',), \
+                   lambda: self.__color_map('biomes', \
+                                            *self.__biome_scale(), 12))
+
+######################################################################
+######################################################################
+
+    def __biome_scale(self):
+        ''' Levels and colors of the biome color bar
+        '''
+
         minv = -3.
         maxv = 8.
 
@@ -6464,17 +8527,7 @@ class maps_class():
                         bit_rgb[int(round(color[i][1]))],
                         bit_rgb[int(round(color[i][2]))])
 
-        # Generate the dictionary    
-        cdict = {'red':[], 'green':[], 'blue':[]}
-        for lv, col in zip(level, color):
-            cdict[ 'red' ].append((lv, col[0], col[0]))
-            cdict['green'].append((lv, col[1], col[1]))
-            cdict[ 'blue'].append((lv, col[2], col[2]))
-
-        # Define map and return    
-        cmap = LinearSegmentedColormap('biomes',cdict,12)
-
-        return cmap
+        return level, color
 
 ######################################################################
 ######################################################################
@@ -6627,7 +8680,7 @@ class maps_class():
         ''' Visualize a map in 2D
         '''
 
-        if not self.__can_plot_2D:
+        if not self.__can_plot_2D():
             msg = 'pyplot/cartopy not available'
             self.__error(msg)
             return
@@ -6664,8 +8717,10 @@ class maps_class():
         # Get projection
         proj = self.__get_projection(lat_0,lon_0,pthrange,pchrange)
 
-        # Get heights, longitudes and latitudes
-        pheight, lon, lat = self.__height, self.__lon, self.__lat
+        # Get heights, longitudes and latitudes, with the pending
+        # rotation applied to the columns
+        lon, gather = self.__columns(self.__lon)
+        pheight, lat = gather(self.__height), self.__lat
 
         # Compute native map projection coordinates of lat/lon grid.
         x, y = np.meshgrid(lon, lat)
@@ -6773,178 +8828,28 @@ class maps_class():
                 cbar.set_label('km')
                 cax.yaxis.set_label_position('left')
 
-                # If there are lakes
+                # If there are lakes, as a single collection
                 if self.__lake_exist:
-                    jj = -1
-                    # For each lake
-                    for lake in self.__lake:
-                        jj += 1
-                        lakex = lake[1]
-                        lakey = lake[0]
-
-                        # Borders
-                        xl = np.min(lakex)
-                        xr = np.max(lakex)
-                        yl = np.min(lakey)
-                        yr = np.max(lakey)
-
-                        # Check if completely out of bounds
-                        if xr < pchrange[0] or \
-                           xl > pchrange[1] or \
-                           yr < pthrange[0] or \
-                           yl > pthrange[1]:
-                            continue
-
-                        # If the lake crosses the globe
-                        if xl < -170. and xr > 170.:
-                            lakexl = []
-                            lakeyl = []
-                            lakexr = []
-                            lakeyr = []
-                            for ii in range(len(lakex)):
-                                if lakex[ii] > 0.:
-                                    lakexl += [lakex[ii]]
-                                    lakeyl += [lakey[ii]]
-                                else:
-                                    lakexr += [lakex[ii]]
-                                    lakeyr += [lakey[ii]]
-                            ax.fill(lakexr, lakeyr, \
-                                    color=(0.86,1.0,1.0,1.0), \
-                                    transform=proj)
-                            ax.fill(lakexl, lakeyl, \
-                                    color=(0.86,1.0,1.0,1.0), \
-                                    transform=proj)
-                        # If the lake is fine in the periodic boundary
-                        else:
-
-                            # Check that the lake is not split
-                            if xl < pchrange[0] or \
-                               xr > pchrange[1] or \
-                               yl < pthrange[0] or \
-                               yr > pthrange[1]:
-
-                                lakexl = []
-                                lakeyl = []
-                                for ii in range(len(lakex)):
-                                    if lakex[ii] > xl and \
-                                       lakex[ii] < xr and \
-                                       lakey[ii] > yl and \
-                                       lakey[ii] < yr:
-                                        lakexl += [lakex[ii]]
-                                        lakeyl += [lakey[ii]]
-
-                                ax.fill(lakexl, lakeyl, \
-                                        color=(0.86,1.0,1.0,1.0), \
-                                        transform=proj)
-
-                            # If no split
-                            else:
-                                ax.fill(lakex, lakey, \
-                                        color=(0.86,1.0,1.0,1.0), \
-                                        transform=proj)
-
-                # If there are rivers
+                    verts = self.__line_pieces( \
+                                    self.__rotate_line(self.__lake), \
+                                               self.__lake_off, \
+                                               pthrange, pchrange, \
+                                               closed=True)
+                    ax.add_collection(PolyCollection(verts, \
+                                        facecolors=(0.86,1.0,1.0,1.0), \
+                                        edgecolors=(0.86,1.0,1.0,1.0), \
+                                        transform=proj))
+
+                # If there are rivers, as a single collection
                 if self.__river_exist:
-                    # For each river
-                    for river in self.__river:
-
-                        riverx = river[1]
-                        rivery = river[0]
-
-                        # Borders
-                        xl = np.min(riverx)
-                        xr = np.max(riverx)
-                        yl = np.min(rivery)
-                        yr = np.max(rivery)
-
-                        # Check if completely out of bounds
-                        if xr < pchrange[0] or \
-                           xl > pchrange[1] or \
-                           yr < pthrange[0] or \
-                           yl > pthrange[1]:
-                            continue
-
-                        # If the river crosses the globe
-                        if xl < -170. and xr > 170.:
-
-                            lriversx = []
-                            lriversy = []
-                            llriversx = [riverx[0]]
-                            llriversy = [rivery[0]]
-
-                            if riverx[0] < 0.:
-                                pos = -1.
-                            else:
-                                pos = 1
-
-                            for ii in range(1,len(riverx)):
-
-                                if pos < 0. and riverx[ii] > 0.:
-                                    pos = 1.
-                                    lriversx.append(llriversx)
-                                    lriversy.append(llriversy)
-                                    llriversx = [riverx[ii]]
-                                    llriversy = [rivery[ii]]
-
-                                elif pos > 0. and riverx[ii] < 0.:
-                                    pos = -1.
-                                    lriversx.append(llriversx)
-                                    lriversy.append(llriversy)
-                                    llriversx = [riverx[ii]]
-                                    llriversy = [rivery[ii]]
-
-                                else:
-                                    llriversx.append(riverx[ii])
-                                    llriversy.append(rivery[ii])
-                                
-                                if len(llriversx) > 0:
-                                    lriversx.append(llriversx)
-                                    lriversy.append(llriversy)
-
-                            for rivx,rivy in zip(lriversx,lriversy):
-                                ax.plot(rivx,rivy, \
-                                         color=(0.86,1.0,1.0,1.0), \
-                                         transform=proj)
-
-                        # If the river is fine in the periodic
-                        # boundary
-                        else:
-
-                            # Check that the lake is not split
-                            if xl < pchrange[0] or \
-                               xr > pchrange[1] or \
-                               yl < pthrange[0] or \
-                               yr > pthrange[1]:
-
-                                riverxl = []
-                                riveryl = []
-                                for ii in range(len(riverx)):
-                                    if riverx[ii] > xl and \
-                                       riverx[ii] < xr and \
-                                       rivery[ii] > yl and \
-                                       rivery[ii] < yr:
-                                        riverxl.append(riverx[ii])
-                                        riveryl.append(rivery[ii])
-                                        if ii == len(riverx)-1:
-                                            ax.plot(riverxl,riveryl, \
-                                               color= \
-                                                 (0.86,1.0,1.0,1.0), \
-                                               transform=proj)
-                                    else:
-                                        if len(riverxl) > 0:
-                                            ax.plot(riverxl,riveryl, \
-                                               color= \
-                                                 (0.86,1.0,1.0,1.0), \
-                                               transform=proj)
-                                            riverxl = []
-                                            riveryl = []
-
-                            # If no split
-                            else:
-
-                                ax.plot(riverx,rivery, \
-                                        color=(0.86,1.0,1.0,1.0), \
-                                        transform=proj)
+                    verts = self.__line_pieces( \
+                                    self.__rotate_line(self.__river), \
+                                               self.__river_off, \
+                                               pthrange, pchrange, \
+                                               closed=False)
+                    ax.add_collection(LineCollection(verts, \
+                                        colors=(0.86,1.0,1.0,1.0), \
+                                        transform=proj))
 
                 # Fix extent
                 if self.__river_exist or self.__lake_exist:
@@ -6958,9 +8863,9 @@ class maps_class():
             elif ii == 1:
 
                 # Get vector
-                plonv = self.__wind[:,:,1]
-                platv = self.__wind[:,:,0]
-                pmodv = self.__wind[:,:,2]
+                plonv = gather(self.__wind[:,:,1])
+                platv = gather(self.__wind[:,:,0])
+                pmodv = gather(self.__wind[:,:,2])
 
                 # Adjust color
                 cmap = self.__color_adjust(cm.rainbow, \
@@ -6992,7 +8897,7 @@ class maps_class():
             elif ii == 2:
 
                 # Get temperature
-                ptemp = self.__temperature
+                ptemp = gather(self.__temperature)
 
                 # Contour data over the map.
                 ax.contour(x,y,pheight,[0.],transform=proj, \
@@ -7039,7 +8944,7 @@ class maps_class():
             elif ii == 3:
 
                 # Get moist
-                pmoist = self.__moist
+                pmoist = gather(self.__moist)
 
                 # Contour data over the map.
                 ax.contour(x,y,pheight,[0.],transform=proj, \
@@ -7081,7 +8986,7 @@ class maps_class():
             elif ii == 4:
 
                 # Get biome
-                pbiome = self.__biome
+                pbiome = gather(self.__biome)
 
                 # Contour data over the map.
                 ax.contour(x,y,pheight,[0.],transform=proj, \
@@ -7171,3 +9076,551 @@ class maps_class():
             plt.show()        
         plt.close('all')
 
+
+######################################################################
+######################################################################
+######################################################################
+######################################################################
+
+    def render_png(self, layer=None, name=None, projection=None):
+        ''' Stores a layer of the map ("height", "wind",
+            "temperature", "moist" or "biome") as a png image with
+            one pixel per node and the colors used by draw. The
+            projection can be "pc" or "lcy". Needs no pyplot
+        '''
+
+        if not self.__exist:
+            msg = 'Must generate a map first'
+            self.__error(msg)
+            return
+
+        if layer is None:
+            layer = 'height'
+
+        if name is None:
+            name = self.__name + '_' + str(layer) + '.png'
+
+        if projection is None:
+            if self.__projection == 'lcy':
+                projection = 'lcy'
+            else:
+                projection = 'pc'
+
+        if projection not in ['pc', 'lcy']:
+            msg = 'Unknown projection '+str(projection)+ \
+                  ', must be pc or lcy'
+            self.__error(msg)
+            return
+
+        rgb = self.__layer_rgb(layer)
+        if rgb is None:
+            return
+
+        # Rows from north to south, uniform in the projection
+        if projection == 'pc':
+            coord = self.__lat
+        else:
+            coord = np.sin(self.__lat*self.__dera)
+        target = np.linspace(coord[-1], coord[0], len(coord))
+        irow = np.clip(np.searchsorted(coord, target), 1, len(coord)-1)
+        near = np.abs(coord[irow-1]-target) <= np.abs(coord[irow]-target)
+        irow = np.where(near, irow-1, irow)
+
+        # Pending rotation of the columns
+        lon, gather = self.__columns(self.__lon)
+
+        self.__write_png(name, gather(rgb[irow]))
+
+######################################################################
+######################################################################
+
+    def __layer_rgb(self, layer):
+        ''' Colors of a layer as an uint8 (nth,nch,3) array
+        '''
+
+        N = 256
+        if layer == 'height':
+            data = self.__height
+            minv, maxv = np.min(data), np.max(data)
+            key = ('height', minv, maxv)
+            build = lambda: self.__height_scale(minv, maxv)
+        elif layer == 'wind':
+            if not self.__wind_exist:
+                msg = 'Must generate a wind first'
+                self.__error(msg)
+                return
+            data = self.__wind[:,:,2]
+            minv, maxv = np.min(data), np.max(data)
+            ominv, omaxv = self.__minwind, self.__maxwind
+            key = ('rainbow', self.__can_plot_2D(), minv, maxv, \
+                   ominv, omaxv)
+            build = lambda: self.__adjust_scale( \
+                                self.__base_cmap('rainbow'), \
+                                minv, maxv, ominv, omaxv)
+        elif layer == 'temperature':
+            if not self.__temperature_exist:
+                msg = 'Must generate a temperature first'
+                self.__error(msg)
+                return
+            data = self.__temperature
+            minv, maxv = np.min(data), np.max(data)
+            T0, T1 = self.__mintemperature, self.__maxtemperature
+            if T0 < 0:
+                key = ('temperature', T0, T1)
+                build = lambda: self.__temperature_scale(T0, T1)
+            else:
+                key = ('Reds_r', self.__can_plot_2D())
+                build = lambda: (np.linspace(0., 1., N), \
+                                 self.__base_cmap('Reds_r') \
+                                     (np.arange(N))[:,:3])
+        elif layer == 'moist':
+            if not self.__moist_exist:
+                msg = 'Must generate a moisture first'
+                self.__error(msg)
+                return
+            data = self.__moist
+            minv, maxv = np.min(data), np.max(data)
+            ominv, omaxv = self.__minmoist, self.__maxmoist
+            key = ('plasma', self.__can_plot_2D(), minv, maxv, \
+                   ominv, omaxv)
+            build = lambda: self.__adjust_scale( \
+                                self.__base_cmap('plasma'), \
+                                minv, maxv, ominv, omaxv)
+        elif layer == 'biome':
+            if not self.__biome_exist:
+                msg = 'Must generate a biome first'
+                self.__error(msg)
+                return
+            data = self.__biome
+            minv, maxv = -3., 8.
+            N = 12
+            key = ('biome',)
+            build = self.__biome_scale
+        else:
+            msg = 'Unknown layer '+str(layer)+ \
+                  ', must be height, wind, temperature, moist or biome'
+            self.__error(msg)
+            return
+
+        lut = self.__color_cached(('table',) + key, \
+                                  lambda: self.__color_lut(*build(), N))
+
+        # Index of every node in the table
+        if maxv > minv:
+            idx = (np.asarray(data, dtype=float)-minv)*(N/(maxv-minv))
+            idx = np.clip(idx.astype(np.int64), 0, N-1)
+        else:
+            idx = np.zeros(np.shape(data), dtype=np.int64)
+
+        return lut[idx]
+
+######################################################################
+######################################################################
+
+    def __base_cmap(self, name):
+        ''' Matplotlib color map by name, or a close approximation
+            when pyplot is not available, as a function of an array
+            of indexes from 0 to 255
+        '''
+
+        if self.__can_plot_2D():
+            return getattr(cm, name)
+
+        x = np.linspace(0., 1., 256)
+        if name == 'rainbow':
+            table = np.array([np.abs(2.*x-.5), \
+                              np.sin(np.pi*x), \
+                              np.cos(.5*np.pi*x)]).T
+        else:
+            if name == 'plasma':
+                points = [( 13,  8,135),( 75,  3,161),(125,  3,168), \
+                          (168, 34,150),(203, 70,121),(229,107, 93), \
+                          (248,148, 65),(253,195, 40),(240,249, 33)]
+            elif name == 'Reds_r':
+                points = [(103,  0, 13),(165, 15, 21),(203, 24, 29), \
+                          (239, 59, 44),(251,106, 74),(252,146,114), \
+                          (252,187,161),(254,224,210),(255,245,240)]
+            points = np.array(points, dtype=float)/255.
+            xp = np.linspace(0., 1., len(points))
+            table = np.array([np.interp(x, xp, points[:,ic]) \
+                              for ic in range(3)]).T
+        rgba = np.column_stack((np.clip(table, 0., 1.), np.ones(256)))
+
+        return lambda i: rgba[i]
+
+######################################################################
+######################################################################
+
+    def __write_png(self, name, rgb):
+        ''' Stores an uint8 (n,m,3) array as a png file
+        '''
+
+        def chunk(tag, data):
+            crc = zlib.crc32(tag + data) & 0xffffffff
+            return struct.pack('>I', len(data)) + tag + data + \
+                   struct.pack('>I', crc)
+
+        height, width = rgb.shape[0], rgb.shape[1]
+
+        # Every row starts with the filter type 0
+        raw = np.zeros((height, 3*width+1), dtype=np.uint8)
+        raw[:,1:] = np.ascontiguousarray(rgb, dtype=np.uint8). \
+                    reshape(height, 3*width)
+
+        header = struct.pack('>IIBBBBB', width, height, 8, 2, 0, 0, 0)
+        with open(name, 'wb') as f:
+            f.write(b'\x89PNG\r\n\x1a\n')
+            f.write(chunk(b'IHDR', header))
+            f.write(chunk(b'IDAT', zlib.compress(raw.tobytes())))
+            f.write(chunk(b'IEND', b''))
+
+######################################################################
+######################################################################
+######################################################################
+######################################################################
+
+def _maps_class__batch_world(seed, params, outdir, stages, outputs, \
+                             cachedir):
+    ''' Generates and stores the world of a seed for
+        generate_batch, returns the seed, the files written and
+        the error, None if every output was written
+    '''
+
+    files = []
+    try:
+        with contextlib.redirect_stdout(io.StringIO()):
+            world = maps_class(seed=seed, **params)
+            base = '{0}_{1}'.format(params.get('name', 'map'), seed)
+            if cachedir is None:
+                stream = None
+            else:
+                stream = os.path.join(cachedir, base + '.npy')
+            base = os.path.join(outdir, base)
+
+            # The same steps as generate_all, with the heights
+            # streamed if there is a cache directory, each one
+            # checked by the stage it completes
+            if stages == 'map':
+                steps = [('generate_map', 'map', \
+                          lambda: world.generate_map(stream=stream))]
+            else:
+                steps = [('generate_map', 'map', \
+                          lambda: world.generate_map(full=True, \
+                                                     stream=stream)), \
+                         ('generate_weather', 'biome', \
+                          world.generate_weather)]
+            if stages == 'all':
+                steps.append(('generate_rivers', 'rivers', \
+                              world.generate_rivers))
+            for method, stage, step in steps:
+                step()
+                if stage not in world.get_generated():
+                    return seed, files, method + ' failed'
+
+            # Files left by a previous run must not pass as written
+            for output in outputs:
+                if output == 'map':
+                    name = base + '.map'
+                elif output == 'vtk':
+                    name = base + '.vtk'
+                else:
+                    name = base + '_' + output + '.png'
+                if os.path.isfile(name):
+                    os.remove(name)
+                if output == 'map':
+                    world.save_map(name)
+                elif output == 'vtk':
+                    world.save_vtk(name, binary=True)
+                else:
+                    world.render_png(output, name)
+                if not os.path.isfile(name):
+                    return seed, files, 'Could not store ' + name
+                files.append(name)
+    except (Exception, SystemExit):
+        error = sys.exc_info()[:2]
+        return seed, files, '{0}: {1}'.format(error[0].__name__, \
+                                              error[1])
+
+    return seed, files, None
+
+######################################################################
+######################################################################
+
+def _maps_class__batch_params(params):
+    ''' Checks the parameters of generate_batch on a map, as the
+        map only warns about invalid values and takes the default.
+        Returns the error, None if the map takes every parameter
+    '''
+
+    try:
+        with contextlib.redirect_stdout(io.StringIO()):
+            world = maps_class(seed=0, **params)
+    except (Exception, SystemExit):
+        error = sys.exc_info()[:2]
+        return 'Invalid params, {0}: {1}'.format(error[0].__name__, \
+                                                 error[1])
+
+    for key, given in params.items():
+        if given is None:
+            continue
+        if key == 'windnnodes':
+            value = world.get_winddnnodes()
+        else:
+            value = getattr(world, 'get_' + key)()
+        if value is None or isinstance(value, str) or \
+           isinstance(given, str):
+            same = value == given
+        else:
+            try:
+                same = np.array_equal(np.asarray(value, dtype=float), \
+                                      np.asarray(given, dtype=float))
+            except (TypeError, ValueError):
+                same = False
+        if not same:
+            return 'Invalid value of ' + key + ': ' + str(given)
+
+    return None
+
+######################################################################
+######################################################################
+
+def _maps_class__batch_run(seeds, params, workers, outdir, stages, \
+                           outputs, cachedir):
+    ''' Runs the worlds of generate_batch, yields (seed, files,
+        error) as every world finishes
+    '''
+
+    # A single worker runs here, sharing the noise of this process
+    if workers == 1:
+        for seed in seeds:
+            yield _maps_class__batch_world(seed, params, outdir, \
+                                           stages, outputs, cachedir)
+        return
+
+    # Every process keeps its noise generators for all the seeds it
+    # gets
+    pool = ProcessPoolExecutor(max_workers=min(workers, len(seeds)) \
+                                           if len(seeds) > 0 else 1)
+    try:
+        futures = dict([(pool.submit(_maps_class__batch_world, seed, \
+                                     params, outdir, stages, \
+                                     outputs, cachedir), seed) \
+                        for seed in seeds])
+        for future in as_completed(futures):
+            try:
+                yield future.result()
+            except Exception:
+                error = sys.exc_info()[:2]
+                yield futures[future], [], \
+                      '{0}: {1}'.format(error[0].__name__, error[1])
+    finally:
+        for future in futures:
+            future.cancel()
+        pool.shutdown(wait=True)
+
+######################################################################
+######################################################################
+
+def generate_batch(seeds, params=None, workers=None, outdir=None, \
+                   stages=None, outputs=None, cachedir=None):
+    ''' Generates the world of every seed, with the other
+        maps_class parameters in the dictionary params, in a pool
+        of workers processes. stages is "map", "weather" or "all"
+        (default), as generate_map, generate_weather or
+        generate_all, and outputs lists "map" (default), "vtk" or
+        layers of render_png, stored in outdir as name_seed.map,
+        name_seed.vtk and name_seed_layer.png. With cachedir the
+        heights are streamed to cachedir/name_seed.npy. Returns an
+        iterator of (seed, files, error) as every world finishes,
+        error is None unless that world failed. Raises ValueError
+        for invalid arguments or parameters, before generating
+    '''
+
+    # Check input
+    if params is None:
+        params = {}
+    if not isinstance(params, dict) or 'seed' in params:
+        msg = 'params must be a dictionary without seed'
+        raise ValueError(msg)
+    try:
+        seeds = [int(seed) for seed in seeds]
+    except (TypeError, ValueError):
+        msg = 'seeds must be a list of integers'
+        raise ValueError(msg)
+    if workers is None:
+        workers = os.cpu_count() or 1
+    if not isinstance(workers, int) or workers < 1:
+        msg = 'workers must be a positive integer'
+        raise ValueError(msg)
+    if outdir is None:
+        outdir = '.'
+    if not os.path.isdir(outdir):
+        msg = 'outdir must be an existing directory'
+        raise ValueError(msg)
+    if stages is None:
+        stages = 'all'
+    if stages not in ['map', 'weather', 'all']:
+        msg = 'stages must be map, weather or all'
+        raise ValueError(msg)
+    if outputs is None:
+        outputs = ['map']
+    if isinstance(outputs, str) or \
+       not all([output in ['map', 'vtk', 'height', 'wind', \
+                           'temperature', 'moist', 'biome'] \
+                for output in outputs]):
+        msg = 'outputs must be a list of map, vtk or layers'
+        raise ValueError(msg)
+    outputs = list(outputs)
+    if stages == 'map' and \
+       any([output in ['wind', 'temperature', 'moist', 'biome'] \
+            for output in outputs]):
+        msg = 'outputs of the weather need stages weather or all'
+        raise ValueError(msg)
+    if cachedir is not None and not os.path.isdir(cachedir):
+        msg = 'cachedir must be an existing directory'
+        raise ValueError(msg)
+    msg = _maps_class__batch_params(params)
+    if msg is not None:
+        raise ValueError(msg)
+
+    return _maps_class__batch_run(seeds, params, workers, outdir, \
+                                  stages, outputs, cachedir)
+
+######################################################################
+######################################################################
+
+def main(argv=None):
+    ''' Command line generation of maps, python -m maps --help
+        for the options. Returns the exit status, 1 if any world
+        failed
+    '''
+
+    parser = argparse.ArgumentParser(prog='python -m maps', \
+                 description='Pseudo-random map generation')
+    parser.add_argument('--par', default=None, \
+                        help='.par file with the parameters, the ' + \
+                             'options below override it')
+    for key, kind in [('nth', int), ('nch', int), ('seed', int), \
+                      ('octaves', int), ('frequency', float), \
+                      ('persistence', float), ('water', float), \
+                      ('maxdepth', float), ('maxheight', float), \
+                      ('windnnodes', int), ('maxwindspeed', float), \
+                      ('mintemperature', float), \
+                      ('maxtemperature', float), \
+                      ('projection', str), ('name', str)]:
+        parser.add_argument('--' + key, type=kind, default=None, \
+                            help='see maps_class.parameter_list()')
+    parser.add_argument('--thrange', type=float, nargs=2, default=None, \
+                        metavar=('TH0', 'TH1'), \
+                        help='latitude range in degrees')
+    parser.add_argument('--chrange', type=float, nargs=2, default=None, \
+                        metavar=('CH0', 'CH1'), \
+                        help='longitude range in degrees')
+    parser.add_argument('--stages', default='all', \
+                        choices=['map', 'weather', 'all'], \
+                        help='heights, up to the biomes, or also ' + \
+                             'rivers and lakes')
+    parser.add_argument('--seeds', default=None, \
+                        help='comma separated seeds or first-last ' + \
+                             'ranges, instead of --seed')
+    parser.add_argument('--workers', type=int, default=1, \
+                        help='worker processes for the seeds')
+    parser.add_argument('--cache-dir', default=None, \
+                        help='directory to stream the heights to ' + \
+                             'as .npy files')
+    parser.add_argument('--outdir', default='.', \
+                        help='directory of the outputs')
+    parser.add_argument('--outputs', default='map', \
+                        help='comma separated map, vtk and layers ' + \
+                             'to store as png')
+    args = parser.parse_args(argv)
+
+    # The map would only warn and take the default
+    for key in ['nth', 'nch']:
+        if getattr(args, key) is not None and getattr(args, key) < 3:
+            parser.error('--' + key + ' must be at least 3')
+    for key, limit in [('thrange', 90.), ('chrange', 180.)]:
+        ran = getattr(args, key)
+        if ran is not None and \
+           (ran[0] >= ran[1] or ran[0] < -limit or ran[1] > limit):
+            parser.error(('--{0} must be increasing, between ' + \
+                          '{1:g} and {2:g}').format(key, -limit, limit))
+    if args.workers < 1:
+        parser.error('--workers must be a positive integer')
+
+    # Parameters of the .par file, or the defaults
+    world = maps_class()
+    if args.par is not None and not world.load_parameters(args.par):
+        return 1
+    params = {'nth': world.get_nth(), \
+              'nch': world.get_nch(), \
+              'thrange': world.get_thrange(), \
+              'chrange': world.get_chrange(), \
+              'pthrange': world.get_pthrange(), \
+              'pchrange': world.get_pchrange(), \
+              'seed': world.get_seed(), \
+              'octaves': world.get_octaves(), \
+              'frequency': world.get_frequency(), \
+              'persistence': world.get_persistence(), \
+              'water': world.get_water(), \
+              'maxdepth': world.get_maxdepth(), \
+              'maxheight': world.get_maxheight(), \
+              'windnnodes': world.get_winddnnodes(), \
+              'maxwindspeed': world.get_maxwindspeed(), \
+              'mintemperature': world.get_mintemperature(), \
+              'maxtemperature': world.get_maxtemperature(), \
+              'projection': world.get_projection(), \
+              'name': world.get_name()}
+    if world.get_windnodes() is not None:
+        params['windnodes'] = world.get_windnodes()
+
+    for key in params.keys():
+        if getattr(args, key, None) is not None:
+            params[key] = getattr(args, key)
+    if args.thrange is not None:
+        params['pthrange'] = args.thrange
+    if args.chrange is not None:
+        params['pchrange'] = args.chrange
+
+    # Seeds
+    seed = params.pop('seed')
+    if args.seeds is None:
+        seeds = [seed]
+    else:
+        seeds = []
+        try:
+            for item in args.seeds.split(','):
+                if '-' in item:
+                    first, last = item.split('-')
+                    seeds += list(range(int(first), int(last) + 1))
+                else:
+                    seeds.append(int(item))
+        except ValueError:
+            parser.error('seeds must be like 1,2,10-20')
+
+    outputs = [output for output in args.outputs.split(',') \
+               if len(output) > 0]
+
+    try:
+        worlds = generate_batch(seeds, params, args.workers, \
+                                args.outdir, args.stages, outputs, \
+                                args.cache_dir)
+    except ValueError as error:
+        parser.error(str(error))
+
+    status = 0
+    for seed, files, error in worlds:
+        if error is None:
+            print('{0} {1}'.format(seed, ' '.join(files)))
+        else:
+            print('{0} failed: {1}'.format(seed, error), \
+                  file=sys.stderr)
+            status = 1
+
+    return status
+
+######################################################################
+######################################################################
+
+if __name__ == '__main__':
+    sys.exit(main())